@@ -0,0 +1,114 @@
+"""
+Compares prefix lookups on paths: ``LIKE`` vs. bytewise range.
+
+Fills an unlogged table with N synthetic paths (default 10M) like
+'/data/d17/s042/f000012345', then counts the rows below a few directories,
+once with ``path LIKE '/data/d1%'`` as the walker used to do, and once
+with the range predicate of :func:`stoma.models.below` on an index on
+``path COLLATE "C"``. Reports the plan, rows matched and best execution
+time of several runs.
+
+Directories are named d0 .. d999 without padding, so that the LIKE
+predicate also matches siblings, e.g. d10 .. d19 and d100 .. d199 for d1.
+
+Needs a PostgreSQL database; the table is kept for further runs unless
+``--drop`` is given.
+
+Usage::
+
+    python bench/path_prefix.py [--rows N] [--runs N] [--drop] URL
+
+e.g. ``python bench/path_prefix.py postgresql://stoma@localhost/stoma_bench``
+"""
+import argparse
+import json
+import sys
+
+import sqlalchemy as sa
+
+
+TABLE = 'bench_path'
+PREFIXES = ('/data/d1', '/data/d500', '/data/d999/s007')
+
+
+def create(conn, n):
+    conn.execute('DROP TABLE IF EXISTS {}'.format(TABLE))
+    conn.execute('CREATE UNLOGGED TABLE {} (path VARCHAR(1024) '
+        'PRIMARY KEY)'.format(TABLE))
+    print('Inserting {} rows...'.format(n))
+    conn.execute("""
+        INSERT INTO {} (path)
+        SELECT '/data/d' || (i % 1000)
+            || '/s' || lpad(((i / 1000) % 100)::text, 3, '0')
+            || '/f' || lpad(i::text, 9, '0')
+        FROM generate_series(0, {} - 1) AS i
+    """.format(TABLE, n))
+    print('Creating index...')
+    conn.execute('CREATE INDEX {0}_c_ix ON {0} (path COLLATE "C")'.format(
+        TABLE))
+    conn.execute('VACUUM ANALYZE {}'.format(TABLE))
+
+
+def explain(conn, where, params):
+    sql = 'EXPLAIN (ANALYZE, FORMAT JSON) SELECT count(*) FROM {} ' \
+        'WHERE {}'.format(TABLE, where)
+    r = conn.execute(sa.text(sql), params).scalar()
+    if isinstance(r, str):
+        r = json.loads(r)
+    plan = r[0]
+    # Below the aggregate
+    node = plan['Plan']['Plans'][0]
+    while node.get('Node Type') in ('Gather', 'Partial Aggregate') \
+            and node.get('Plans'):
+        node = node['Plans'][0]
+    return node['Node Type'], plan['Execution Time']
+
+
+def count(conn, where, params):
+    sql = 'SELECT count(*) FROM {} WHERE {}'.format(TABLE, where)
+    return conn.execute(sa.text(sql), params).scalar()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('url', help='SQLAlchemy URL of a PostgreSQL DB')
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--drop', action='store_true',
+        help='Drop the table afterwards')
+    args = parser.parse_args(argv[1:])
+
+    engine = sa.create_engine(args.url)
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        n = conn.execute("SELECT count(*) FROM pg_class "
+            "WHERE relname = '{}'".format(TABLE)).scalar()
+        if n:
+            n = conn.execute('SELECT count(*) FROM {}'.format(TABLE)).scalar()
+        if n != args.rows:
+            create(conn, args.rows)
+
+        like = 'path LIKE :pattern'
+        range_ = 'path COLLATE "C" >= :lower AND path COLLATE "C" < :upper'
+        print('{:18s} {:6s} {:28s} {:>10s} {:>10s}'.format(
+            'prefix', 'kind', 'plan', 'rows', 'ms'))
+        for prefix in PREFIXES:
+            cases = (
+                ('like', like, {'pattern': prefix + '%'}),
+                ('range', range_, {'lower': prefix + '/',
+                    'upper': prefix + '0'}),
+            )
+            for kind, where, params in cases:
+                best = None
+                for _ in range(args.runs):
+                    node, ms = explain(conn, where, params)
+                    best = ms if best is None else min(best, ms)
+                print('{:18s} {:6s} {:28s} {:10d} {:10.1f}'.format(
+                    prefix, kind, node, count(conn, where, params), best))
+
+        if args.drop:
+            conn.execute('DROP TABLE {}'.format(TABLE))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
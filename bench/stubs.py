@@ -0,0 +1,232 @@
+"""
+Stand-ins for Tika and ElasticSearch servers.
+
+They answer the requests :class:`stoma.tika.TikaRestClient` and
+:class:`stoma.elastics.ElasticSearchRestClient` send, with canned results
+after a configurable latency, so that benchmarks measure stoma rather than
+the servers. Each request sleeps ``latency`` seconds plus ``per_mb``
+seconds per MiB of request body.
+
+Usage::
+
+    python bench/stubs.py [--tika-port N] [--ela-port N] [--latency S]
+        [--per-mb S]
+"""
+import argparse
+import html
+import http.server
+import json
+import mimetypes
+import re
+import sys
+import threading
+import time
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle's algorithm the
+    # body waits for the client's delayed ACK, about 40 ms per request
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def read_body(self):
+        n = int(self.headers.get('Content-Length') or 0)
+        if n:
+            return self.rfile.read(n)
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(parts)
+        return b''
+
+    def delay(self, body):
+        srv = self.server
+        time.sleep(srv.latency + srv.per_mb * len(body) / 1048576)
+
+    def reply(self, body, content_type='application/json', status=200):
+        if not isinstance(body, bytes):
+            if not isinstance(body, str):
+                body = json.dumps(body)
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self):
+        body = self.read_body()
+        with self.server.lock:
+            self.server.n_requests += 1
+        self.delay(body)
+        self.handle_request(self.command, self.path.split('?')[0], body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = dispatch
+
+
+class TikaHandler(StubHandler):
+
+    def handle_request(self, method, path, body):
+        fn = re.search(r'filename=(.*)$',
+            self.headers.get('content-disposition', ''))
+        fn = fn.group(1) if fn else ''
+        mt = mimetypes.guess_type(fn)[0] or 'application/octet-stream'
+        text = html.escape(body[:2000].decode('utf-8', errors='replace')) \
+            if mt.startswith(('text/', 'application/json')) else ''
+        accept = self.headers.get('accept', '')
+        meta = {'Content-Type': mt, 'Content-Length': str(len(body)),
+            'resourceName': fn}
+        if path == '/version':
+            self.reply('Apache Tika stub', 'text/plain')
+        elif path == '/detect/stream':
+            self.reply(mt, 'text/plain')
+        elif path.startswith('/language/'):
+            self.reply('en', 'text/plain')
+        elif path == '/meta':
+            if accept == 'application/rdf+xml':
+                self.reply('<rdf:RDF/>', 'application/rdf+xml')
+            else:
+                self.reply(meta)
+        elif path == '/tika':
+            if accept == 'text/html':
+                self.reply('<html><head><title>{}</title></head><body><p>{}'
+                    '</p></body></html>'.format(fn, text), 'text/html')
+            else:
+                self.reply(text, 'text/plain')
+        elif path.startswith('/rmeta'):
+            if not path.endswith('/ignore'):
+                meta['X-TIKA:content'] = ('<html><head></head><body><p>{}'
+                    '</p></body></html>').format(text)
+            self.reply([meta])
+        else:
+            self.reply({'error': 'not found'}, status=404)
+
+
+class ElasticHandler(StubHandler):
+
+    def handle_request(self, method, path, body):
+        srv = self.server
+        if path == '/' and method == 'GET':
+            self.reply({'name': 'stub', 'cluster_name': 'bench',
+                'version': {'number': '5.6.0', 'lucene_version': '6.6.0'},
+                'tagline': 'You Know, for Search'})
+        elif path.endswith('/_count'):
+            self.reply({'count': len(srv.docs)})
+        elif path == '/_bulk':
+            self.reply({'took': 1, 'errors': False,
+                'items': self.bulk(body)})
+        elif method in ('PUT', 'DELETE') and path.count('/') == 2 \
+                and path.endswith('/'):
+            # Create or delete index
+            self.reply({'acknowledged': True})
+        elif method in ('PUT', 'POST'):
+            with srv.lock:
+                id_ = path.rstrip('/').split('/')[-1]
+                srv.docs[id_] = srv.docs.get(id_, 0) + 1
+                v = srv.docs[id_]
+            self.reply({'_id': id_, '_version': v, 'result': 'created'})
+        elif method == 'DELETE':
+            with srv.lock:
+                srv.docs.pop(path.rstrip('/').split('/')[-1], None)
+            self.reply({'result': 'deleted'})
+        else:
+            self.reply({'found': False}, status=404)
+
+    def bulk(self, body):
+        srv = self.server
+        lines = body.decode('utf-8').splitlines()
+        items = []
+        i = 0
+        while i < len(lines):
+            action, meta = list(json.loads(lines[i]).items())[0]
+            i += 1
+            if action != 'delete':
+                i += 1
+            with srv.lock:
+                id_ = meta.get('_id')
+                if id_ is None:
+                    srv.next_id += 1
+                    id_ = 'stub{}'.format(srv.next_id)
+                if action == 'delete':
+                    status = 200 if srv.docs.pop(id_, None) else 404
+                    v = 1
+                else:
+                    srv.docs[id_] = srv.docs.get(id_, 0) + 1
+                    v = srv.docs[id_]
+                    status = 201 if v == 1 else 200
+            items.append({action: {'_id': id_, '_version': v,
+                'status': status}})
+        return items
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, handler, port=0, latency=0.0, per_mb=0.0):
+        """
+        A stub server on localhost, serving in a background thread.
+
+        :param handler: :class:`TikaHandler` or :class:`ElasticHandler`.
+        :param port: Port; 0 for any free one, see :attr:`port`.
+        :param latency: Seconds to sleep per request.
+        :param per_mb: Seconds to sleep per MiB of request body.
+        """
+        super().__init__(('127.0.0.1', port), handler)
+        self.latency = latency
+        self.per_mb = per_mb
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.docs = {}
+        self.next_id = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+            daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tika-port', type=int, default=9998)
+    parser.add_argument('--ela-port', type=int, default=9200)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--per-mb', type=float, default=0.0)
+    args = parser.parse_args(argv[1:])
+    tika = StubServer(TikaHandler, args.tika_port, args.latency,
+        args.per_mb).start()
+    ela = StubServer(ElasticHandler, args.ela_port, args.latency,
+        args.per_mb).start()
+    print('Tika stub on {}, ElasticSearch stub on {}'.format(tika.port,
+        ela.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    tika.stop()
+    ela.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,195 @@
+"""
+Times walk, analysis and indexing on a synthetic tree.
+
+Generates a tree with :mod:`tree` (or uses ``--tree``), starts the stubs of
+:mod:`stubs` for Tika and ElasticSearch, creates the data model in a fresh
+database and times, each in its own transaction:
+
+- ``walk``: :meth:`stoma.walker.Walker.walk` of the new tree,
+- ``analyse``: :meth:`stoma.analyser.Analyser.analyse`, or
+  ``analyse_parallel`` with ``--analyse-workers`` > 1,
+- ``index``: :meth:`stoma.indexer.Indexer.index`,
+- ``rewalk``: a second walk of the unchanged tree.
+
+``total`` is the sum of walk, analyse and index, i.e. an end-to-end first
+run. Results are printed, or written with ``--output``, as JSON together
+with the parameters, the commit and the summary of :mod:`stoma.metrics`,
+so that runs of different commits can be compared.
+
+The database defaults to a temporary SQLite file. A PostgreSQL URL may be
+given instead; its tables in schema ``stoma`` are DROPPED first, so use a
+dedicated database. Parallel analysis needs PostgreSQL.
+
+Usage::
+
+    python bench/suite.py [--db URL] [--tree DIR] [--latency S]
+        [--per-mb S] [--analyse-workers N] [--extract-mode MODE]
+        [--output FILE] [tree options, see bench/tree.py]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+import transaction
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stoma import models
+from stoma.analyser import Analyser
+from stoma.elastics import ElasticSearchRestClient
+from stoma.indexer import Indexer
+from stoma.metrics import REGISTRY
+from stoma.models import DbSession
+from stoma.tika import TikaRestClient, EXTRACT_MODE_CLASSIC
+from stoma.walker import Walker
+
+import stubs
+import tree
+
+
+def _bytewise(a, b):
+    # Code point order of str is the byte order of UTF-8
+    return (a > b) - (a < b)
+
+
+def create_engine(url):
+    """
+    Creates an engine and a fresh data model.
+
+    On SQLite, schema ``stoma`` is a second database file attached to each
+    connection, and collation "C", which :func:`stoma.models.below` uses,
+    compares bytewise like on PostgreSQL.
+    """
+    engine = sa.create_engine(url)
+    if engine.dialect.name == 'sqlite':
+        fn = engine.url.database
+        for x in (fn, fn + '.stoma'):
+            if os.path.exists(x):
+                os.remove(x)
+
+        @sa.event.listens_for(engine, 'connect')
+        def connect(dbapi_conn, rec):
+            dbapi_conn.create_collation('C', _bytewise)
+            dbapi_conn.execute('ATTACH DATABASE ? AS stoma', (fn + '.stoma',))
+    else:
+        engine.execute('CREATE SCHEMA IF NOT EXISTS stoma')
+        models.DbBase.metadata.drop_all(engine)
+    models.DbEngine = engine
+    DbSession.configure(bind=engine)
+    models.DbBase.metadata.bind = engine
+    models.create_all()
+    return engine
+
+
+def timed(results, key, func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    results[key] = round(time.perf_counter() - t0, 3)
+
+
+def in_transaction(func, *args):
+    with transaction.manager:
+        func(*args)
+
+
+def commit_id():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(__file__) or '.').decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, root, lgg):
+    tika_srv = stubs.StubServer(stubs.TikaHandler, latency=args.latency,
+        per_mb=args.per_mb).start()
+    ela_srv = stubs.StubServer(stubs.ElasticHandler, latency=args.latency,
+        per_mb=args.per_mb).start()
+    try:
+        create_engine(args.db)
+        sess = DbSession()
+        tika = TikaRestClient(port=tika_srv.port,
+            extract_mode=args.extract_mode)
+        ela = ElasticSearchRestClient(lgg=lgg, port=ela_srv.port)
+        w = Walker(lgg=lgg, sess=sess, walk_workers=args.walk_workers)
+        ana = Analyser(lgg=lgg, sess=sess, tika=tika,
+            workers=args.analyse_workers)
+        ixr = Indexer(lgg=lgg, sess=sess, ela=ela)
+
+        results = {}
+        timed(results, 'walk', in_transaction, w.walk, root)
+        if ana.workers > 1:
+            timed(results, 'analyse', ana.analyse_parallel)
+        else:
+            timed(results, 'analyse', in_transaction, ana.analyse)
+        timed(results, 'index', in_transaction, ixr.index)
+        results['total'] = round(results['walk'] + results['analyse']
+            + results['index'], 3)
+        timed(results, 'rewalk', in_transaction, w.walk, root)
+        results['tika_requests'] = tika_srv.n_requests
+        results['ela_requests'] = ela_srv.n_requests
+        results['ela_docs'] = len(ela_srv.docs)
+        w.close()
+        sess.close()
+        return results
+    finally:
+        tika_srv.stop()
+        ela_srv.stop()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db', help='SQLAlchemy URL; default is a '
+        'temporary SQLite file')
+    parser.add_argument('--tree', help='Existing tree to use instead of '
+        'generating one')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--per-mb', type=float, default=0.0)
+    parser.add_argument('--walk-workers', type=int, default=1)
+    parser.add_argument('--analyse-workers', type=int, default=1)
+    parser.add_argument('--extract-mode', default=EXTRACT_MODE_CLASSIC)
+    parser.add_argument('--output', help='Write results to this file')
+    tree.add_arguments(parser)
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.WARNING)
+    lgg = logging.getLogger('bench')
+    tmp = tempfile.mkdtemp(prefix='stoma-bench-')
+    try:
+        if not args.db:
+            args.db = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        params = {k: v for k, v in vars(args).items() if k != 'output'}
+        if args.tree:
+            root = os.path.abspath(args.tree)
+        else:
+            root = os.path.join(tmp, 'tree')
+            params['tree'] = tree.generate(root, files=args.files,
+                depth=args.depth, fanout=args.fanout,
+                median_size=args.median_size, max_size=args.max_size,
+                mix=args.mix, seed=args.seed)
+        results = run(args, root, lgg)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    out = json.dumps({
+        'commit': commit_id(),
+        'params': params,
+        'results': results,
+        'metrics': REGISTRY.summary(),
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fh:
+            fh.write(out + '\n')
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,64 @@
+"""
+Compares Tika extraction modes by bytes sent and wall time.
+
+Runs :meth:`stoma.tika.TikaPymMixin.pym` over the given files, once in
+classic mode and once in rmeta mode, against a running Tika server.
+
+Usage::
+
+    python bench/tika_extract.py [--host HOST] [--port PORT] FILE...
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stoma.tika import (TikaRestClient, EXTRACT_MODE_CLASSIC,
+    EXTRACT_MODE_RMETA)
+
+
+class CountingTikaRestClient(TikaRestClient):
+    """Counts requests and bytes of request bodies."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_requests = 0
+        self.n_bytes = 0
+
+    def _send(self, path, fn, hh, **kwargs):
+        self.n_requests += 1
+        self.n_bytes += os.path.getsize(fn)
+        return super()._send(path, fn, hh, **kwargs)
+
+    def language_text(self, text):
+        self.n_requests += 1
+        self.n_bytes += len(text.encode('utf-8'))
+        return super().language_text(text)
+
+
+def run(mode, files, host, port):
+    tika = CountingTikaRestClient(host=host, port=port, extract_mode=mode)
+    t0 = time.perf_counter()
+    for fn in files:
+        tika.pym(fn)
+    return time.perf_counter() - t0, tika.n_requests, tika.n_bytes
+
+
+def main(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument('--host', default='localhost')
+    p.add_argument('--port', type=int, default=9998)
+    p.add_argument('files', nargs='+')
+    args = p.parse_args(argv[1:])
+    total = sum(os.path.getsize(fn) for fn in args.files)
+    print('{} files, {} bytes'.format(len(args.files), total))
+    for mode in (EXTRACT_MODE_CLASSIC, EXTRACT_MODE_RMETA):
+        secs, n_req, n_bytes = run(mode, args.files, args.host, args.port)
+        print('{:8s} {:8.3f} s  {:6d} requests  {:12d} bytes sent'.format(
+            mode, secs, n_req, n_bytes))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
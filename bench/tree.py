@@ -0,0 +1,151 @@
+"""
+Generates a synthetic file tree for benchmarks.
+
+Files are spread over directories ``depth`` levels deep with ``fanout``
+subdirectories each. Sizes follow a log-normal distribution around
+``--median-size``, capped at ``--max-size``. The mime mix gives relative
+weights of file kinds, e.g. ``txt=5,html=2,json=1,pdf=1,jpg=1``; text
+kinds get readable content, the others random bytes behind a matching
+magic number.
+
+The same seed yields the same tree, including mtimes, so that results of
+different commits can be compared.
+
+Usage::
+
+    python bench/tree.py [--files N] [--depth N] [--fanout N]
+        [--median-size BYTES] [--max-size BYTES] [--mix KIND=W,...]
+        [--seed N] DIR
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+
+
+DEFAULT_MIX = 'txt=5,html=2,json=1,xml=1,pdf=1,jpg=1'
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+    'eiusmod tempor incididunt ut labore et dolore magna aliqua enim ad '
+    'minim veniam quis nostrud exercitation ullamco laboris nisi aliquip '
+    'ex ea commodo consequat').split()
+MAGIC = {
+    'pdf': b'%PDF-1.4\n',
+    'jpg': b'\xff\xd8\xff\xe0\x00\x10JFIF\x00',
+    'png': b'\x89PNG\r\n\x1a\n',
+    'zip': b'PK\x03\x04',
+}
+MTIME_BASE = 1500000000
+
+
+def parse_mix(s):
+    """
+    Parses a mime mix like 'txt=5,html=2'.
+
+    :return: List of tuples (kind, weight).
+    """
+    mix = []
+    for x in s.split(','):
+        k, _, w = x.strip().partition('=')
+        if k not in MAGIC and k not in ('txt', 'html', 'json', 'xml'):
+            raise ValueError("Unknown kind '{}'".format(k))
+        mix.append((k, float(w) if w else 1.0))
+    return mix
+
+
+def text(rnd, size):
+    ww = []
+    n = 0
+    while n < size:
+        w = rnd.choice(WORDS)
+        ww.append(w)
+        n += len(w) + 1
+    return ' '.join(ww)[:size]
+
+
+def content(rnd, kind, size):
+    """Returns bytes of about ``size`` bytes for a file of ``kind``."""
+    if kind == 'txt':
+        return text(rnd, size).encode('utf-8')
+    if kind == 'html':
+        body = text(rnd, max(size - 80, 1))
+        return ('<html><head><title>{}</title></head><body><p>{}</p>'
+            '</body></html>').format(rnd.choice(WORDS), body).encode('utf-8')
+    if kind == 'json':
+        n = max(size // 40, 1)
+        return json.dumps([{'id': i, 'text': text(rnd, 24)}
+            for i in range(n)]).encode('utf-8')
+    if kind == 'xml':
+        n = max(size // 40, 1)
+        return ('<?xml version="1.0" encoding="utf-8"?><doc>' + ''.join(
+            '<p>{}</p>'.format(text(rnd, 30)) for _ in range(n))
+            + '</doc>').encode('utf-8')
+    magic = MAGIC[kind]
+    return magic + rnd.getrandbits(8 * max(size - len(magic), 0)).to_bytes(
+        max(size - len(magic), 0), 'little')
+
+
+def dirs(root, depth, fanout):
+    """Returns list of leaf directories."""
+    level = [root]
+    for d in range(depth):
+        level = [os.path.join(p, 'd{:02d}'.format(i)) for p in level
+            for i in range(fanout)]
+    return level
+
+
+def generate(root, files=10000, depth=3, fanout=8, median_size=8192,
+        max_size=4 * 1024 * 1024, mix=DEFAULT_MIX, seed=1):
+    """
+    Generates the tree.
+
+    :return: Dict with parameters, number of files and total bytes.
+    """
+    rnd = random.Random(seed)
+    kinds, weights = zip(*parse_mix(mix))
+    leaves = dirs(root, depth, fanout)
+    for d in leaves:
+        os.makedirs(d, exist_ok=True)
+    total = 0
+    mu = math.log(median_size)
+    for i in range(files):
+        kind = rnd.choices(kinds, weights)[0]
+        size = min(int(rnd.lognormvariate(mu, 1.0)) + 1, max_size)
+        fn = os.path.join(rnd.choice(leaves), 'f{:07d}.{}'.format(i, kind))
+        b = content(rnd, kind, size)
+        with open(fn, 'wb') as fh:
+            fh.write(b)
+        t = MTIME_BASE + i
+        os.utime(fn, (t, t))
+        total += len(b)
+    return {
+        'files': files, 'depth': depth, 'fanout': fanout,
+        'median_size': median_size, 'max_size': max_size, 'mix': mix,
+        'seed': seed, 'bytes': total,
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=8)
+    parser.add_argument('--median-size', type=int, default=8192)
+    parser.add_argument('--max-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('dir', help='Root of the tree, created if missing')
+    add_arguments(parser)
+    args = parser.parse_args(argv[1:])
+    r = generate(args.dir, files=args.files, depth=args.depth,
+        fanout=args.fanout, median_size=args.median_size,
+        max_size=args.max_size, mix=args.mix, seed=args.seed)
+    print(json.dumps(r, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
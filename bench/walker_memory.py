@@ -0,0 +1,72 @@
+"""
+Compares memory held by collected walk items.
+
+Builds the same synthetic set of stat results once in the former layout, a
+dict per item holding the ``os.stat_result`` and two ``datetime``
+instances, and once in :class:`stoma.records.ItemRecords`, and reports the
+bytes allocated per item, excluding the path strings.
+
+Usage::
+
+    python bench/walker_memory.py [N]
+"""
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stoma.records import ItemRecords
+
+
+def synthetic_stats(n):
+    t = 1450000000.0
+    for i in range(n):
+        yield os.stat_result((
+            0o100644, 1000000 + i, 64769, 1, 1000, 1000, 4096 + i * 7,
+            t + i + 0.25, t + i + 0.5, t + i + 0.75
+        ))
+
+
+def measure(build, paths, n):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    obj = build(paths, synthetic_stats(n))
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del obj
+    return used
+
+
+def build_dicts(paths, stats):
+    items = {}
+    for fn, st in zip(paths, stats):
+        items[fn] = {'os_stat': st}
+        items[fn]['item_ctime'] = datetime.fromtimestamp(st.st_ctime)
+        items[fn]['item_mtime'] = datetime.fromtimestamp(st.st_mtime)
+        # Set by compare
+        items[fn]['action'] = 'n'
+    return items
+
+
+def build_records(paths, stats):
+    items = ItemRecords()
+    for fn, st in zip(paths, stats):
+        i = items.append(fn, st)
+        items.set_action(i, 'n')
+    return items
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 200000
+    paths = ['/data/dir{:04d}/file{:08d}.txt'.format(i % 1000, i)
+        for i in range(n)]
+    for name, build in (('dicts', build_dicts), ('records', build_records)):
+        used = measure(build, paths, n)
+        print('{:8s} {:12d} bytes  {:8.1f} bytes/item'.format(
+            name, used, used / n))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
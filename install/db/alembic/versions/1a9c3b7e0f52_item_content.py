@@ -0,0 +1,66 @@
+"""Move analysis results of item into table item_content
+
+Revision ID: 1a9c3b7e0f52
+Revises: e6a08d2f5c39
+Create Date: 2026-10-17 18:40:26.114907
+
+Texts are moved uncompressed. Downgrading fails for texts that were
+stored compressed meanwhile, since SQL cannot decompress them.
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1a9c3b7e0f52'
+down_revision = 'e6a08d2f5c39'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+TEXT_COLUMNS = ('meta_xmp', 'data_text', 'data_html_head', 'data_html_body')
+
+
+def upgrade(rc):
+    op.create_table('item_content',
+        sa.Column('path', sa.Unicode(1024), nullable=False),
+        sa.Column('compression', sa.Unicode(16), nullable=True),
+        sa.Column('meta_json', JSONB(none_as_null=True), nullable=True),
+        sa.Column('meta_xmp', sa.LargeBinary(), nullable=True),
+        sa.Column('data_text', sa.LargeBinary(), nullable=True),
+        sa.Column('data_html_head', sa.LargeBinary(), nullable=True),
+        sa.Column('data_html_body', sa.LargeBinary(), nullable=True),
+        sa.ForeignKeyConstraint(['path'], ['stoma.item.path'],
+            name='item_content_path_item_fk', onupdate='CASCADE',
+            ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('path', name='item_content_pk'),
+        schema='stoma'
+    )
+    op.execute("""
+        INSERT INTO stoma.item_content (path, meta_json, {cols})
+        SELECT path, meta_json, {converted}
+        FROM stoma.item
+        WHERE meta_json IS NOT NULL OR {any_text}
+    """.format(
+        cols=', '.join(TEXT_COLUMNS),
+        converted=', '.join("convert_to({}, 'UTF8')".format(c)
+            for c in TEXT_COLUMNS),
+        any_text=' OR '.join('{} IS NOT NULL'.format(c)
+            for c in TEXT_COLUMNS)
+    ))
+    for c in ('meta_json',) + TEXT_COLUMNS:
+        op.drop_column('item', c, schema='stoma')
+
+
+def downgrade(rc):
+    op.add_column('item', sa.Column('meta_json', JSONB(none_as_null=True),
+        nullable=True), schema='stoma')
+    for c in TEXT_COLUMNS:
+        op.add_column('item', sa.Column(c, sa.UnicodeText(), nullable=True),
+            schema='stoma')
+    op.execute("""
+        UPDATE stoma.item AS i SET meta_json = c.meta_json, {sets}
+        FROM stoma.item_content AS c
+        WHERE c.path = i.path
+    """.format(sets=', '.join(
+        "{0} = convert_from(c.{0}, 'UTF8')".format(c) for c in TEXT_COLUMNS)))
+    op.drop_table('item_content', schema='stoma')
@@ -0,0 +1,34 @@
+"""Add table directory for pruning unchanged directories
+
+Revision ID: 3f2a9c1d7b10
+Revises: None
+Create Date: 2026-10-17 09:12:40.113529
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b10'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(rc):
+    op.create_table(
+        'directory',
+        sa.Column('path', sa.Unicode(1024), nullable=False),
+        sa.Column('parent', sa.Unicode(1024), nullable=False),
+        sa.Column('dir_mtime', sa.DateTime(), nullable=False),
+        sa.Column('nlink', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('path', name=op.f('directory_pk')),
+        schema='stoma'
+    )
+    op.create_index('directory_parent_ix', 'directory', ['parent'],
+        schema='stoma')
+
+
+def downgrade(rc):
+    op.drop_index('directory_parent_ix', table_name='directory',
+        schema='stoma')
+    op.drop_table('directory', schema='stoma')
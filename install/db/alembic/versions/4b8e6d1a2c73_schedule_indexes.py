@@ -0,0 +1,31 @@
+"""Add partial indexes for scheduling orders of pending analysis
+
+Revision ID: 4b8e6d1a2c73
+Revises: 7f3d2c8b9e14
+Create Date: 2026-10-17 21:14:27.530918
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b8e6d1a2c73'
+down_revision = '7f3d2c8b9e14'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+INDEXES = (
+    ('item_need_analysis_size_ix', ['size', 'path']),
+    ('item_need_analysis_mtime_ix', ['item_mtime']),
+)
+
+
+def upgrade(rc):
+    for name, columns in INDEXES:
+        op.create_index(name, 'item', columns, schema='stoma',
+            postgresql_where=sa.text("state = 'need_analysis'"))
+
+
+def downgrade(rc):
+    for name, columns in reversed(INDEXES):
+        op.drop_index(name, table_name='item', schema='stoma')
@@ -0,0 +1,29 @@
+"""Add lease columns to item
+
+Revision ID: 5d7e19b3a6c4
+Revises: 8c41e07a5d23
+Create Date: 2026-10-17 14:21:37.210958
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d7e19b3a6c4'
+down_revision = '8c41e07a5d23'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(rc):
+    op.add_column('item', sa.Column('claimed_by', sa.Unicode(255),
+        nullable=True), schema='stoma')
+    op.add_column('item', sa.Column('claimed_at', sa.DateTime(),
+        nullable=True), schema='stoma')
+    op.add_column('item', sa.Column('lease_expires', sa.DateTime(),
+        nullable=True), schema='stoma')
+
+
+def downgrade(rc):
+    op.drop_column('item', 'lease_expires', schema='stoma')
+    op.drop_column('item', 'claimed_at', schema='stoma')
+    op.drop_column('item', 'claimed_by', schema='stoma')
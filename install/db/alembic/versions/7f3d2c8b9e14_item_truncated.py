@@ -0,0 +1,23 @@
+"""Add truncated flag to item
+
+Revision ID: 7f3d2c8b9e14
+Revises: 1a9c3b7e0f52
+Create Date: 2026-10-17 20:03:51.402733
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7f3d2c8b9e14'
+down_revision = '1a9c3b7e0f52'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(rc):
+    op.add_column('item', sa.Column('truncated', sa.Boolean(),
+        nullable=False, server_default=sa.text('false')), schema='stoma')
+
+
+def downgrade(rc):
+    op.drop_column('item', 'truncated', schema='stoma')
@@ -0,0 +1,25 @@
+"""Add content digest to item
+
+Revision ID: 8c41e07a5d23
+Revises: 3f2a9c1d7b10
+Create Date: 2026-10-17 10:02:11.584602
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c41e07a5d23'
+down_revision = '3f2a9c1d7b10'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(rc):
+    op.add_column('item', sa.Column('digest', sa.Unicode(160), nullable=True),
+        schema='stoma')
+    op.create_index('item_digest_ix', 'item', ['digest'], schema='stoma')
+
+
+def downgrade(rc):
+    op.drop_index('item_digest_ix', table_name='item', schema='stoma')
+    op.drop_column('item', 'digest', schema='stoma')
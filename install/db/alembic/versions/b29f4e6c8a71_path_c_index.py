@@ -0,0 +1,26 @@
+"""Add bytewise path indexes for prefix lookups
+
+Revision ID: b29f4e6c8a71
+Revises: 5d7e19b3a6c4
+Create Date: 2026-10-17 16:05:48.730214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b29f4e6c8a71'
+down_revision = '5d7e19b3a6c4'
+
+from alembic import op
+
+
+def upgrade(rc):
+    op.execute('CREATE INDEX item_path_c_ix ON stoma.item '
+        '(path COLLATE "C")')
+    op.execute('CREATE INDEX directory_path_c_ix ON stoma.directory '
+        '(path COLLATE "C")')
+
+
+def downgrade(rc):
+    op.drop_index('directory_path_c_ix', table_name='directory',
+        schema='stoma')
+    op.drop_index('item_path_c_ix', table_name='item', schema='stoma')
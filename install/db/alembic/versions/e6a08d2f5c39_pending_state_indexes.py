@@ -0,0 +1,36 @@
+"""Add partial indexes on pending item states
+
+Revision ID: e6a08d2f5c39
+Revises: b29f4e6c8a71
+Create Date: 2026-10-17 17:12:03.918446
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e6a08d2f5c39'
+down_revision = 'b29f4e6c8a71'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+PENDING = (
+    ('item_need_analysis_ix', 'need_analysis'),
+    ('item_need_indexing_ix', 'need_indexing'),
+    ('item_need_deletion_ix', 'need_deletion'),
+)
+
+
+def upgrade(rc):
+    for name, state in PENDING:
+        op.create_index(name, 'item', ['path'], schema='stoma',
+            postgresql_where=sa.text("state = '{}'".format(state)))
+    op.create_index('item_in_process_ix', 'item', ['lease_expires'],
+        schema='stoma',
+        postgresql_where=sa.text("state IN ('analysing', 'indexing')"))
+
+
+def downgrade(rc):
+    op.drop_index('item_in_process_ix', table_name='item', schema='stoma')
+    for name, state in reversed(PENDING):
+        op.drop_index(name, table_name='item', schema='stoma')
@@ -1,16 +1,75 @@
-from .const import ITEM_STATE_ANALYSING, ITEM_STATE_NEED_INDEXING, ITEM_STATE_NEED_ANALYSIS
-from .models import Item
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from .const import (ITEM_STATE_ANALYSING, ITEM_STATE_NEED_INDEXING,
+    ITEM_STATE_NEED_ANALYSIS, ANALYSED_ITEM_STATES, MIME_TYPE_UNKNOWN)
+from .digest import file_digest
+from .lease import lease, NO_LEASE, DEFAULT_LEASE_SECONDS
+from .metrics import ANALYSE_SECONDS, ANALYSED_ITEMS
+from .mime import guess_from_content
+from .models import DbSession, Item, META_KEYS
+from .scheduler import Scheduler
 
 
 class Analyser:
 
-    def __init__(self, lgg, sess, tika):
+    def __init__(self, lgg, sess, tika, digest=None, workers=1, claim_size=10,
+            checkpoint=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+            compression=None, extractors=None, scheduler=None):
+        """
+        Analyses items by sending them to Tika.
+
+        :param lgg: Logger
+        :param sess: DB session
+        :param tika: Tika client, e.g. :class:`stoma.tika.TikaRestClient`
+        :param digest: Name of digest algorithm, see
+            :func:`stoma.digest.file_digest`. If set, the results of an
+            already analysed item with the same content are reused instead of
+            calling Tika.
+        :param workers: Number of threads for :meth:`analyse_parallel`.
+        :param claim_size: Number of items a worker claims at once.
+        :param checkpoint: Optional instance of
+            :class:`stoma.checkpoint.Checkpoint` to commit :meth:`analyse`
+            in intervals.
+        :param lease_seconds: Duration of the lease on claimed items, see
+            :class:`stoma.lease.Reaper`.
+        :param compression: Compression of stored texts, see
+            :mod:`stoma.codec`.
+        :param extractors: Optional instance of
+            :class:`stoma.extractors.ExtractorRegistry` to extract simple
+            formats locally instead of with Tika.
+        :param scheduler: Optional instance of
+            :class:`stoma.scheduler.Scheduler` to choose order and lanes of
+            pending items; default takes them in order of path.
+        """
         self.lgg = lgg
         self.sess = sess
         self.tika = tika
+        self.digest = digest
+        self.workers = workers
+        self.claim_size = claim_size
+        self.checkpoint = checkpoint
+        self.lease_seconds = lease_seconds
+        self.compression = compression
+        self.extractors = extractors
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self._failed = set()
+        """Paths that failed in :meth:`analyse_parallel`"""
+        self._failed_lock = threading.Lock()
 
     def analyse(self, filter_crit=None):
-        tika = self.tika
+        """
+        Analyses all pending items within the current transaction.
+
+        With a checkpoint, the transaction is committed in intervals, so
+        that analysed items are kept if the run is interrupted.
+
+        :param filter_crit: Optional list of additional filter criteria.
+        """
         lgg = self.lgg
         sess = self.sess
         fil = [
@@ -19,8 +78,8 @@ class Analyser:
         if filter_crit:
             fil += filter_crit
 
-        # TODO Refactor handling of session and transaction to be suitable for parallel execution
-        paths = [r.path for r in self.sess.query(Item.path).filter(*fil).order_by(Item.path)]
+        paths = [r.path for r in self.sess.query(Item.path).filter(*fil).order_by(
+            *self.scheduler.order_by())]
         for p in paths:
             lgg.debug("Analysing '{}'".format(p))
 
@@ -28,9 +87,216 @@ class Analyser:
             it.state = ITEM_STATE_ANALYSING
             sess.flush()
 
-            pym_meta = tika.pym(p)
-            it.mime_type = pym_meta['mime_type']
-            it.language = pym_meta['language']
-            it.set_meta(pym_meta)
-            it.state = ITEM_STATE_NEED_INDEXING
+            self.analyse_item(it)
             sess.flush()
+            if self.checkpoint:
+                self.checkpoint.tick()
+
+    def analyse_parallel(self, filter_crit=None):
+        """
+        Analyses all pending items with a pool of ``workers`` threads.
+
+        Each worker has its own DB session and transactions. It claims a
+        batch of pending items with ``SELECT ... FOR UPDATE SKIP LOCKED``,
+        commits them as being analysed, and then analyses and commits them
+        one by one. Several processes, also on different hosts, may share a
+        database this way.
+
+        Claimed items are leased for ``lease_seconds``, and the lease of the
+        remaining items of a batch is renewed when half of it passed. Items
+        of a crashed worker are reaped after their lease expired.
+
+        Each lane of the scheduler gets its own workers, which only claim
+        items of their lane.
+
+        An item that fails, e.g. because it was deleted after the walk or
+        Tika answered with an error, is logged and released, i.e. put back
+        to need_analysis. It is not claimed again during this run.
+
+        Do not call this within a transaction.
+
+        :param filter_crit: Optional list of additional filter criteria.
+        """
+        lanes = []
+        for name, workers, crit in self.scheduler.lane_filters():
+            fil = list(filter_crit) if filter_crit else []
+            if crit is not None:
+                fil.append(crit)
+            workers = workers if workers is not None else self.workers
+            self.lgg.info("Analysing lane '{}' with {} workers".format(
+                name, workers))
+            lanes += [fil] * workers
+        self._failed = set()
+        with ThreadPoolExecutor(max_workers=len(lanes)) as executor:
+            ff = [executor.submit(self._work, fil) for fil in lanes]
+            n = sum(f.result() for f in ff)
+        self.lgg.info('Analysed {} items'.format(n))
+        if self._failed:
+            self.lgg.warning('Failed to analyse {} items'.format(
+                len(self._failed)))
+
+    def _work(self, filter_crit):
+        sess = DbSession()
+        ana = Analyser(lgg=self.lgg, sess=sess, tika=self.tika,
+            digest=self.digest, claim_size=self.claim_size,
+            lease_seconds=self.lease_seconds, compression=self.compression,
+            extractors=self.extractors, scheduler=self.scheduler)
+        n = 0
+        try:
+            while True:
+                fil = list(filter_crit) if filter_crit else []
+                with self._failed_lock:
+                    if self._failed:
+                        fil.append(Item.path.notin_(list(self._failed)))
+                with transaction.manager:
+                    paths = ana.claim(fil)
+                if not paths:
+                    break
+                claimed = time.monotonic()
+                for i, p in enumerate(paths):
+                    if time.monotonic() - claimed > self.lease_seconds / 2:
+                        with transaction.manager:
+                            ana.renew(paths[i:])
+                        claimed = time.monotonic()
+                    self.lgg.debug("Analysing '{}'".format(p))
+                    try:
+                        with transaction.manager:
+                            it = sess.query(Item).get(p)
+                            if it is not None:
+                                ana.analyse_item(it)
+                    except Exception as exc:
+                        self.lgg.error("Failed to analyse '{}': {}".format(
+                            p, exc))
+                        with self._failed_lock:
+                            self._failed.add(p)
+                        with transaction.manager:
+                            ana.release([p])
+                        continue
+                    n += 1
+        finally:
+            sess.close()
+        return n
+
+    def claim(self, filter_crit=None):
+        """
+        Claims a batch of pending items for analysis.
+
+        Rows locked by other transactions are skipped.
+
+        :param filter_crit: Optional list of additional filter criteria.
+        :return: List of claimed paths.
+        """
+        sess = self.sess
+        fil = [
+            Item.state == ITEM_STATE_NEED_ANALYSIS
+        ]
+        if filter_crit:
+            fil += filter_crit
+        # Workers claim within their lane, see analyse_parallel(), so
+        # ordering by lane would only defeat the indexes
+        rs = sess.query(Item.path).filter(*fil).order_by(
+            *self.scheduler.order_by(lanes=False)).limit(
+            self.claim_size).with_for_update(skip_locked=True)
+        paths = [r.path for r in rs]
+        if paths:
+            sess.query(Item).filter(Item.path.in_(paths)).update(
+                dict(lease(self.lease_seconds), state=ITEM_STATE_ANALYSING),
+                synchronize_session=False)
+            mark_changed(sess)
+        return paths
+
+    def renew(self, paths):
+        """
+        Renews the lease on claimed items.
+
+        :param paths: List of paths.
+        """
+        sess = self.sess
+        sess.query(Item).filter(
+            Item.path.in_(paths),
+            Item.state == ITEM_STATE_ANALYSING
+        ).update(lease(self.lease_seconds), synchronize_session=False)
+        mark_changed(sess)
+
+    def release(self, paths):
+        """
+        Releases claimed items, putting them back to need_analysis.
+
+        :param paths: List of paths.
+        """
+        sess = self.sess
+        sess.query(Item).filter(
+            Item.path.in_(paths),
+            Item.state == ITEM_STATE_ANALYSING
+        ).update(dict(NO_LEASE, state=ITEM_STATE_NEED_ANALYSIS),
+            synchronize_session=False)
+        mark_changed(sess)
+
+    def analyse_item(self, it):
+        """
+        Analyses a single item and sets its state to need_indexing.
+
+        :param it: Instance of :class:`stoma.models.Item`.
+        """
+        t0 = time.perf_counter()
+        backend = 'reuse'
+        pym_meta = self.find_analysed(it) if self.digest else None
+        if pym_meta is None:
+            ext = self.extractors
+            if ext is not None and it.mime_type == MIME_TYPE_UNKNOWN:
+                # Detection was deferred by the walker
+                it.mime_type = guess_from_content(it.path)
+            if ext is not None and ext.find(it.mime_type) is not None:
+                backend = 'local'
+                pym_meta = ext.pym(it.path, mime_type=it.mime_type)
+            else:
+                backend = 'tika'
+                pym_meta = self.tika.pym(it.path)
+        self.set_result(it, pym_meta)
+        ANALYSE_SECONDS.observe(time.perf_counter() - t0, backend=backend)
+        ANALYSED_ITEMS.inc(backend=backend)
+
+    def set_result(self, it, pym_meta):
+        """
+        Stores analysis results on an item and sets its state to need_indexing.
+
+        :param it: Instance of :class:`stoma.models.Item`.
+        :param pym_meta: Dict as returned by Tika's ``pym()``.
+        """
+        it.mime_type = pym_meta['mime_type']
+        it.language = pym_meta['language']
+        it.set_meta(pym_meta, self.compression)
+        it.truncated = pym_meta.get('truncated', False)
+        it.state = ITEM_STATE_NEED_INDEXING
+        for k, v in NO_LEASE.items():
+            setattr(it, k, v)
+
+    def find_analysed(self, it):
+        """
+        Returns analysis results of another item with the same content.
+
+        Computes the digest of ``it``, if it is not yet known.
+
+        :param it: Instance of :class:`stoma.models.Item`.
+        :return: Dict like the one returned by Tika's ``pym()``, or None.
+        """
+        if not it.digest:
+            try:
+                it.digest = file_digest(it.path, self.digest)
+            except OSError as exc:
+                self.lgg.warning("Cannot compute digest of '{}': {}".format(
+                    it.path, exc))
+                return None
+        other = self.sess.query(Item).filter(
+            Item.digest == it.digest,
+            Item.path != it.path,
+            Item.state.in_(ANALYSED_ITEM_STATES)
+        ).first()
+        if other is None:
+            return None
+        self.lgg.debug("Reusing analysis of '{}'".format(other.path))
+        m = {k: getattr(other, k) for k in META_KEYS}
+        m['mime_type'] = other.mime_type
+        m['language'] = other.language
+        m['truncated'] = other.truncated
+        return m
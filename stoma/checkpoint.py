@@ -0,0 +1,80 @@
+import time
+
+import transaction
+
+
+DEFAULT_COMMIT_ITEMS = 100
+DEFAULT_COMMIT_SECONDS = 30.0
+
+
+class Checkpoint:
+
+    def __init__(self, lgg, items=DEFAULT_COMMIT_ITEMS,
+            seconds=DEFAULT_COMMIT_SECONDS):
+        """
+        Commits the current transaction in regular intervals.
+
+        Long runs call :meth:`tick` after each processed item. Once ``items``
+        items were processed, or ``seconds`` seconds passed since the last
+        commit, the current transaction is committed and a new one begun.
+        Work done so far thus survives a crash, and row locks are held only
+        until the next commit.
+
+        Callers must keep no ORM instances across a tick, because they
+        expire on commit.
+
+        :param lgg: Logger
+        :param items: Commit after this many items; 0 to not count items.
+        :param seconds: Commit after this many seconds; 0 to not look at the
+            clock.
+        """
+        self.lgg = lgg
+        self.items = items
+        self.seconds = seconds
+        self.n = 0
+        self.n_commits = 0
+        self.started = time.monotonic()
+
+    @classmethod
+    def from_rc(cls, lgg, rc):
+        """
+        Creates a checkpoint as configured in rc.
+
+        Reads keys ``commit.items`` and ``commit.seconds``.
+
+        :param lgg: Logger
+        :param rc: Instance of :class:`pym.rc.Rc`.
+        """
+        return cls(
+            lgg=lgg,
+            items=int(rc.g('commit.items', DEFAULT_COMMIT_ITEMS)),
+            seconds=float(rc.g('commit.seconds', DEFAULT_COMMIT_SECONDS))
+        )
+
+    def is_due(self):
+        if self.items and self.n >= self.items:
+            return True
+        return bool(self.seconds
+            and time.monotonic() - self.started >= self.seconds)
+
+    def tick(self, n=1):
+        """
+        Counts ``n`` processed items, and commits if due.
+
+        :return: True if committed, else False.
+        """
+        self.n += n
+        if not self.is_due():
+            return False
+        self.commit()
+        return True
+
+    def commit(self):
+        """Commits the current transaction and begins a new one."""
+        transaction.commit()
+        transaction.begin()
+        self.n_commits += 1
+        self.lgg.debug('Checkpoint {}: committed {} items'.format(
+            self.n_commits, self.n))
+        self.n = 0
+        self.started = time.monotonic()
@@ -0,0 +1,70 @@
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSIONS = (COMPRESSION_ZSTD,)
+ZSTD_LEVEL = 3
+
+_local = threading.local()
+
+
+def check_compression(compression):
+    """
+    Raises ValueError if ``compression`` is unknown or not available.
+
+    :param compression: Name of compression, or None.
+    """
+    if compression is None:
+        return
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression '{}'".format(compression))
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ValueError("Compression '{}' needs package zstandard".format(
+            compression))
+
+
+def _zstd():
+    # (De)compressors must not be shared between threads
+    try:
+        return _local.zstd
+    except AttributeError:
+        _local.zstd = (zstandard.ZstdCompressor(level=ZSTD_LEVEL),
+            zstandard.ZstdDecompressor())
+        return _local.zstd
+
+
+def encode_text(s, compression=None):
+    """
+    Encodes text for a bytea column.
+
+    :param s: String or None.
+    :param compression: Name of compression, or None to store UTF-8 as is.
+    :return: Bytes, or None if ``s`` is None.
+    """
+    if s is None:
+        return None
+    b = s.encode('utf-8')
+    if compression == COMPRESSION_ZSTD:
+        return _zstd()[0].compress(b)
+    return b
+
+
+def decode_text(b, compression=None):
+    """
+    Decodes text from a bytea column.
+
+    :param b: Bytes, memoryview as returned by psycopg2, or None.
+    :param compression: Name of compression the text was encoded with.
+    :return: String, or None if ``b`` is None.
+    """
+    if b is None:
+        return None
+    b = bytes(b)
+    if compression == COMPRESSION_ZSTD:
+        b = _zstd()[1].decompress(b)
+    return b.decode('utf-8')
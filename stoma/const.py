@@ -29,6 +29,12 @@ ITEM_STATE_INDEXED = 'indexed'
 """Item is indexed"""
 
 IN_PROCESS_ITEM_STATES = (ITEM_STATE_ANALYSING, ITEM_STATE_NEED_INDEXING, ITEM_STATE_INDEXING)
+PENDING_ITEM_STATES = (ITEM_STATE_NEED_ANALYSIS, ITEM_STATE_NEED_DELETION) \
+    + IN_PROCESS_ITEM_STATES
+"""States of items with work left to do; a new run must keep them"""
+ANALYSED_ITEM_STATES = (ITEM_STATE_NEED_INDEXING, ITEM_STATE_INDEXING,
+    ITEM_STATE_INDEXED, ITEM_STATE_UNCHANGED)
+"""States of items whose analysis results are present"""
 
 STAT_ATTR = 'st_mode st_ino st_dev st_nlink st_uid st_gid st_size st_atime st_mtime st_ctime'.split(' ')
 
@@ -0,0 +1,51 @@
+import functools
+import hashlib
+import mmap
+import os
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+DEFAULT_ALGORITHM = 'blake2b'
+
+CHUNK_SIZE = 1024 * 1024
+"""Files are read in chunks of this size..."""
+MMAP_THRESHOLD = 16 * 1024 * 1024
+"""...unless they are at least this large, then they are memory-mapped."""
+
+
+def _new_hash(algorithm):
+    if algorithm.startswith('xxh'):
+        if xxhash is None:
+            raise ValueError("Digest '{}' needs package xxhash".format(
+                algorithm))
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def file_digest(fn, algorithm=DEFAULT_ALGORITHM):
+    """
+    Computes digest of a file's content.
+
+    The returned string is prefixed with the name of the algorithm, so that
+    digests computed with different algorithms never compare equal.
+
+    :param fn: Filename.
+    :param algorithm: Name of a hash algorithm known to :mod:`hashlib`, e.g.
+        'blake2b' or 'sha256', or of one from package ``xxhash``, e.g.
+        'xxh64'.
+    :return: String 'ALGORITHM:HEXDIGEST'.
+    """
+    h = _new_hash(algorithm)
+    with open(fn, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+        else:
+            for chunk in iter(functools.partial(fh.read, CHUNK_SIZE), b''):
+                h.update(chunk)
+    return '{}:{}'.format(algorithm, h.hexdigest())
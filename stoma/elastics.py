@@ -1,19 +1,86 @@
-import requests
 import socket
 import logging
 from pym.lib import json_serializer, json_deserializer
 
+from .httpclient import create_session, DEFAULT_CONNECT_TIMEOUT
+from .metrics import ELA_BULK_SECONDS, ELA_BULK_ACTIONS
+
+
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_BULK_DOCS = 500
+"""Maximum number of actions per bulk request"""
+DEFAULT_BULK_BYTES = 10 * 1024 * 1024
+"""Maximum size of a bulk request body in bytes"""
+
 
 mlgg = logging.getLogger(__name__)
 
 
+def bulk_chunks(actions, max_docs=DEFAULT_BULK_DOCS,
+        max_bytes=DEFAULT_BULK_BYTES):
+    """
+    Serializes bulk actions as NDJSON, grouped to fit into requests.
+
+    :param actions: Iterable of tuples (action, meta, source), see
+        :meth:`ElasticSearchRestClient.bulk`.
+    :param max_docs: Maximum number of actions per group.
+    :param max_bytes: Maximum size of a group in bytes, unless a single action
+        is larger.
+    :return: Generator of lists of byte strings. Each list is the body of one
+        request.
+    """
+    chunks = []
+    size = 0
+    for action, meta, source in actions:
+        s = json_serializer({action: meta}) + '\n'
+        if source is not None:
+            s += json_serializer(source) + '\n'
+        b = s.encode('utf-8')
+        if chunks and (len(chunks) >= max_docs or size + len(b) > max_bytes):
+            yield chunks
+            chunks = []
+            size = 0
+        chunks.append(b)
+        size += len(b)
+    if chunks:
+        yield chunks
+
+
+def bulk_results(s):
+    """
+    Returns list of results from the response of a bulk request.
+
+    :param s: Response body.
+    :return: List of dicts, one per action.
+    """
+    # Each item is a dict with the action as only key
+    return [list(it.values())[0] for it in json_deserializer(s)['items']]
+
+
 class ElasticSearchRestClient:
 
-    def __init__(self, lgg, host='localhost', port=9200):
+    def __init__(self, lgg, host='localhost', port=9200, session=None,
+            timeout=None):
+        """
+        Communicate with ElasticSearch via REST.
+
+        :param lgg: Logger
+        :param host: Host of ElasticSearch.
+        :param port: Port of ElasticSearch.
+        :param session: Instance of :class:`requests.Session`, which may be
+            shared by several clients and threads. If None, a pooled session
+            with default settings is created, see
+            :func:`stoma.httpclient.create_session`.
+        :param timeout: Timeout of requests in seconds, either a float or a
+            tuple (connect timeout, read timeout).
+        """
         self.lgg = lgg
         self.host = host
         self.port = port
         self.url = 'http://{}:{}'.format(host, port)
+        self.session = session if session else create_session()
+        self.timeout = timeout if timeout else (DEFAULT_CONNECT_TIMEOUT,
+            DEFAULT_READ_TIMEOUT)
 
     def is_running(self):
         ip = socket.gethostbyname(self.host)
@@ -31,7 +98,7 @@ class ElasticSearchRestClient:
 
     def hello(self):
         url = self.url
-        r = requests.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         r.raise_for_status()
         return json_deserializer(r.text)
 
@@ -52,7 +119,8 @@ class ElasticSearchRestClient:
                 "match_all": {}
             }
         }
-        r = requests.get(url, data=json_serializer(q))
+        r = self.session.get(url, data=json_serializer(q),
+            timeout=self.timeout)
         r.raise_for_status()
         return json_deserializer(r.text)
 
@@ -66,16 +134,46 @@ class ElasticSearchRestClient:
             if create:
                 url += '/_create'
             s = json_serializer(data).encode('utf-8')
-            r = requests.put(url, data=s)
+            r = self.session.put(url, data=s, timeout=self.timeout)
         else:
             url = '{base}/{index}/{doc_type}/'.format(
                 base=self.url, index=index, doc_type=doc_type
             )
             s = json_serializer(data).encode('utf-8')
-            r = requests.post(url, data=s)
+            r = self.session.post(url, data=s, timeout=self.timeout)
         r.raise_for_status()
         return json_deserializer(r.text)
 
+    def bulk(self, actions, max_docs=DEFAULT_BULK_DOCS,
+            max_bytes=DEFAULT_BULK_BYTES):
+        """
+        Performs many actions with few requests to ``/_bulk``.
+
+        Actions are serialized as NDJSON and sent in requests of at most
+        ``max_docs`` actions and, unless a single action is larger,
+        ``max_bytes`` bytes.
+
+        :param actions: Iterable of tuples (action, meta, source). Action is
+            'index', 'create', 'update' or 'delete'; meta is a dict with
+            keys like '_index', '_type' and '_id'; source is the document,
+            or None for 'delete'.
+        :return: List of result dicts, one per action and in the same order.
+            Each has keys like '_id', '_version', 'status', and 'error' if
+            the action failed.
+        """
+        results = []
+        for chunks in bulk_chunks(actions, max_docs, max_bytes):
+            url = self.url + '/_bulk'
+            with ELA_BULK_SECONDS.time():
+                r = self.session.post(url, data=b''.join(chunks),
+                    headers={'content-type': 'application/x-ndjson'},
+                    timeout=self.timeout)
+                r.raise_for_status()
+                rr = bulk_results(r.text)
+            ELA_BULK_ACTIONS.inc(len(rr))
+            results += rr
+        return results
+
     def load(self, index, doc_type, id_, source=None):
         """
         Loads specified document.
@@ -102,7 +200,7 @@ class ElasticSearchRestClient:
                 base=self.url, index=index, doc_type=doc_type, id=id_
             )
             params = dict(_source=source.join(','))
-        r = requests.get(url, params=params)
+        r = self.session.get(url, params=params, timeout=self.timeout)
         r.raise_for_status()
         return json_deserializer(r.text)
 
@@ -110,7 +208,7 @@ class ElasticSearchRestClient:
         url = '{base}/{index}/{doc_type}/{id}'.format(
             base=self.url, index=index, doc_type=doc_type, id=id_
         )
-        r = requests.head(url)
+        r = self.session.head(url, timeout=self.timeout)
         if r.status_code == 200:
             return True
         elif r.status_code == 404:
@@ -122,7 +220,7 @@ class ElasticSearchRestClient:
         url = '{base}/{index}/{doc_type}/{id}'.format(
             base=self.url, index=index, doc_type=doc_type, id=id_
         )
-        r = requests.delete(url)
+        r = self.session.delete(url, timeout=self.timeout)
         if r.status_code == 200:
             return True
         elif r.status_code == 404:
@@ -135,9 +233,11 @@ class ElasticSearchRestClient:
             base=self.url, index=index, doc_type=doc_type
         )
         if isinstance(q, str):
-            r = requests.get(url, params=dict(q=q))
+            r = self.session.get(url, params=dict(q=q),
+                timeout=self.timeout)
         else:
-            r = requests.get(url, data=json_serializer(q))
+            r = self.session.get(url, data=json_serializer(q),
+                timeout=self.timeout)
         r.raise_for_status()
         return json_deserializer(r.text)
 
@@ -146,7 +246,7 @@ class ElasticSearchRestClient:
             base=self.url, index=index
         )
         s = json_serializer(rc) if rc else None
-        r = requests.put(url, data=s)
+        r = self.session.put(url, data=s, timeout=self.timeout)
         r.raise_for_status()
         return json_deserializer(r.text)
 
@@ -154,6 +254,6 @@ class ElasticSearchRestClient:
         url = '{base}/{index}/'.format(
             base=self.url, index=index
         )
-        r = requests.delete(url)
+        r = self.session.delete(url, timeout=self.timeout)
         r.raise_for_status()
         return json_deserializer(r.text)
@@ -0,0 +1,288 @@
+import json
+import logging
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree, html
+
+try:
+    import chardet
+except ImportError:
+    chardet = None
+
+from .tika import LANGUAGE_SAMPLE_SIZE, DEFAULT_MAX_TEXT_SIZE
+
+
+mlgg = logging.getLogger(__name__)
+
+FALLBACK_ENCODING = 'cp1252'
+"""Encoding of text that is not UTF-8 and that chardet cannot identify"""
+CHARDET_SAMPLE_SIZE = 64 * 1024
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+
+# ===[ EXTRACTORS ]=======
+#
+# Extractors run in worker processes, so they are plain module functions.
+# Each takes filename, mime type and maximum text size, and returns a bundle
+# like TikaPymMixin.pym() does, except for key 'language'.
+
+def split_mime_type(mime_type):
+    """
+    Splits a mime type like 'text/plain; charset=utf-8'.
+
+    :return: Tuple(mime type, charset); charset is None if not given.
+    """
+    mt, _, params = mime_type.partition(';')
+    charset = None
+    for p in params.split(';'):
+        k, _, v = p.partition('=')
+        if k.strip().lower() == 'charset' and v.strip():
+            charset = v.strip().strip('"')
+    return mt.strip().lower(), charset
+
+
+def read_head(fn, max_text_size):
+    """
+    Reads the start of a file, enough for ``max_text_size`` characters.
+
+    :return: Tuple(bytes, truncated)
+    """
+    limit = max_text_size * 4 if max_text_size else -1
+    with open(fn, 'rb') as fh:
+        b = fh.read(limit)
+        truncated = bool(max_text_size) and bool(fh.read(1))
+    return b, truncated
+
+
+def decode(b, charset=None):
+    """
+    Decodes bytes of unknown encoding.
+
+    Tries ``charset``, then UTF-8, then what chardet detects, if it is
+    installed, and finally ``FALLBACK_ENCODING``.
+
+    :return: Tuple(text, encoding)
+    """
+    candidates = [charset, 'utf-8']
+    if chardet is not None:
+        candidates.append(chardet.detect(b[:CHARDET_SAMPLE_SIZE])['encoding'])
+    for enc in candidates:
+        if not enc or enc.lower() in ('binary', 'unknown-8bit'):
+            continue
+        try:
+            return b.decode(enc), enc
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return b.decode(FALLBACK_ENCODING, errors='replace'), FALLBACK_ENCODING
+
+
+def _bundle(mime_type, encoding, text, max_text_size, truncated, parser,
+        head=None, body=None):
+    if max_text_size and text and len(text) > max_text_size:
+        text = text[:max_text_size]
+        truncated = True
+    meta = {'Content-Type': mime_type, 'X-Parsed-By': parser}
+    if encoding:
+        meta['Content-Encoding'] = encoding
+    return {
+        'mime_type': mime_type,
+        'meta_json': meta,
+        'meta_xmp': None,
+        'data_html_head': head,
+        'data_html_body': body,
+        'data_text': text if text else None,
+        'language': None,
+        'truncated': truncated,
+    }
+
+
+def extract_text(fn, mime_type, max_text_size=DEFAULT_MAX_TEXT_SIZE):
+    """Extracts plain text, e.g. source code, CSV, Markdown."""
+    charset = split_mime_type(mime_type)[1]
+    b, truncated = read_head(fn, max_text_size)
+    s, enc = decode(b, charset)
+    return _bundle(mime_type, enc, s.strip(), max_text_size, truncated,
+        'stoma.extractors.extract_text')
+
+
+def extract_json(fn, mime_type, max_text_size=DEFAULT_MAX_TEXT_SIZE):
+    """
+    Extracts JSON.
+
+    The JSON text is passed through as is. Complete documents that do not
+    parse are flagged in ``meta_json``.
+    """
+    charset = split_mime_type(mime_type)[1]
+    b, truncated = read_head(fn, max_text_size)
+    s, enc = decode(b, charset)
+    m = _bundle(mime_type, enc, s.strip(), max_text_size, truncated,
+        'stoma.extractors.extract_json')
+    if not truncated:
+        try:
+            json.loads(s)
+        except ValueError:
+            m['meta_json']['X-Stoma:invalid'] = True
+    return m
+
+
+def extract_html(fn, mime_type, max_text_size=DEFAULT_MAX_TEXT_SIZE):
+    """Extracts HTML, split into head and body like Tika's HTML output."""
+    charset = split_mime_type(mime_type)[1]
+    b, truncated = read_head(fn, max_text_size)
+    s, enc = decode(b, charset)
+    try:
+        if not s.strip():
+            raise etree.ParserError('Document is empty')
+        try:
+            root = html.document_fromstring(s)
+        except ValueError:
+            # Strings with an XML encoding declaration are refused; the
+            # text is decoded already, so the declaration can go
+            root = html.document_fromstring(XML_DECLARATION.sub('', s,
+                count=1))
+    except etree.ParserError:
+        # Nothing but whitespace or comments
+        return _bundle(mime_type, enc, None, max_text_size, truncated,
+            'stoma.extractors.extract_html')
+    head = root.find('head')
+    body = root.find('body')
+    if body is None:
+        body = root
+    return _bundle(mime_type, enc, body.text_content().strip(),
+        max_text_size, truncated, 'stoma.extractors.extract_html',
+        html.tostring(head, encoding='unicode') if head is not None else None,
+        html.tostring(body, encoding='unicode'))
+
+
+def extract_xml(fn, mime_type, max_text_size=DEFAULT_MAX_TEXT_SIZE):
+    """Extracts the text content of XML."""
+    charset = split_mime_type(mime_type)[1]
+    b, truncated = read_head(fn, max_text_size)
+    parser = etree.XMLParser(recover=True, resolve_entities=False,
+        no_network=True)
+    root = etree.fromstring(b, parser) if b.strip() else None
+    if root is None:
+        s = None
+    else:
+        s = '\n'.join(t.strip() for t in root.itertext() if t.strip())
+    return _bundle(mime_type, charset, s, max_text_size, truncated,
+        'stoma.extractors.extract_xml')
+
+
+EXTRACTORS = {
+    'application/json': extract_json,
+    'text/html': extract_html,
+    'application/xhtml+xml': extract_html,
+    'text/xml': extract_xml,
+    'application/xml': extract_xml,
+    'application/javascript': extract_text,
+    'application/x-sh': extract_text,
+    # Markup that Tika parses, as libmagic may report it
+    'text/rtf': None,
+    'text/richtext': None,
+    'text/enriched': None,
+}
+"""
+Extractors by mime type. Other types below ``text/`` are extracted as plain
+text; types mapped to None are left to Tika.
+"""
+TEXT_PREFIX = 'text/'
+
+
+# ===[ REGISTRY ]=======
+
+class ExtractorRegistry:
+
+    def __init__(self, tika, workers=None, max_text_size=None,
+            extractors=None):
+        """
+        Extracts simple formats locally and the rest with Tika.
+
+        :meth:`pym` has the interface of
+        :meth:`stoma.tika.TikaPymMixin.pym`, plus the mime type of the file
+        to choose the backend by. Local extractors run in a pool of
+        ``workers`` processes, so that parsing does not hold the GIL of
+        the analyser threads. The language of locally extracted text is
+        still identified by Tika, from a small sample.
+
+        :param tika: Tika client for the other formats.
+        :param workers: Number of processes; default is number of CPUs.
+        :param max_text_size: Maximum number of characters of text; default
+            is that of ``tika``.
+        :param extractors: Dict mapping mime types to extractor functions;
+            default is ``EXTRACTORS``.
+        """
+        self.tika = tika
+        self.workers = workers
+        self.max_text_size = (max_text_size if max_text_size is not None
+            else tika.max_text_size)
+        self.extractors = dict(EXTRACTORS if extractors is None
+            else extractors)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """Process pool of local extractors, started on first use."""
+        # Analyser threads may ask at the same time, start only one pool
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers)
+            return self._executor
+
+    def close(self):
+        """Stops the worker processes, if started."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def register(self, mime_type, func):
+        """
+        Registers an extractor.
+
+        :param mime_type: Mime type, without parameters.
+        :param func: Module-level function, see e.g. :func:`extract_text`,
+            or None to leave the type to Tika.
+        """
+        self.extractors[mime_type] = func
+
+    def find(self, mime_type):
+        """
+        Returns the local extractor of a mime type.
+
+        :return: Function, or None if the type is left to Tika.
+        """
+        if not mime_type:
+            return None
+        mt = split_mime_type(mime_type)[0]
+        if mt in self.extractors:
+            return self.extractors[mt]
+        if mt.startswith(TEXT_PREFIX):
+            return extract_text
+        return None
+
+    def pym(self, fn, hh=None, mime_type=None):
+        """
+        Fetches a bundle of meta information about given file.
+
+        :param fn: Filename.
+        :param hh: Optional array with header fields for Tika server
+        :param mime_type: Mime type of the file as guessed by the walker.
+        :return: Dict with meta info.
+        """
+        func = self.find(mime_type)
+        if func is None:
+            return self.tika.pym(fn, hh=hh)
+        mlgg.debug("Extracting '{}' locally with {}".format(fn,
+            func.__name__))
+        m = self.executor.submit(func, fn, mime_type,
+            self.max_text_size).result()
+        s = m['data_text']
+        if s:
+            s = self.tika.language_text(s[:LANGUAGE_SAMPLE_SIZE])
+            m['language'] = s if s else None
+        return m
@@ -0,0 +1,68 @@
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 300.0
+RETRY_STATUS = (502, 503, 504)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+        backoff_factor=DEFAULT_BACKOFF_FACTOR):
+    """
+    Creates a HTTP session with a pool of keep-alive connections.
+
+    Failed connects, and responses with a status in ``RETRY_STATUS``, are
+    retried with exponential backoff. Like urllib3's default, only
+    idempotent methods are retried, i.e. not POST.
+
+    :param pool_size: Maximum number of connections kept open per host.
+        Should be at least the number of threads using the session.
+    :param retries: Maximum number of retries.
+    :param backoff_factor: Sleep ``backoff_factor * 2 ** (n - 1)`` seconds
+        before the n-th retry.
+    :return: Instance of :class:`requests.Session`.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+        max_retries=retry)
+    sess = requests.Session()
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    return sess
+
+
+def session_from_rc(rc, prefix, read_timeout=DEFAULT_READ_TIMEOUT):
+    """
+    Creates a HTTP session as configured in rc.
+
+    Reads keys ``pool_size``, ``retries``, ``backoff_factor``,
+    ``connect_timeout`` and ``read_timeout`` below ``prefix``, e.g.
+    ``tika.pool_size``.
+
+    :param rc: Instance of :class:`pym.rc.Rc`.
+    :param prefix: Prefix of keys, including the trailing dot.
+    :param read_timeout: Default read timeout in seconds.
+    :return: Tuple(session, timeout); ``timeout`` is a tuple (connect
+        timeout, read timeout) to pass with each request.
+    """
+    sess = create_session(
+        pool_size=int(rc.g(prefix + 'pool_size', DEFAULT_POOL_SIZE)),
+        retries=int(rc.g(prefix + 'retries', DEFAULT_RETRIES)),
+        backoff_factor=float(rc.g(prefix + 'backoff_factor',
+            DEFAULT_BACKOFF_FACTOR))
+    )
+    timeout = (
+        float(rc.g(prefix + 'connect_timeout', DEFAULT_CONNECT_TIMEOUT)),
+        float(rc.g(prefix + 'read_timeout', read_timeout))
+    )
+    return sess, timeout
@@ -1,21 +1,86 @@
-import functools
 import os
 
+import sqlalchemy as sa
+from zope.sqlalchemy import mark_changed
+
 from .const import (ITEM_STATE_NEED_INDEXING, ITEM_STATE_NEED_DELETION,
-    ITEM_STATE_INDEXING, ITEM_STATE_INDEXED, ITEM_STATE_DELETED,
+    ITEM_STATE_INDEXED, ITEM_STATE_DELETED,
     DEFAULT_DOC_TYPE, DEFAULT_INDEX)
-from .models import Item
+from .elastics import DEFAULT_BULK_DOCS, DEFAULT_BULK_BYTES
+from .codec import decode_text
+from .metrics import INDEXED_ITEMS
+from .models import Item, ItemContent
+
+
+DOCUMENT_COLUMNS = [Item.path, Item.mime_type, Item.encoding, Item.language,
+    Item.size, Item.item_ctime, Item.item_mtime, Item.truncated,
+    ItemContent.compression,
+    ItemContent.meta_json, ItemContent.data_text]
+"""
+Columns needed to build the document of an item; query them with an outer
+join of :class:`stoma.models.ItemContent`.
+"""
+
+
+def document(it):
+    """
+    Returns the document to index for an item.
+
+    :param it: Item, or a row with at least the columns of ``DOCUMENT_COLUMNS``.
+    :return: Dict
+    """
+    text = it.data_text
+    if isinstance(text, (bytes, memoryview)):
+        # Encoded column of a row
+        text = decode_text(text, it.compression)
+    data = {
+        'path': it.path,
+        'tags': it.path.split(os.path.sep),
+        'mime_type': it.mime_type,
+        'encoding': it.encoding,
+        'language': it.language,
+        'size': it.size,
+        'ctime': it.item_ctime,
+        'mtime': it.item_mtime,
+        'meta': it.meta_json,
+        'text': text,
+        'truncated': it.truncated
+    }
+    if it.meta_json and 'language' in it.meta_json:
+        data['language'] = it.meta_json['language']
+    return data
 
 
 class Indexer:
 
     def __init__(self, lgg, sess, ela, index=DEFAULT_INDEX,
-            doc_type=DEFAULT_DOC_TYPE):
+            doc_type=DEFAULT_DOC_TYPE, bulk_docs=DEFAULT_BULK_DOCS,
+            bulk_bytes=DEFAULT_BULK_BYTES, checkpoint=None):
+        """
+        Feeds analysed items into ElasticSearch.
+
+        Items are processed in batches of ``bulk_docs``. Each batch is sent
+        with bulk requests, and the results are written back with a single
+        statement.
+
+        :param lgg: Logger
+        :param sess: DB session
+        :param ela: Instance of :class:`stoma.elastics.ElasticSearchRestClient`
+        :param index: Name of index
+        :param doc_type: Document type
+        :param bulk_docs: Number of items per batch.
+        :param bulk_bytes: Maximum size of a bulk request in bytes.
+        :param checkpoint: Optional instance of
+            :class:`stoma.checkpoint.Checkpoint` to commit after batches.
+        """
         self.lgg = lgg
         self.sess = sess
         self.ela = ela
         self.index_name = index
         self.doc_type = doc_type
+        self.bulk_docs = bulk_docs
+        self.bulk_bytes = bulk_bytes
+        self.checkpoint = checkpoint
 
     def index(self, filter_crit=None):
         if not self.ela.is_running():
@@ -23,67 +88,130 @@ class Indexer:
         self._save(filter_crit)
         self._delete(filter_crit)
 
-    def _save(self, filter_crit):
-        lgg = self.lgg
-        sess = self.sess
-        save = functools.partial(self.ela.save, index=self.index_name,
-            doc_type=self.doc_type)
+    def _batches(self, cols, state, filter_crit, content=False):
+        """
+        Yields batches of rows in given state, ordered by path.
+
+        If ``content`` is set, :class:`stoma.models.ItemContent` is joined.
+
+        Rows are locked for update. Paging is by path, so that rows that
+        keep their state, e.g. because indexing them failed, are not
+        fetched again.
+        """
         fil = [
-            Item.state == ITEM_STATE_NEED_INDEXING
+            Item.state == state
         ]
         if filter_crit:
             fil += filter_crit
-        rs = sess.query(Item).filter(*fil).with_for_update()
-        for it in rs:
-            lgg.debug('Indexing {}'.format(it.path))
-            it.state = ITEM_STATE_INDEXING
-            sess.flush()
-
-            data = {
-                'path': it.path,
-                'tags': it.path.split(os.path.sep),
-                'mime_type': it.mime_type,
-                'encoding': it.encoding,
-                'language': it.language,
-                'size': it.size,
-                'ctime': it.item_ctime,
-                'mtime': it.item_mtime,
-                'meta': it.meta_json,
-                'text': it.data_text
-            }
-            if it.meta_json and 'language' in it.meta_json:
-                data['language'] = it.meta_json['language']
-            id_ = it.ela_id if it.ela_id else None
-            r = save(id_=id_, data=data)
-            if not it.ela_id:
-                it.ela_id = r['_id']
-            it.ela_version = r['_version']
-
-            it.state = ITEM_STATE_INDEXED
-            sess.flush()
+        last = None
+        while True:
+            q = self.sess.query(*cols)
+            if content:
+                q = q.outerjoin(ItemContent, ItemContent.path == Item.path)
+            q = q.filter(*fil)
+            if last is not None:
+                q = q.filter(Item.path > last)
+            rs = q.order_by(Item.path).limit(
+                self.bulk_docs).with_for_update(of=Item).all()
+            if not rs:
+                break
+            yield rs
+            last = rs[-1].path
+
+    def _save(self, filter_crit):
+        cols = [Item.ela_id] + DOCUMENT_COLUMNS
+        n = n_err = 0
+        for rs in self._batches(cols, ITEM_STATE_NEED_INDEXING, filter_crit,
+                content=True):
+            actions = [self.index_action(it.ela_id, document(it)) for it in rs]
+            results = self.ela.bulk(actions, max_docs=self.bulk_docs,
+                max_bytes=self.bulk_bytes)
+            n_ok = self.apply_index_results([it.path for it in rs], results)
+            n += n_ok
+            n_err += len(rs) - n_ok
+            self.lgg.debug('Indexed {} items'.format(n))
+            self._tick(len(rs))
+        self.lgg.info('Indexed {} items, {} failed'.format(n, n_err))
+
+    def index_action(self, ela_id, data):
+        """
+        Returns bulk action to index a document.
+
+        :param ela_id: ID of document if it is already indexed, else None.
+        :param data: The document, see :func:`document`.
+        :return: Tuple as expected by
+            :meth:`stoma.elastics.ElasticSearchRestClient.bulk`.
+        """
+        meta = {'_index': self.index_name, '_type': self.doc_type}
+        if ela_id:
+            meta['_id'] = ela_id
+        return 'index', meta, data
+
+    def apply_index_results(self, paths, results):
+        """
+        Writes results of bulk index actions back to the items.
+
+        Items that failed keep their state.
+
+        :param paths: List of paths of indexed items.
+        :param results: List of results in the same order.
+        :return: Number of successfully indexed items.
+        """
+        updates = []
+        for p, r in zip(paths, results):
+            if 'error' in r:
+                self.lgg.error('Item not indexed: {}: {}'.format(
+                    p, r['error']))
+                continue
+            updates.append({
+                'p': p,
+                'ela_id': r['_id'],
+                'ela_version': r['_version'],
+                'state': ITEM_STATE_INDEXED
+            })
+        self._update(updates)
+        INDEXED_ITEMS.inc(len(updates), action='index')
+        return len(updates)
 
     def _delete(self, filter_crit):
-        lgg = self.lgg
-        sess = self.sess
-        delete = functools.partial(self.ela.delete, index=self.index_name,
-            doc_type=self.doc_type)
-        fil = [
-            Item.state == ITEM_STATE_NEED_DELETION
-        ]
-        if filter_crit:
-            fil += filter_crit
-        rs = sess.query(Item).filter(*fil).with_for_update()
-        for it in rs:
-            lgg.debug('Deleting from index {}'.format(it.path))
-            it.state = ITEM_STATE_INDEXING
-            sess.flush()
-
-            id_ = it.ela_id
-            ok = delete(id_=id_)
-            if not ok:
-                self.lgg.warn('Item not deleted: {}, '.format(id_, it.path))
-            it.ela_id = None
-            it.ela_version = None
-
-            it.state = ITEM_STATE_DELETED
-            sess.flush()
+        cols = [Item.path, Item.ela_id]
+        meta = {'_index': self.index_name, '_type': self.doc_type}
+        n = 0
+        for rs in self._batches(cols, ITEM_STATE_NEED_DELETION, filter_crit):
+            indexed = [it for it in rs if it.ela_id]
+            actions = [('delete', dict(meta, _id=it.ela_id), None)
+                for it in indexed]
+            results = self.ela.bulk(actions, max_docs=self.bulk_docs,
+                max_bytes=self.bulk_bytes)
+            failed = set()
+            for it, r in zip(indexed, results):
+                if r.get('status') == 404:
+                    self.lgg.warn('Item not in index: {}, {}'.format(
+                        it.ela_id, it.path))
+                elif 'error' in r:
+                    self.lgg.error('Item not deleted: {}, {}: {}'.format(
+                        it.ela_id, it.path, r['error']))
+                    failed.add(it.path)
+            self._update([{
+                'p': it.path,
+                'ela_id': None,
+                'ela_version': None,
+                'state': ITEM_STATE_DELETED
+            } for it in rs if it.path not in failed])
+            n += len(rs) - len(failed)
+            INDEXED_ITEMS.inc(len(rs) - len(failed), action='delete')
+            self._tick(len(rs))
+        self.lgg.info('Deleted {} items from index'.format(n))
+
+    def _tick(self, n):
+        # Paging of _batches() is by path, so it survives a commit
+        if self.checkpoint:
+            self.checkpoint.tick(n)
+
+    def _update(self, updates):
+        if not updates:
+            return
+        t = Item.__table__
+        upd = t.update().where(t.c.path == sa.bindparam('p'))
+        self.sess.execute(upd, updates)
+        mark_changed(self.sess)
@@ -0,0 +1,141 @@
+import os
+import socket
+
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from zope.sqlalchemy import mark_changed
+
+from .const import (ITEM_STATE_ANALYSING, ITEM_STATE_NEED_ANALYSIS,
+    ITEM_STATE_INDEXING, ITEM_STATE_NEED_INDEXING)
+from .models import Item
+
+
+DEFAULT_LEASE_SECONDS = 3600
+REAP_STATES = {
+    ITEM_STATE_ANALYSING: ITEM_STATE_NEED_ANALYSIS,
+    ITEM_STATE_INDEXING: ITEM_STATE_NEED_INDEXING,
+}
+"""Maps an in-process state to the state an expired item is put back into"""
+
+
+def worker_id():
+    """Returns an ID for this process, as 'HOSTNAME:PID'."""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class utcnow(FunctionElement):
+    """
+    Current time of the database in UTC.
+
+    Leases are taken and reaped by processes on different hosts, so their
+    times come from the clock of the database, not from that of a host, and
+    in UTC, regardless of the time zone of a connection.
+    """
+    type = sa.DateTime()
+
+
+@compiles(utcnow, 'postgresql')
+def _pg_utcnow(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    # E.g. SQLite, whose CURRENT_TIMESTAMP is in UTC
+    return 'CURRENT_TIMESTAMP'
+
+
+class utc_after(FunctionElement):
+    """Time of the database in UTC, a number of seconds from now."""
+    type = sa.DateTime()
+
+    def __init__(self, seconds):
+        self.seconds = int(seconds)
+        super().__init__()
+
+
+@compiles(utc_after, 'postgresql')
+def _pg_utc_after(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP) + INTERVAL '{} seconds'".format(
+        element.seconds)
+
+
+@compiles(utc_after)
+def _utc_after(element, compiler, **kw):
+    return "DATETIME('now', '{:+d} seconds')".format(element.seconds)
+
+
+def lease(seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Returns column values to claim items.
+
+    Times are taken from the database, in UTC, see :class:`utcnow`.
+
+    :param seconds: Duration of the lease.
+    :return: Dict of values for ``claimed_by``, ``claimed_at`` and
+        ``lease_expires``.
+    """
+    return {
+        'claimed_by': worker_id(),
+        'claimed_at': utcnow(),
+        'lease_expires': utc_after(seconds),
+    }
+
+
+NO_LEASE = {
+    'claimed_by': None,
+    'claimed_at': None,
+    'lease_expires': None,
+}
+"""Column values to release items"""
+
+
+class Reaper:
+
+    def __init__(self, lgg, sess):
+        """
+        Puts items whose lease expired back into their pending state.
+
+        A worker that claims items, e.g.
+        :meth:`stoma.analyser.Analyser.claim`, sets their state to
+        analysing and leases them for a while. If the worker dies, the items
+        would stay in that state, and be skipped by everyone else, forever.
+        Once the lease expired, the reaper makes them available again.
+        Items in process without a lease are reaped too; they are left over
+        from runs that did not set leases.
+
+        A worker whose lease expired while it is still busy finishes its
+        item regardless, at worst it is analysed twice.
+
+        :param lgg: Logger
+        :param sess: DB session
+        """
+        self.lgg = lgg
+        self.sess = sess
+
+    def reap(self, now=None):
+        """
+        Reaps expired items within the current transaction.
+
+        :param now: Reference time in UTC; default is the current time of
+            the database.
+        :return: Number of reaped items.
+        """
+        if now is None:
+            now = utcnow()
+        t = Item.__table__
+        n = 0
+        for state, new_state in REAP_STATES.items():
+            upd = t.update().where(sa.and_(
+                t.c.state == state,
+                sa.or_(t.c.lease_expires.is_(None),
+                    t.c.lease_expires < now)
+            )).values(state=new_state, **NO_LEASE)
+            r = self.sess.execute(upd)
+            if r.rowcount:
+                self.lgg.warning("Reaped {} items in state '{}'".format(
+                    r.rowcount, state))
+            n += r.rowcount
+        mark_changed(self.sess)
+        return n
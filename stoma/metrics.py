@@ -0,0 +1,426 @@
+import contextlib
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+import sqlalchemy as sa
+
+
+mlgg = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0,
+    30.0, 60.0, 300.0)
+"""Upper bounds of histogram buckets in seconds"""
+DEFAULT_EXPORT_INTERVAL = 15.0
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def _fmt_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+        for k, v in pairs) + '}'
+
+
+def _fmt_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric:
+
+    type_ = None
+
+    def __init__(self, name, help_, labels=()):
+        """
+        A metric with values per combination of labels.
+
+        :param name: Name, e.g. 'stoma_walk_phase_seconds'.
+        :param help_: Description.
+        :param labels: Names of labels.
+        """
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('Metric {} has labels {}, got {}'.format(
+                self.name, self.labels, tuple(labels)))
+        return tuple(str(labels[k]) for k in self.labels)
+
+    def render(self):
+        """Returns lines in Prometheus text format."""
+        ll = ['# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.type_)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, v in items:
+            ll += self._render_value(key, v)
+        return ll
+
+    def _render_value(self, key, v):
+        return ['{}{} {}'.format(self.name, _fmt_labels(self.labels, key),
+            _fmt_value(v))]
+
+    def summary(self):
+        """Returns dict mapping labels, joined as 'k=v,...', to values."""
+        with self._lock:
+            items = sorted(self._values.items())
+        return {','.join('{}={}'.format(k, v) for k, v in zip(self.labels,
+            key)): self._summary_value(v) for key, v in items}
+
+    def _summary_value(self, v):
+        return v
+
+
+class Counter(Metric):
+
+    type_ = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+
+class Gauge(Metric):
+
+    type_ = 'gauge'
+
+    def set(self, v, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = v
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+
+class Histogram(Metric):
+
+    type_ = 'histogram'
+
+    def __init__(self, name, help_, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        A histogram of e.g. durations.
+
+        :param buckets: Ascending upper bounds of buckets.
+        """
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, v, **labels):
+        key = self._key(labels)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                # Counts per bucket, sum, maximum
+                h = self._values[key] = [[0] * len(self.buckets), 0.0, 0.0]
+            for i, b in enumerate(self.buckets):
+                if v <= b:
+                    h[0][i] += 1
+                    break
+            h[1] += v
+            h[2] = max(h[2], v)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Context manager that observes the duration of its block."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def _render_value(self, key, h):
+        counts, total, _ = h
+        ll = []
+        n = 0
+        for b, c in zip(self.buckets, counts):
+            n += c
+            ll.append('{}_bucket{} {}'.format(self.name,
+                _fmt_labels(self.labels, key, [('le', _fmt_value(b))]), n))
+        lbl = _fmt_labels(self.labels, key)
+        ll.append('{}_sum{} {}'.format(self.name, lbl, _fmt_value(total)))
+        ll.append('{}_count{} {}'.format(self.name, lbl, n))
+        return ll
+
+    def _summary_value(self, h):
+        counts, total, max_ = h
+        n = sum(counts)
+        return {'count': n, 'sum': round(total, 6),
+            'mean': round(total / n, 6) if n else None,
+            'max': round(max_, 6)}
+
+
+class Registry:
+
+    def __init__(self):
+        """Holds metrics and renders them for export."""
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_, labels, **kw):
+        with self._lock:
+            m = self._metrics.get(name)
+            if m is None:
+                m = self._metrics[name] = cls(name, help_, labels, **kw)
+            elif not isinstance(m, cls):
+                raise ValueError('Metric {} is a {}'.format(name, m.type_))
+            return m
+
+    def counter(self, name, help_, labels=()):
+        return self._get(Counter, name, help_, labels)
+
+    def gauge(self, name, help_, labels=()):
+        return self._get(Gauge, name, help_, labels)
+
+    def histogram(self, name, help_, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_, labels, buckets=buckets)
+
+    def render(self):
+        """Returns all metrics in Prometheus text format."""
+        with self._lock:
+            mm = sorted(self._metrics.values(), key=lambda m: m.name)
+        ll = []
+        for m in mm:
+            ll += m.render()
+        return '\n'.join(ll) + '\n'
+
+    def summary(self):
+        """
+        Returns a summary of all metrics that have values.
+
+        :return: Dict mapping names of metrics to dicts of labels and
+            values; histograms have count, sum, mean and max.
+        """
+        with self._lock:
+            mm = sorted(self._metrics.values(), key=lambda m: m.name)
+        return {m.name: s for m, s in ((m, m.summary()) for m in mm) if s}
+
+    def write_textfile(self, fn):
+        """
+        Writes all metrics to a file, e.g. for the textfile collector of
+        Prometheus' node exporter. The file is replaced atomically.
+        """
+        tmp = '{}.{}.tmp'.format(fn, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            fh.write(self.render())
+        os.replace(tmp, fn)
+
+
+REGISTRY = Registry()
+
+
+# ===[ METRICS ]=======
+
+WALK_PHASE_SECONDS = REGISTRY.histogram('stoma_walk_phase_seconds',
+    'Duration of walker phases', ('phase',))
+WALK_ITEMS = REGISTRY.counter('stoma_walk_items_total',
+    'Items saved by the walker, by action', ('action',))
+ANALYSE_SECONDS = REGISTRY.histogram('stoma_analyse_seconds',
+    'Duration of analysing an item', ('backend',))
+ANALYSED_ITEMS = REGISTRY.counter('stoma_analysed_items_total',
+    'Analysed items', ('backend',))
+INDEXED_ITEMS = REGISTRY.counter('stoma_indexed_items_total',
+    'Items indexed or deleted in ElasticSearch', ('action',))
+HTTP_SECONDS = REGISTRY.histogram('stoma_http_request_seconds',
+    'Duration of HTTP requests until the response header arrived',
+    ('service', 'endpoint', 'op'))
+HTTP_REQUEST_BYTES = REGISTRY.counter('stoma_http_request_bytes_total',
+    'Bytes sent in HTTP request bodies of known length',
+    ('service', 'endpoint', 'op'))
+HTTP_RESPONSE_BYTES = REGISTRY.counter('stoma_http_response_bytes_total',
+    'Bytes received in HTTP response bodies of known length',
+    ('service', 'endpoint', 'op'))
+HTTP_ERRORS = REGISTRY.counter('stoma_http_errors_total',
+    'HTTP responses with status >= 400', ('service', 'endpoint', 'status'))
+ELA_BULK_SECONDS = REGISTRY.histogram('stoma_ela_bulk_seconds',
+    'Duration of ElasticSearch bulk requests, including the response body')
+ELA_BULK_ACTIONS = REGISTRY.counter('stoma_ela_bulk_actions_total',
+    'Actions sent in ElasticSearch bulk requests')
+DB_FLUSH_SECONDS = REGISTRY.histogram('stoma_db_flush_seconds',
+    'Duration of DB session flushes')
+DB_COMMIT_SECONDS = REGISTRY.histogram('stoma_db_commit_seconds',
+    'Duration of DB commits')
+QUEUE_DEPTH = REGISTRY.gauge('stoma_queue_depth',
+    'Number of entries waiting in a pipeline queue', ('queue',))
+
+
+# ===[ INSTRUMENTATION ]=======
+
+def first_segment(url):
+    """Returns the first segment of the path of ``url``, e.g. 'rmeta'."""
+    path = urllib.parse.urlsplit(url).path
+    return path.strip('/').split('/', 1)[0]
+
+
+def ela_op(url):
+    """
+    Returns the API of an ElasticSearch URL, e.g. '_bulk', '_search', or
+    'doc' for document URLs, without the names of index and document.
+    """
+    path = urllib.parse.urlsplit(url).path
+    for s in path.strip('/').split('/'):
+        if s.startswith('_'):
+            return s
+    return 'doc' if path.strip('/') else 'root'
+
+
+def instrument_session(session, service, op_of=first_segment):
+    """
+    Records latency and size of the requests of a HTTP session.
+
+    :param session: Instance of :class:`requests.Session`.
+    :param service: Label of the service, e.g. 'tika'.
+    :param op_of: Function that returns the label of the operation from a
+        URL. Must not return unbounded values like document IDs.
+    """
+    def hook(r, *args, **kwargs):
+        u = urllib.parse.urlsplit(r.url)
+        labels = dict(service=service, endpoint=u.netloc, op=op_of(r.url))
+        HTTP_SECONDS.observe(r.elapsed.total_seconds(), **labels)
+        n = r.request.headers.get('Content-Length')
+        if n:
+            HTTP_REQUEST_BYTES.inc(int(n), **labels)
+        n = r.headers.get('Content-Length')
+        if n:
+            HTTP_RESPONSE_BYTES.inc(int(n), **labels)
+        if r.status_code >= 400:
+            HTTP_ERRORS.inc(service=service, endpoint=u.netloc,
+                status=r.status_code)
+    session.hooks['response'].append(hook)
+    return session
+
+
+def instrument_db(target):
+    """
+    Records duration of flushes and commits of DB sessions.
+
+    :param target: Session class or sessionmaker, e.g.
+        :data:`stoma.models.DbSession`.
+    """
+    def start(key):
+        def f(sess, *args):
+            sess.info[key] = time.perf_counter()
+        return f
+
+    def stop(key, hist):
+        def f(sess, *args):
+            t0 = sess.info.pop(key, None)
+            if t0 is not None:
+                hist.observe(time.perf_counter() - t0)
+        return f
+
+    sa.event.listen(target, 'before_flush', start('metrics_flush'))
+    sa.event.listen(target, 'after_flush_postexec',
+        stop('metrics_flush', DB_FLUSH_SECONDS))
+    sa.event.listen(target, 'before_commit', start('metrics_commit'))
+    sa.event.listen(target, 'after_commit',
+        stop('metrics_commit', DB_COMMIT_SECONDS))
+
+
+# ===[ EXPORT ]=======
+
+class Exporter:
+
+    def __init__(self, registry=REGISTRY, textfile=None, port=None,
+            host='127.0.0.1', interval=DEFAULT_EXPORT_INTERVAL):
+        """
+        Exports metrics to a textfile and/or via HTTP.
+
+        The textfile is written every ``interval`` seconds and on
+        :meth:`close`. The HTTP server answers ``GET /metrics`` in
+        Prometheus text format, and ``GET /summary`` in JSON.
+
+        :param registry: Instance of :class:`Registry`.
+        :param textfile: Filename, or None.
+        :param port: Port of the HTTP server, or None.
+        :param host: Address the HTTP server binds to.
+        :param interval: Seconds between writes of the textfile.
+        """
+        self.registry = registry
+        self.textfile = textfile
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self._stop = threading.Event()
+        self._writer = None
+        self._server = None
+
+    def start(self):
+        if self.textfile:
+            self._stop.clear()
+            self._writer = threading.Thread(target=self._write_loop,
+                name='metrics-textfile', daemon=True)
+            self._writer.start()
+        if self.port:
+            self._server = http.server.ThreadingHTTPServer(
+                (self.host, self.port), self._handler())
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever,
+                name='metrics-http', daemon=True).start()
+            mlgg.info('Serving metrics on http://{}:{}/metrics'.format(
+                self.host, self.port))
+
+    def close(self):
+        """Stops export and writes the textfile a last time."""
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        if self.textfile:
+            self.registry.write_textfile(self.textfile)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.registry.write_textfile(self.textfile)
+            except OSError as exc:
+                mlgg.warning('Failed to write metrics: {}'.format(exc))
+
+    def _handler(self):
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, ct = registry.render(), CONTENT_TYPE
+                elif self.path == '/summary':
+                    body = json.dumps(registry.summary(), sort_keys=True)
+                    ct = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                b = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', ct)
+                self.send_header('Content-Length', str(len(b)))
+                self.end_headers()
+                self.wfile.write(b)
+
+            def log_message(self, fmt, *args):
+                mlgg.debug(fmt % args)
+
+        return Handler
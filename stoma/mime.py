@@ -1,33 +1,240 @@
-import magic
+import logging
 import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import magic
+
+from .const import MIME_TYPE_DEFAULT
+
+
+mlgg = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 100000
+"""Number of magic results a :class:`MimeDetector` keeps"""
+
+_local = threading.local()
+
+
+def _build_tables():
+    mimetypes.init()
+    types = {ext.lower(): mt for ext, mt in mimetypes.types_map.items()}
+    suffixes = {ext.lower(): x for ext, x in mimetypes.suffix_map.items()}
+    encodings = {ext.lower(): enc
+        for ext, enc in mimetypes.encodings_map.items()}
+    return types, suffixes, encodings
+
+
+EXTENSION_TYPES, EXTENSION_SUFFIXES, EXTENSION_ENCODINGS = _build_tables()
+"""
+Lookup tables of :mod:`mimetypes` by lower-case extension: mime types,
+aliases like '.tgz' for '.tar.gz', and encodings like 'gzip' for '.gz'
+"""
+
+
+def guess_from_extension(fn):
+    """
+    Guesses mime type from the extension of a filename.
+
+    Like :func:`mimetypes.guess_type`, but with precomputed tables and
+    case-insensitive.
+
+    :param fn: Filename.
+    :return: Tuple(mime_type, encoding); both may be None.
+    """
+    base, ext = os.path.splitext(os.path.basename(fn))
+    ext = ext.lower()
+    if ext in EXTENSION_SUFFIXES:
+        base, ext = os.path.splitext(base + EXTENSION_SUFFIXES[ext])
+        ext = ext.lower()
+    enc = EXTENSION_ENCODINGS.get(ext)
+    if enc is not None:
+        base, ext = os.path.splitext(base)
+        ext = ext.lower()
+    return EXTENSION_TYPES.get(ext), enc
+
+
+def _magic():
+    # Instances of magic.Magic must not be shared between threads
+    try:
+        return _local.magic
+    except AttributeError:
+        _local.magic = magic.Magic(mime=True, mime_encoding=True)
+        return _local.magic
+
+
+def guess_from_content(fn, magic_inst=None):
+    """
+    Guesses mime type from the content of a file with libmagic.
 
+    :param fn: Filename.
+    :param magic_inst: Instance of :class:`magic.Magic`, created with
+        mime=True and mime_encoding=True; default is one of the current
+        thread.
+    :return: Mime type, e.g. 'text/plain; charset=us-ascii'.
+    """
+    mt = (magic_inst if magic_inst else _magic()).from_file(fn)
+    if isinstance(mt, bytes):
+        mt = mt.decode('ASCII')
+    # In case magic returned several types on separate lines
+    return mt.split(r'\012')[0].strip()
 
-def guess_mime_type(fn,
-        magic_inst=magic.Magic(mime=True, mime_encoding=True, keep_going=True)):
+
+def guess_mime_type(fn, magic_inst=None):
     """
     Guesses mime-type from filename.
 
-    Uses Python's lib ``mimetypes`` first, if no type could be determined, falls
-    back to ``python-magic``.
+    Uses the extension first; if no type could be determined, falls back
+    to ``python-magic``.
 
-    Returned encoding might be None.
+    Returned encoding is that of :mod:`mimetypes`, e.g. 'gzip', and might
+    be None. A mime type from magic may have a charset parameter.
 
     :param fn: Filename.
     :param magic_inst: Instance of :class:`magic.Magic`. Should be created with
-        mime=True, mime_encoding=True, keep_going=True.
+        mime=True, mime_encoding=True.
     :return: Tuple(mime_type, encoding).
     """
-    # Try Python's native lib first
-    mt, enc = mimetypes.guess_type(fn)
+    mt, enc = guess_from_extension(fn)
     # It may not find all types, e.g. it returns None for 'text/plain', so
     # fallback on python-magic.
     if not mt:
-        if magic_inst:
-            mt = magic_inst.from_file(fn).decode('ASCII')
-        else:
-            mt = magic.from_file(fn).decode('ASCII')
-    if not enc:
-        enc = None
-    # In case magic returned several types on separate lines
-    mt = mt.split(r'\012')[0]
+        mt = guess_from_content(fn, magic_inst)
     return mt, enc
+
+
+class MimeDetector:
+
+    def __init__(self, workers=1, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Guesses mime types of many files.
+
+        Like :func:`guess_mime_type`, types are taken from the extension if
+        possible. Only files without a known extension are read by
+        libmagic, in a pool of ``workers`` threads with an instance of
+        :class:`magic.Magic` each. The pool, and so the loaded magic
+        databases, lives until :meth:`close`.
+
+        Results of libmagic are cached by (inode, device, mtime, size), so
+        that files that did not change, including hard links and renamed
+        files, are not read again while the detector lives, e.g. during
+        ``stoma watch``. Results by extension are not cached, since a
+        rename keeps the inode but may change the extension.
+
+        :param workers: Number of threads for libmagic.
+        :param cache_size: Maximum number of cached results; the oldest
+            are dropped first.
+        """
+        self.workers = workers
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self.n_magic = 0
+        """Number of files read by libmagic"""
+        self.n_cached = 0
+        """Number of files whose type was found in the cache"""
+
+    @property
+    def executor(self):
+        """Thread pool for libmagic, started on first use."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                    thread_name_prefix='mime')
+            return self._executor
+
+    def close(self):
+        """Stops the threads, if started."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    @staticmethod
+    def cache_key(st):
+        """
+        Returns the cache key of a file.
+
+        :param st: Instance of :class:`os.stat_result`, or dict with its
+            attributes, as in column ``os_stat``.
+        """
+        if isinstance(st, dict):
+            return st['st_ino'], st['st_dev'], st['st_mtime'], st['st_size']
+        return st.st_ino, st.st_dev, st.st_mtime, st.st_size
+
+    def guess(self, fn, st=None):
+        """
+        Guesses the mime type of a single file.
+
+        :param fn: Filename.
+        :param st: Stat result of the file, see :meth:`cache_key`; without
+            it, the cache is not used.
+        :return: Tuple(mime_type, encoding).
+        """
+        return self.guess_many([(fn, st)])[0]
+
+    def guess_many(self, files):
+        """
+        Guesses mime types of many files.
+
+        :param files: List of tuples (filename, stat result).
+        :return: List of tuples (mime_type, encoding) in the same order.
+        """
+        results = [guess_from_extension(fn) for fn, _ in files]
+        todo = []
+        for i, (fn, st) in enumerate(files):
+            if results[i][0]:
+                continue
+            key = self.cache_key(st) if st is not None else None
+            mt = self._cache_get(key)
+            if mt is not None:
+                self.n_cached += 1
+                results[i] = (mt, results[i][1])
+            else:
+                todo.append((i, fn, key))
+        if not todo:
+            return results
+        if self.workers > 1 and len(todo) > 1:
+            mts = list(self.executor.map(self._from_content,
+                [fn for _, fn, _ in todo]))
+        else:
+            mts = [self._from_content(fn) for _, fn, _ in todo]
+        self.n_magic += len(todo)
+        for (i, fn, key), mt in zip(todo, mts):
+            if mt is None:
+                mt = MIME_TYPE_DEFAULT
+            else:
+                self._cache_put(key, mt)
+            results[i] = (mt, results[i][1])
+        return results
+
+    @staticmethod
+    def _from_content(fn):
+        try:
+            return guess_from_content(fn)
+        except (OSError, magic.MagicException) as exc:
+            # E.g. the file was removed since the walk saw it
+            mlgg.warning("Failed to detect mime type of '{}': {}".format(
+                fn, exc))
+            return None
+
+    def _cache_get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            mt = self._cache.get(key)
+            if mt is not None:
+                self._cache.move_to_end(key)
+            return mt
+
+    def _cache_put(self, key, mt):
+        if key is None or not self.cache_size:
+            return
+        with self._lock:
+            self._cache[key] = mt
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
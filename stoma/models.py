@@ -1,3 +1,5 @@
+import os
+
 import sqlalchemy as sa
 from sqlalchemy import engine_from_config, MetaData
 from sqlalchemy.dialects.postgresql import JSONB
@@ -14,8 +16,10 @@ from zope.sqlalchemy import ZopeTransactionExtension
 from pym.models.types import LocalDateTime
 import pym.lib
 from .i18n import _
+from .codec import encode_text, decode_text
 from .const import (MIME_TYPE_DEFAULT, IN_PROCESS_ITEM_STATES,
-    ITEM_STATE_UNCHANGED)
+    ITEM_STATE_UNCHANGED, ITEM_STATE_NEED_ANALYSIS, ITEM_STATE_NEED_INDEXING,
+    ITEM_STATE_NEED_DELETION, ITEM_STATE_ANALYSING, ITEM_STATE_INDEXING)
 
 
 # ===[ DB HELPERS ]=======
@@ -48,6 +52,12 @@ DbEngine = None
 Default DB engine.
 """
 
+JsonB = JSONB(none_as_null=True).with_variant(sa.JSON(none_as_null=True),
+    'sqlite')
+"""
+JSONB, or plain JSON on SQLite, which the benchmarks may run on.
+"""
+
 
 # ===[ IMPORTABLE SETUP FUNCS ]=======
 
@@ -80,9 +90,35 @@ def create_all():
     DbBase.metadata.create_all(DbEngine)
 
 
+META_KEYS = 'meta_json meta_xmp data_text data_html_head data_html_body'.split(' ')
+"""Attributes of an item that hold analysis results"""
+TEXT_META_KEYS = META_KEYS[1:]
+"""Those of ``META_KEYS`` that are stored as encoded text"""
+
+
 class Item(DbBase):
     __tablename__ = "item"
     __table_args__ = (
+        sa.Index('item_digest_ix', 'digest'),
+        # Nearly all items are indexed or unchanged. These partial indexes
+        # find the pending ones, in the order work is taken, without
+        # scanning the table.
+        sa.Index('item_need_analysis_ix', 'path', postgresql_where=sa.text(
+            "state = '" + ITEM_STATE_NEED_ANALYSIS + "'")),
+        # Orders of stoma.scheduler
+        sa.Index('item_need_analysis_size_ix', 'size', 'path',
+            postgresql_where=sa.text(
+                "state = '" + ITEM_STATE_NEED_ANALYSIS + "'")),
+        sa.Index('item_need_analysis_mtime_ix', 'item_mtime',
+            postgresql_where=sa.text(
+                "state = '" + ITEM_STATE_NEED_ANALYSIS + "'")),
+        sa.Index('item_need_indexing_ix', 'path', postgresql_where=sa.text(
+            "state = '" + ITEM_STATE_NEED_INDEXING + "'")),
+        sa.Index('item_need_deletion_ix', 'path', postgresql_where=sa.text(
+            "state = '" + ITEM_STATE_NEED_DELETION + "'")),
+        sa.Index('item_in_process_ix', 'lease_expires',
+            postgresql_where=sa.text("state IN ('" + ITEM_STATE_ANALYSING
+                + "', '" + ITEM_STATE_INDEXING + "')")),
         {'schema': 'stoma'}
     )
 
@@ -109,6 +145,17 @@ class Item(DbBase):
     """Encoding, if content is text."""
     language = sa.Column(sa.Unicode(255), nullable=True)
     """Detected language."""
+    digest = sa.Column(sa.Unicode(160), nullable=True)
+    """Digest of the content as 'ALGORITHM:HEXDIGEST', see
+    :func:`stoma.digest.file_digest`. NULL if not yet computed."""
+
+    claimed_by = sa.Column(sa.Unicode(255), nullable=True)
+    """Worker that claimed this item, see :func:`stoma.lease.worker_id`"""
+    claimed_at = sa.Column(sa.DateTime(), nullable=True)
+    """Time of the database in UTC, see :class:`stoma.lease.utcnow`"""
+    lease_expires = sa.Column(sa.DateTime(), nullable=True)
+    """After this time, in UTC, :class:`stoma.lease.Reaper` takes the item
+    back from its worker."""
 
     # noinspection PyUnusedLocal
     @sa.orm.validates('mime_type')
@@ -117,35 +164,55 @@ class Item(DbBase):
         assert '/' in mime_type
         return mime_type
 
-    os_stat = sa.Column(JSONB(none_as_null=True), nullable=True)
+    os_stat = sa.Column(JsonB, nullable=True)
     """Result of os.stat"""
 
-    xattr = sa.Column(JSONB(none_as_null=True), nullable=True)
+    xattr = sa.Column(JsonB, nullable=True)
     """Extended attributes"""
 
-    meta_json = sa.Column(JSONB(none_as_null=True), nullable=True)
-    """Extracted meta information as JSON"""
-    meta_xmp = sa.Column(sa.UnicodeText(), nullable=True)
-    """Extracted meta information as XMP"""
-    data_text = sa.Column(sa.UnicodeText(), nullable=True)
-    """Certain mime-types allow storing content as text. Also the text rendering
-    of uploaded office documents is stored here."""
-    data_json = sa.Column(JSONB(none_as_null=True), nullable=True)
+    data_json = sa.Column(JsonB, nullable=True)
     """Certain mime-types allow storing content as JSON"""
-    data_html_head = sa.orm.deferred(sa.Column(sa.UnicodeText(), nullable=True))
-    """Head of HTML rendering of office documents."""
-    data_html_body = sa.orm.deferred(sa.Column(sa.UnicodeText(), nullable=True))
-    """Body of HTML rendering of office documents."""
+    truncated = sa.Column(sa.Boolean(), nullable=False,
+        server_default=sa.text('false'))
+    """Whether text and HTML are incomplete, because they exceeded the
+    size limit or the file was too large to extract them at all."""
+
+    content = sa.orm.relationship('ItemContent', uselist=False,
+        cascade='all, delete-orphan', passive_deletes=True)
+    """Analysis results, loaded on first access."""
 
-    def set_meta(self, meta):
-        kk = 'meta_json meta_xmp data_text data_html_head data_html_body'.split(' ')
+    def set_meta(self, meta, compression=None):
         mj = meta.get('meta_json', None)
         if mj:
             s = pym.lib.json_serializer(mj)
             s = s.replace("\0", '').replace("\x00", '').replace("\u0000", '').replace("\\u0000", '')
             meta['meta_json'] = pym.lib.json_deserializer(s)
-        for k in kk:
-            setattr(self, k, meta.get(k, None))
+        if self.content is None:
+            self.content = ItemContent(path=self.path)
+        self.content.set_meta(meta, compression)
+
+    def get_meta(self, key):
+        """
+        Returns an analysis result.
+
+        :param key: One of ``META_KEYS``.
+        :return: Value, or None if item has no analysis results.
+        """
+        if self.content is None:
+            return None
+        return self.content.get(key)
+
+    meta_json = property(lambda self: self.get_meta('meta_json'),
+        doc="""Extracted meta information as JSON""")
+    meta_xmp = property(lambda self: self.get_meta('meta_xmp'),
+        doc="""Extracted meta information as XMP""")
+    data_text = property(lambda self: self.get_meta('data_text'),
+        doc="""Certain mime-types allow storing content as text. Also the
+        text rendering of uploaded office documents is stored here.""")
+    data_html_head = property(lambda self: self.get_meta('data_html_head'),
+        doc="""Head of HTML rendering of office documents.""")
+    data_html_body = property(lambda self: self.get_meta('data_html_body'),
+        doc="""Body of HTML rendering of office documents.""")
 
     ctime = sa.Column(LocalDateTime, server_default=sa.func.current_timestamp(),
         nullable=False,
@@ -156,6 +223,121 @@ class Item(DbBase):
     """Timestamp, last edit time."""
 
 
+class ItemContent(DbBase):
+    """
+    Analysis results of an item.
+
+    They are kept apart from :class:`Item`, so that rows of the latter stay
+    small: changing the state of an item does not rewrite megabytes of
+    text, and scans over items do not read it.
+
+    Texts are stored as UTF-8 in bytea columns, optionally compressed, see
+    :mod:`stoma.codec`. Use :meth:`get` and :meth:`set_meta` to access them
+    decoded.
+    """
+    __tablename__ = "item_content"
+    __table_args__ = (
+        {'schema': 'stoma'}
+    )
+
+    path = sa.Column(sa.Unicode(1024),
+        sa.ForeignKey('stoma.item.path', onupdate='CASCADE',
+            ondelete='CASCADE'),
+        nullable=False, primary_key=True)
+    compression = sa.Column(sa.Unicode(16), nullable=True)
+    """Compression of the text columns, None if uncompressed."""
+
+    meta_json = sa.Column(JsonB, nullable=True)
+    """Extracted meta information as JSON"""
+    meta_xmp = sa.Column(sa.LargeBinary(), nullable=True)
+    """Extracted meta information as XMP"""
+    data_text = sa.Column(sa.LargeBinary(), nullable=True)
+    """Text rendering of the content"""
+    data_html_head = sa.orm.deferred(sa.Column(sa.LargeBinary(),
+        nullable=True))
+    """Head of HTML rendering of office documents."""
+    data_html_body = sa.orm.deferred(sa.Column(sa.LargeBinary(),
+        nullable=True))
+    """Body of HTML rendering of office documents."""
+
+    def get(self, key):
+        """
+        Returns a decoded analysis result.
+
+        :param key: One of ``META_KEYS``.
+        """
+        v = getattr(self, key)
+        if key in TEXT_META_KEYS:
+            v = decode_text(v, self.compression)
+        return v
+
+    def set_meta(self, meta, compression=None):
+        """
+        Sets all analysis results.
+
+        :param meta: Dict with keys of ``META_KEYS``; missing keys are set
+            to None.
+        :param compression: Compression of the text columns, see
+            :func:`stoma.codec.encode_text`.
+        """
+        self.compression = compression
+        for k in META_KEYS:
+            v = meta.get(k, None)
+            if k in TEXT_META_KEYS:
+                v = encode_text(v, compression)
+            setattr(self, k, v)
+
+
+class Directory(DbBase):
+    """
+    Metadata of a walked directory.
+
+    A directory's mtime and link count change if entries are added, removed
+    or renamed in it. If both are unchanged since the last walk, the walker
+    does not list the directory again, see :class:`stoma.walker.Walker`.
+    """
+    __tablename__ = "directory"
+    __table_args__ = (
+        sa.Index('directory_parent_ix', 'parent'),
+        {'schema': 'stoma'}
+    )
+
+    path = sa.Column(sa.Unicode(1024), nullable=False, primary_key=True)
+    parent = sa.Column(sa.Unicode(1024), nullable=False)
+    dir_mtime = sa.Column(sa.DateTime(), nullable=False)
+    """Mtime of the directory as seen during the last walk"""
+    nlink = sa.Column(sa.Integer(), nullable=False)
+    """Link count, i.e. 2 plus number of subdirectories on most filesystems"""
+
+
+# Prefix lookups compare bytewise, which these indexes support, regardless
+# of the database's default collation.
+sa.Index('item_path_c_ix', sa.collate(Item.path, 'C'))
+sa.Index('directory_path_c_ix', sa.collate(Directory.path, 'C'))
+
+
+def below(col, path):
+    """
+    Returns criterion for paths below directory ``path``.
+
+    Unlike ``col LIKE path || '%'``, this does not match siblings, e.g.
+    '/data/foobar' for '/data/foo', and, being a range on ``col COLLATE
+    "C"``, it uses index ``item_path_c_ix`` resp. ``directory_path_c_ix``
+    whatever the database's collation is. Wildcards in ``path`` have no
+    special meaning either.
+
+    :param col: Column of paths, e.g. ``Item.path``.
+    :param path: Path of directory.
+    :return: SQLAlchemy criterion.
+    """
+    lower = path.rstrip(os.sep) + os.sep
+    # Bytewise, all paths below are less than the one with the separator
+    # replaced by its successor
+    upper = lower[:-1] + chr(ord(os.sep) + 1)
+    c = sa.collate(col, 'C')
+    return sa.and_(c >= lower, c < upper)
+
+
 # Do not walk over items currently processed by other tasks
 def exclude_filter():
     return [Item.state != st for st in IN_PROCESS_ITEM_STATES]
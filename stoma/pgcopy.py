@@ -0,0 +1,47 @@
+import io
+import json
+
+
+def is_postgresql(sess):
+    """Tells whether ``sess`` is bound to PostgreSQL through psycopg2."""
+    dialect = sess.get_bind().dialect
+    return dialect.name == 'postgresql' and dialect.driver == 'psycopg2'
+
+
+def copy_escape(v):
+    """
+    Formats a value for ``COPY ... FROM STDIN`` in text format.
+
+    :param v: Value; dicts and lists are written as JSON.
+    :return: String
+    """
+    if v is None:
+        return '\\N'
+    if isinstance(v, (dict, list)):
+        v = json.dumps(v)
+    return str(v).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_from(sess, table, columns, rows):
+    """
+    Loads rows into a table with ``COPY``.
+
+    Runs on the connection of ``sess``, i.e. within its transaction.
+
+    :param sess: DB session bound to PostgreSQL through psycopg2.
+    :param table: Name of table.
+    :param columns: List of column names.
+    :param rows: Iterable of tuples of values in order of ``columns``.
+    """
+    buf = io.StringIO()
+    for r in rows:
+        buf.write('\t'.join(copy_escape(v) for v in r))
+        buf.write('\n')
+    buf.seek(0)
+    cur = sess.connection().connection.cursor()
+    try:
+        cur.copy_expert('COPY {} ({}) FROM STDIN'.format(
+            table, ', '.join(columns)), buf)
+    finally:
+        cur.close()
@@ -0,0 +1,460 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import transaction
+from zope.sqlalchemy import mark_changed
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .analyser import Analyser
+from .const import (ITEM_STATE_NEED_ANALYSIS, ITEM_STATE_ANALYSING,
+    MIME_TYPE_UNKNOWN)
+from .elastics import bulk_chunks, bulk_results
+from .httpclient import RETRY_STATUS
+from .indexer import Indexer, document
+from .lease import lease, NO_LEASE
+from .metrics import (ANALYSE_SECONDS, ANALYSED_ITEMS, ELA_BULK_SECONDS,
+    ELA_BULK_ACTIONS, HTTP_SECONDS, QUEUE_DEPTH)
+from .mime import guess_from_content
+from .models import DbSession, Item
+from .tika import bundle_from_rmeta, LANGUAGE_SAMPLE_SIZE
+
+
+mlgg = logging.getLogger(__name__)
+
+_DONE = object()
+"""Sentinel to tell a stage that no more input will arrive"""
+
+
+def _endpoint_failed(exc):
+    """
+    Tells whether a request failed by the fault of the Tika endpoint: it is
+    unreachable, timed out or answered with a status of ``RETRY_STATUS``.
+    """
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in RETRY_STATUS
+    return isinstance(exc, (aiohttp.ClientConnectionError,
+        asyncio.TimeoutError))
+
+
+class Pipeline:
+
+    def __init__(self, lgg, walker, analyser, indexer, concurrency=8,
+            queue_size=1000, bulk_interval=1.0):
+        """
+        Runs walk, analysis and indexing concurrently.
+
+        The stages are connected by bounded queues, so a fast stage waits for
+        a slow one instead of piling up work:
+
+        1. The walker runs in a thread in streaming mode. Each saved batch is
+           committed, and its paths are put into the analysis queue.
+        2. ``concurrency`` coroutines take paths from that queue, claim each
+           item, extract it with a single ``/rmeta`` request to Tika (see
+           :meth:`stoma.tika.TikaPymMixin.pym_rmeta`) or with a local
+           extractor of the analyser, commit the result and put the document
+           into the index queue.
+        3. One coroutine collects documents from the index queue and sends
+           them with a bulk request to ElasticSearch as soon as it has
+           ``indexer.bulk_docs`` of them, or ``bulk_interval`` seconds
+           passed.
+
+        An item is thus searchable seconds after the walk saw it, instead of
+        after all items were analysed. HTTP is done with :mod:`aiohttp`, DB
+        work in a pool of threads with a session each.
+
+        Items that fail are logged and left for the next run. Deletions, and
+        items that failed to index, are handled by a regular
+        :meth:`stoma.indexer.Indexer.index` at the end.
+
+        :param lgg: Logger
+        :param walker: Instance of :class:`stoma.walker.Walker`
+        :param analyser: Instance of :class:`stoma.analyser.Analyser`, whose
+            Tika client and digest setting are used.
+        :param indexer: Instance of :class:`stoma.indexer.Indexer`
+        :param concurrency: Number of concurrent Tika requests.
+        :param queue_size: Maximum length of each queue.
+        :param bulk_interval: Maximum number of seconds a document waits for
+            more to fill a bulk request.
+        """
+        if aiohttp is None:
+            raise ImportError('Pipeline needs package aiohttp')
+        self.lgg = lgg
+        self.walker = walker
+        self.analyser = analyser
+        self.indexer = indexer
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.bulk_interval = bulk_interval
+        self.tika_url = analyser.tika.url
+        self.ela_url = indexer.ela.url
+        self._timeout = analyser.tika.timeout
+        self._local = threading.local()
+        self._sessions = []
+        self._loop = None
+        self._db_pool = None
+        self._http = None
+        self._ana_q = None
+        self._ixr_q = None
+        self.n_analysed = 0
+        self.n_indexed = 0
+
+    def run(self, start_dir):
+        """
+        Runs the pipeline on ``start_dir``.
+
+        Do not call this within a transaction.
+
+        :param start_dir: Directory to start with.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._run(start_dir))
+        finally:
+            loop.close()
+            for sess in self._sessions:
+                sess.close()
+            self._sessions = []
+        self.lgg.info('Pipeline analysed {} and indexed {} items'.format(
+            self.n_analysed, self.n_indexed))
+        with transaction.manager:
+            self.indexer.index()
+
+    async def _run(self, start_dir):
+        self._loop = asyncio.get_event_loop()
+        self._ana_q = asyncio.Queue(maxsize=self.queue_size)
+        self._ixr_q = asyncio.Queue(maxsize=self.queue_size)
+        connect_timeout, read_timeout = self._timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+            sock_read=read_timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency + 1)
+        self._db_pool = ThreadPoolExecutor(max_workers=self.concurrency + 1)
+        try:
+            async with aiohttp.ClientSession(connector=connector,
+                    timeout=timeout) as http:
+                self._http = http
+                analysers = [asyncio.ensure_future(self._analyse_stage())
+                    for _ in range(self.concurrency)]
+                ixr = asyncio.ensure_future(self._index_stage())
+                try:
+                    await self._loop.run_in_executor(None, self._walk,
+                        start_dir)
+                    # Pick up items left over from previous runs
+                    await self._ana_q.join()
+                    await self._sweep()
+                    for _ in analysers:
+                        await self._ana_q.put(_DONE)
+                    await asyncio.gather(*analysers)
+                    await self._ixr_q.put(_DONE)
+                    await ixr
+                except BaseException:
+                    for f in analysers + [ixr]:
+                        f.cancel()
+                    raise
+        finally:
+            self._db_pool.shutdown()
+
+    # ===[ WALK ]=======
+
+    def _walk(self, start_dir):
+        w = self.walker
+        w.on_batch = self._walk_batch
+        transaction.begin()
+        try:
+            w.walk_streaming(start_dir)
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            self.lgg.error('Transaction aborted')
+            raise
+        finally:
+            w.on_batch = None
+
+    def _walk_batch(self, paths):
+        transaction.commit()
+        transaction.begin()
+        # Blocks while the queue is full
+        asyncio.run_coroutine_threadsafe(self._put_many(paths),
+            self._loop).result()
+
+    async def _put_many(self, paths):
+        for p in paths:
+            await self._ana_q.put(p)
+        QUEUE_DEPTH.set(self._ana_q.qsize(), queue='analyse')
+
+    async def _sweep(self):
+        batch_size = self.walker.batch_size
+        last = ''
+        while True:
+            paths = await self._db(self._pending_paths, last, batch_size)
+            if not paths:
+                break
+            await self._put_many(paths)
+            last = paths[-1]
+
+    @staticmethod
+    def _pending_paths(sess, last, limit):
+        rs = sess.query(Item.path).filter(
+            Item.state == ITEM_STATE_NEED_ANALYSIS,
+            Item.path > last
+        ).order_by(Item.path).limit(limit)
+        return [r.path for r in rs]
+
+    # ===[ ANALYSE ]=======
+
+    async def _analyse_stage(self):
+        while True:
+            p = await self._ana_q.get()
+            QUEUE_DEPTH.set(self._ana_q.qsize(), queue='analyse')
+            try:
+                if p is _DONE:
+                    return
+                await self._analyse(p)
+            except Exception as exc:
+                self.lgg.error("Failed to analyse '{}': {}".format(p, exc))
+            finally:
+                self._ana_q.task_done()
+
+    async def _analyse(self, p):
+        r = await self._db(self._claim, p)
+        if r is None:
+            # Already claimed
+            return
+        backend = 'reuse'
+        t0 = time.perf_counter()
+        if isinstance(r, str):
+            ext = self.analyser.extractors
+            if ext is not None and r == MIME_TYPE_UNKNOWN:
+                # Detection was deferred by the walker
+                r = await self._loop.run_in_executor(None,
+                    guess_from_content, p)
+            backend = 'local' if ext is not None \
+                and ext.find(r) is not None else 'tika'
+            try:
+                m = await self._extract(p, r)
+            except Exception:
+                await self._db(self._release, p)
+                raise
+            r = await self._db(self._save_result, p, m)
+        ANALYSE_SECONDS.observe(time.perf_counter() - t0, backend=backend)
+        ANALYSED_ITEMS.inc(backend=backend)
+        self.n_analysed += 1
+        await self._ixr_q.put(r)
+        QUEUE_DEPTH.set(self._ixr_q.qsize(), queue='index')
+
+    def _claim(self, sess, p):
+        """
+        Claims an item for analysis.
+
+        :return: None if item is not pending, a tuple (path, ela_id, document)
+            if results of an item with the same content were reused, else
+            the mime type of the item to choose the extractor by; '' if
+            unknown or if there are no local extractors.
+        """
+        n = sess.query(Item).filter(
+            Item.path == p,
+            Item.state == ITEM_STATE_NEED_ANALYSIS
+        ).update(dict(lease(self.analyser.lease_seconds),
+            state=ITEM_STATE_ANALYSING), synchronize_session=False)
+        if not n:
+            return None
+        mark_changed(sess)
+        if self.analyser.digest:
+            ana = self._local.analyser
+            it = sess.query(Item).get(p)
+            m = ana.find_analysed(it)
+            if m is not None:
+                ana.set_result(it, m)
+                sess.flush()
+                return p, it.ela_id, document(it)
+        if self.analyser.extractors is None:
+            return ''
+        mt = sess.query(Item.mime_type).filter(Item.path == p).scalar()
+        return mt if mt else ''
+
+    @staticmethod
+    def _release(sess, p):
+        sess.query(Item).filter(
+            Item.path == p,
+            Item.state == ITEM_STATE_ANALYSING
+        ).update(dict(NO_LEASE, state=ITEM_STATE_NEED_ANALYSIS),
+            synchronize_session=False)
+        mark_changed(sess)
+
+    def _save_result(self, sess, p, m):
+        it = sess.query(Item).get(p)
+        self._local.analyser.set_result(it, m)
+        sess.flush()
+        return p, it.ela_id, document(it)
+
+    @contextlib.contextmanager
+    def _tika_url(self):
+        """Yields base URL of Tika, an endpoint of its pool if it has one."""
+        pool = self.analyser.tika.pool
+        if pool is None:
+            yield self.tika_url
+            return
+        ep = pool.acquire()
+        ok = True
+        try:
+            yield ep.url
+        except Exception as exc:
+            ok = not _endpoint_failed(exc)
+            raise
+        finally:
+            pool.release(ep, ok)
+
+    async def _tika_put(self, path, op, headers, fn=None, data=None,
+            as_json=False):
+        """
+        PUTs a file or data to Tika and returns the body of the response.
+
+        Like :meth:`stoma.tika.TikaRestClient._request`, a request whose
+        endpoint of the pool is unreachable, times out or answers with a
+        status of ``RETRY_STATUS`` is sent to another endpoint, up to once
+        per endpoint.
+
+        :param path: Path of URL.
+        :param op: Name of the operation for metrics.
+        :param headers: Dict of header fields.
+        :param fn: Name of a file to send as body...
+        :param data: ...or the body.
+        :param as_json: Whether to decode the body as JSON, else as text.
+        """
+        pool = self.analyser.tika.pool
+        n = len(pool) if pool is not None else 1
+        for i in range(n):
+            try:
+                with contextlib.ExitStack() as stack:
+                    url = stack.enter_context(self._tika_url())
+                    # Opened per attempt, a retry must send the file from
+                    # its start
+                    body = stack.enter_context(open(fn, 'rb')) \
+                        if fn is not None else data
+                    t0 = time.perf_counter()
+                    async with self._http.put(url + path, data=body,
+                            headers=headers) as r:
+                        r.raise_for_status()
+                        if as_json:
+                            res = await r.json(content_type=None)
+                        else:
+                            res = await r.text()
+                    HTTP_SECONDS.observe(time.perf_counter() - t0,
+                        service='tika',
+                        endpoint=urllib.parse.urlsplit(url).netloc, op=op)
+                    return res
+            except Exception as exc:
+                if i == n - 1 or not _endpoint_failed(exc):
+                    raise
+                mlgg.warning('{}; trying another Tika endpoint'.format(
+                    exc))
+
+    async def _extract(self, p, mime_type):
+        ext = self.analyser.extractors
+        func = ext.find(mime_type) if ext is not None else None
+        if func is not None:
+            m = await self._loop.run_in_executor(ext.executor, func, p,
+                mime_type, ext.max_text_size)
+        else:
+            m = await self._rmeta(p)
+        s = m['data_text']
+        if s:
+            s = await self._tika_put('/language/string', 'language',
+                headers={'content-type': 'text/plain; charset=utf-8'},
+                data=s[:LANGUAGE_SAMPLE_SIZE].encode('utf-8'))
+            m['language'] = s if s else None
+        return m
+
+    async def _rmeta(self, p):
+        tika = self.analyser.tika
+        hh = {'content-disposition': 'attachment; filename={}'.format(p)}
+        meta_only = tika.is_too_large(p)
+        if meta_only:
+            path = '/rmeta/ignore'
+        else:
+            path = '/rmeta/html'
+            if tika.max_text_size:
+                hh['writeLimit'] = str(tika.max_text_size)
+        docs = await self._tika_put(path, 'rmeta', headers=hh, fn=p,
+            as_json=True)
+        # Parsing HTML may take a while, keep the loop responsive
+        m = await self._loop.run_in_executor(None, bundle_from_rmeta, docs,
+            tika.max_text_size)
+        if meta_only:
+            m['truncated'] = True
+        return m
+
+    # ===[ INDEX ]=======
+
+    async def _index_stage(self):
+        batch = []
+        done = False
+        while not done:
+            try:
+                x = await asyncio.wait_for(self._ixr_q.get(),
+                    timeout=self.bulk_interval if batch else None)
+            except asyncio.TimeoutError:
+                x = None
+            if x is _DONE:
+                done = True
+            elif x is not None:
+                batch.append(x)
+            QUEUE_DEPTH.set(self._ixr_q.qsize(), queue='index')
+            if batch and (done or x is None
+                    or len(batch) >= self.indexer.bulk_docs):
+                try:
+                    await self._bulk(batch)
+                except Exception as exc:
+                    self.lgg.error('Failed to index {} items: {}'.format(
+                        len(batch), exc))
+                batch = []
+
+    async def _bulk(self, batch):
+        ixr = self.indexer
+        actions = [ixr.index_action(ela_id, doc) for _, ela_id, doc in batch]
+        results = []
+        for chunks in bulk_chunks(actions, ixr.bulk_docs, ixr.bulk_bytes):
+            with ELA_BULK_SECONDS.time():
+                async with self._http.post(self.ela_url + '/_bulk',
+                        data=b''.join(chunks),
+                        headers={'content-type': 'application/x-ndjson'}
+                        ) as r:
+                    r.raise_for_status()
+                    rr = bulk_results(await r.text())
+            ELA_BULK_ACTIONS.inc(len(rr))
+            results += rr
+        paths = [p for p, _, _ in batch]
+        self.n_indexed += await self._db(self._apply_index_results, paths,
+            results)
+
+    def _apply_index_results(self, sess, paths, results):
+        return self._local.indexer.apply_index_results(paths, results)
+
+    # ===[ DB ]=======
+
+    async def _db(self, func, *args):
+        """Runs ``func(sess, *args)`` in a transaction of a DB thread."""
+        return await self._loop.run_in_executor(self._db_pool,
+            self._in_transaction, func, *args)
+
+    def _in_transaction(self, func, *args):
+        local = self._local
+        if not hasattr(local, 'sess'):
+            local.sess = DbSession()
+            self._sessions.append(local.sess)
+            local.analyser = Analyser(lgg=self.lgg, sess=local.sess,
+                tika=None, digest=self.analyser.digest,
+                compression=self.analyser.compression)
+            local.indexer = Indexer(lgg=self.lgg, sess=local.sess,
+                ela=None, index=self.indexer.index_name,
+                doc_type=self.indexer.doc_type)
+        with transaction.manager:
+            return func(local.sess, *args)
@@ -0,0 +1,187 @@
+import sqlalchemy as sa
+
+from .models import Item
+
+
+POLICY_PATH = 'path'
+POLICY_SMALLEST = 'smallest'
+POLICY_RECENT = 'recent'
+POLICIES = (POLICY_PATH, POLICY_SMALLEST, POLICY_RECENT)
+
+DEFAULT_LANE = 'default'
+
+
+def mime_type_crit(patterns):
+    """
+    Returns a filter criterion for mime types.
+
+    :param patterns: List of mime types, or patterns like 'video/*'.
+    :return: SQL expression, None if ``patterns`` is empty.
+    """
+    exact = [p.lower() for p in patterns if not p.endswith('*')]
+    prefixes = [p[:-1].lower() for p in patterns if p.endswith('*')]
+    crit = [Item.mime_type.startswith(p, autoescape=True) for p in prefixes]
+    if exact:
+        crit.append(Item.mime_type.in_(exact))
+    if not crit:
+        return None
+    return sa.or_(*crit)
+
+
+class Lane:
+
+    def __init__(self, name, mime_types=None, min_size=None, workers=1):
+        """
+        A lane of analysis with its own workers.
+
+        An item goes into the lane if its mime type matches or its size is
+        at least ``min_size``.
+
+        :param name: Name of the lane, for logging.
+        :param mime_types: List of mime types, or patterns like 'video/*'.
+        :param min_size: Minimum size in bytes.
+        :param workers: Number of threads that analyse the lane.
+        """
+        self.name = name
+        self.mime_types = list(mime_types) if mime_types else []
+        self.min_size = min_size
+        self.workers = workers
+
+    def __repr__(self):
+        return '<Lane {}>'.format(self.name)
+
+    def crit(self):
+        """Returns the filter criterion of items in this lane."""
+        crit = []
+        mt = mime_type_crit(self.mime_types)
+        if mt is not None:
+            crit.append(mt)
+        if self.min_size is not None:
+            crit.append(Item.size >= self.min_size)
+        if not crit:
+            return sa.false()
+        return sa.or_(*crit)
+
+
+class Scheduler:
+
+    def __init__(self, policy=POLICY_PATH, weights=None, lanes=None):
+        """
+        Decides in which order and lane pending items are analysed.
+
+        Items are taken by descending weight of their mime type first, then
+        by ``policy``:
+
+        - ``path``: In order of their path, i.e. directory by directory.
+        - ``smallest``: Smallest files first, so that many small documents
+          are not held up by a few huge ones.
+        - ``recent``: Most recently modified files first.
+
+        Oversized or slow types can be put into lanes. Each lane is
+        analysed by its own workers, so it cannot take up the workers of
+        the default lane. An item that matches several lanes goes into the
+        first one. Without parallel workers, the items of lanes come last.
+
+        :param policy: One of ``POLICIES``.
+        :param weights: Dict mapping mime types, or patterns like 'image/*',
+            to weights. Types not given have weight 1, higher weights come
+            first. Exact types win over patterns.
+        :param lanes: List of instances of :class:`Lane`.
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unknown scheduling policy '{}'".format(policy))
+        self.policy = policy
+        self.weights = dict(weights) if weights else {}
+        self.lanes = list(lanes) if lanes else []
+
+    @classmethod
+    def from_rc(cls, rc):
+        """
+        Creates a scheduler from settings.
+
+        Reads keys ``schedule.policy``, ``schedule.weights`` and
+        ``schedule.lanes``, see ``etc/rc.yaml``.
+
+        :param rc: Instance of :class:`pym.rc.Rc`.
+        """
+        lanes = []
+        for name, v in (rc.g('schedule.lanes', None) or {}).items():
+            min_size = v.get('min_size')
+            lanes.append(Lane(name,
+                mime_types=v.get('mime_types'),
+                min_size=int(min_size) if min_size is not None else None,
+                workers=int(v.get('workers', 1))))
+        weights = {k: float(v) for k, v
+            in (rc.g('schedule.weights', None) or {}).items()}
+        return cls(policy=rc.g('schedule.policy', POLICY_PATH) or POLICY_PATH,
+            weights=weights, lanes=lanes)
+
+    def uses_mime_type(self):
+        """Tells whether weights or lanes depend on the mime type."""
+        return bool(self.weights) or any(lane.mime_types
+            for lane in self.lanes)
+
+    def weight(self):
+        """Returns an SQL expression of the weight of an item."""
+        if not self.weights:
+            return None
+        # Exact types first, longer patterns before shorter ones
+        keys = sorted(self.weights, key=lambda k: (k.endswith('*'), -len(k)))
+        whens = []
+        for k in keys:
+            if k.endswith('*'):
+                c = Item.mime_type.startswith(k[:-1].lower(), autoescape=True)
+            else:
+                c = Item.mime_type == k.lower()
+            whens.append((c, self.weights[k]))
+        return sa.case(whens, else_=1.0)
+
+    def order_by(self, lanes=True):
+        """
+        Returns list of ORDER BY clauses to take pending items in.
+
+        Only the order of the policy can be served by the partial indexes of
+        pending items. Weights are computed per row, so all pending rows are
+        sorted.
+
+        :param lanes: Whether to put items of lanes last. Not needed if the
+            query is filtered by the criterion of a lane already, as in
+            :meth:`stoma.analyser.Analyser.claim`.
+        """
+        order = []
+        if lanes and self.lanes:
+            order.append(sa.case([(self.lanes_crit(), 1)], else_=0))
+        w = self.weight()
+        if w is not None:
+            order.append(w.desc())
+        if self.policy == POLICY_SMALLEST:
+            order.append(Item.size)
+        elif self.policy == POLICY_RECENT:
+            order.append(Item.item_mtime.desc())
+        # Stable order for items that compare equal
+        order.append(Item.path)
+        return order
+
+    def lanes_crit(self):
+        """Returns criterion of items in any lane."""
+        return sa.or_(*[lane.crit() for lane in self.lanes])
+
+    def lane_filters(self):
+        """
+        Returns filter criteria of the lanes.
+
+        :return: List of tuples (name, workers, criterion). The default
+            lane comes first, with ``workers`` None for the caller's
+            default; its criterion is None if there are no lanes.
+        """
+        if not self.lanes:
+            return [(DEFAULT_LANE, None, None)]
+        ff = [(DEFAULT_LANE, None, sa.not_(self.lanes_crit()))]
+        prev = []
+        for lane in self.lanes:
+            c = lane.crit()
+            if prev:
+                c = sa.and_(c, sa.not_(sa.or_(*prev)))
+            prev.append(lane.crit())
+            ff.append((lane.name, lane.workers, c))
+        return ff
@@ -1,5 +1,6 @@
 import argparse
 import datetime
+import json
 import logging
 import os
 import sys
@@ -11,10 +12,24 @@ import transaction
 from zope.sqlalchemy import mark_changed
 
 from ..elastics import ElasticSearchRestClient
+from ..elastics import DEFAULT_READ_TIMEOUT as ELA_READ_TIMEOUT
+from ..httpclient import create_session, session_from_rc
+from ..checkpoint import Checkpoint
+from ..codec import check_compression
+from ..extractors import ExtractorRegistry
+from ..lease import Reaper, DEFAULT_LEASE_SECONDS
+from ..metrics import (REGISTRY, Exporter, instrument_db, instrument_session,
+    ela_op)
+from ..scheduler import Scheduler
 from ..cli import Cli
-from ..models import create_all, Item
+from ..models import create_all, Item, DbSession
 from ..walker import Walker
-from ..tika import TikaRestClient
+from ..watcher import Watcher
+from ..pipeline import Pipeline
+from ..tika import (TikaRestClient, EXTRACT_MODE_CLASSIC,
+    DEFAULT_MAX_TEXT_SIZE, DEFAULT_MAX_FILE_SIZE)
+from ..tikapool import (TikaPool, parse_endpoints, DEFAULT_CHECK_INTERVAL,
+    DEFAULT_MAX_FAILURES, DEFAULT_EJECT_SECONDS)
 from ..analyser import Analyser
 from ..indexer import Indexer
 from ..const import DEFAULT_INDEX
@@ -23,6 +38,9 @@ from ..const import DEFAULT_INDEX
 class Runner(Cli):
     def __init__(self):
         super().__init__()
+        self._walker = None
+        self._extractors = None
+        self._tika_pool = None
 
     def init_app(self, args, lgg=None, rc=None, rc_key=None, setup_logging=True):
         super().init_app(args=args, lgg=lgg, rc=rc, rc_key=rc_key,
@@ -50,56 +68,202 @@ class Runner(Cli):
 
     def cmd_index(self):
         self.lgg.info('Indexing')
+        w, ana, ixr = self._init_workers()
+
+        if self.args.pipeline:
+            pipe = Pipeline(lgg=self.lgg, walker=w, analyser=ana, indexer=ixr,
+                concurrency=self.args.concurrency)
+            pipe.run(self.args.start_dir)
+            return
+
+        if self.args.resume:
+            self.lgg.info('Resuming, skipping walk')
+        else:
+            transaction.begin()
+            try:
+                if self.args.stream:
+                    # Keep saved batches if the walk is interrupted
+                    w.on_batch = lambda paths: ana.checkpoint.commit()
+                    w.walk_streaming(self.args.start_dir)
+                else:
+                    w.walk(self.args.start_dir)
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                self.lgg.error('Transaction aborted')
+                raise
+            finally:
+                w.on_batch = None
+
+        if w.defer_mime and ana.scheduler.uses_mime_type():
+            # Lanes and weights need the type before analysis
+            transaction.begin()
+            try:
+                w.detect_deferred()
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                self.lgg.error('Transaction aborted')
+                raise
+
+        if ana.workers > 1:
+            ana.analyse_parallel()
+        else:
+            transaction.begin()
+            try:
+                ana.analyse()
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                self.lgg.error('Transaction aborted')
+                raise
+
+        transaction.begin()
+        try:
+            ixr.index()
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            self.lgg.error('Transaction aborted')
+            raise
+
+    def cmd_watch(self):
+        self.lgg.info('Watching')
+        w, ana, ixr = self._init_workers()
+        watcher = Watcher(lgg=self.lgg, walker=w, analyser=ana, indexer=ixr,
+            debounce=self.args.debounce, max_delay=self.args.max_delay)
+        try:
+            watcher.watch(self.args.start_dir)
+        except KeyboardInterrupt:
+            self.lgg.info('Interrupted')
+
+    def _init_workers(self):
         __ = logging.getLogger('requests.packages.urllib3.connectionpool')
         __.setLevel(logging.WARN)
 
-        tika = TikaRestClient()
+        tika = self._create_tika()
         if not tika.is_running():
             raise Exception('Tika server is not running')
         self.lgg.debug(tika.version())
-        ela = ElasticSearchRestClient(lgg=self.lgg)
+        ela = self._create_ela()
         if not ela.is_running():
             raise Exception('ElasticSearch server is not running')
         self.lgg.debug(ela.version())
         self.lgg.debug(ela.count())
 
-        w = Walker(lgg=self.lgg, sess=self.sess)
-        ana = Analyser(lgg=self.lgg, sess=self.sess, tika=tika)
-        ixr = Indexer(lgg=self.lgg, sess=self.sess, ela=ela)
+        w = Walker(lgg=self.lgg, sess=self.sess,
+            walk_workers=self.args.walk_workers,
+            batch_size=self.args.batch_size,
+            full_scan=self.args.full_scan,
+            digest=self.args.digest,
+            defer_mime=self.args.defer_mime)
+        self._walker = w
+        checkpoint = Checkpoint.from_rc(self.lgg, self.rc)
+        compression = self.rc.g('content.compression', None) or None
+        check_compression(compression)
+        ana = Analyser(lgg=self.lgg, sess=self.sess, tika=tika,
+            digest=self.args.digest, workers=self.args.analyse_workers,
+            checkpoint=checkpoint,
+            lease_seconds=int(self.rc.g('lease.seconds',
+                DEFAULT_LEASE_SECONDS)),
+            compression=compression,
+            extractors=self._create_extractors(tika),
+            scheduler=Scheduler.from_rc(self.rc))
+        ixr = Indexer(lgg=self.lgg, sess=self.sess, ela=ela,
+            checkpoint=checkpoint)
 
-        transaction.begin()
-        try:
-            w.walk(self.args.start_dir)
-            transaction.commit()
-        except Exception:
-            transaction.abort()
-            self.lgg.error('Transaction aborted')
-            raise
+        # Take back items from crashed workers
+        self._reap()
+        return w, ana, ixr
 
-        transaction.begin()
-        try:
-            ana.analyse()
-            transaction.commit()
-        except Exception:
-            transaction.abort()
-            self.lgg.error('Transaction aborted')
-            raise
+    def cmd_reap(self):
+        self.lgg.info('Reaping items with expired lease')
+        self._reap()
 
-        transaction.begin()
-        try:
-            ixr.index()
-            transaction.commit()
-        except Exception:
-            transaction.abort()
-            self.lgg.error('Transaction aborted')
-            raise
+    def _reap(self):
+        with transaction.manager:
+            n = Reaper(lgg=self.lgg, sess=self.sess).reap()
+        self.lgg.info('Reaped {} items'.format(n))
+
+    def _create_tika(self):
+        rc = self.rc
+        session, timeout = session_from_rc(rc, 'tika.')
+        instrument_session(session, 'tika')
+        host = rc.g('tika.host', 'localhost')
+        port = int(rc.g('tika.port', 9998))
+        pool = None
+        endpoints = parse_endpoints(rc.g('tika.endpoints', None) or [])
+        if endpoints:
+            pool = TikaPool(
+                endpoints,
+                # Without retries, so that a dead endpoint is ejected at once
+                session=create_session(retries=0),
+                check_interval=float(rc.g('tika.check_interval',
+                    DEFAULT_CHECK_INTERVAL)),
+                max_failures=int(rc.g('tika.max_failures',
+                    DEFAULT_MAX_FAILURES)),
+                eject_seconds=float(rc.g('tika.eject_seconds',
+                    DEFAULT_EJECT_SECONDS))
+            )
+            pool.start()
+            self._tika_pool = pool
+            host, port = endpoints[0]
+        return TikaRestClient(
+            host=host,
+            port=port,
+            extract_mode=rc.g('tika.extract_mode', EXTRACT_MODE_CLASSIC),
+            session=session,
+            timeout=timeout,
+            max_text_size=int(rc.g('tika.max_text_size',
+                DEFAULT_MAX_TEXT_SIZE)),
+            max_file_size=int(rc.g('tika.max_file_size',
+                DEFAULT_MAX_FILE_SIZE)),
+            pool=pool
+        )
+
+    def _create_extractors(self, tika):
+        rc = self.rc
+        if not rc.g('extract.local', False):
+            return None
+        workers = rc.g('extract.workers', None)
+        self._extractors = ExtractorRegistry(tika,
+            workers=int(workers) if workers else None)
+        return self._extractors
+
+    def close_workers(self):
+        """
+        Stops the threads of the walker and of the health checks of Tika
+        endpoints, and the worker processes of local extractors.
+        """
+        if self._tika_pool is not None:
+            self._tika_pool.close()
+            self._tika_pool = None
+        if self._walker is not None:
+            self._walker.close()
+            self._walker = None
+        if self._extractors is not None:
+            self._extractors.close()
+            self._extractors = None
+
+    def _create_ela(self):
+        rc = self.rc
+        session, timeout = session_from_rc(rc, 'elasticsearch.',
+            read_timeout=ELA_READ_TIMEOUT)
+        instrument_session(session, 'elasticsearch', op_of=ela_op)
+        return ElasticSearchRestClient(
+            lgg=self.lgg,
+            host=rc.g('elasticsearch.host', 'localhost'),
+            port=int(rc.g('elasticsearch.port', 9200)),
+            session=session,
+            timeout=timeout
+        )
 
     def cmd_drop(self):
         self.lgg.info('Dropping index and database cache')
         __ = logging.getLogger('requests.packages.urllib3.connectionpool')
         __.setLevel(logging.WARN)
 
-        ela = ElasticSearchRestClient(lgg=self.lgg)
+        ela = self._create_ela()
         if not ela.is_running():
             raise Exception('ElasticSearch server is not running')
         self.lgg.debug(ela.version())
@@ -123,6 +287,52 @@ def parse_args(runner, argv):
     runner.parser = p
     runner.add_parser_args(p, (('config', True), ('format', False),
         ('locale', False), ('verbose', False), ('alembic-config', False)))
+    p.add_argument(
+        '--metrics-file',
+        metavar='FILE',
+        help="""Write metrics in Prometheus text format to this file,
+            periodically and at the end, e.g. for the textfile collector of
+            node exporter."""
+    )
+    p.add_argument(
+        '--metrics-port',
+        type=int,
+        metavar='PORT',
+        help="""Serve metrics on http://127.0.0.1:PORT/metrics while
+            running."""
+    )
+    p.add_argument(
+        '--metrics-json',
+        metavar='FILE',
+        help="""Write a JSON summary of the metrics to this file at the
+            end. The summary is logged in any case."""
+    )
+
+    # Common arguments of 'index' and 'watch'
+    p_walk = argparse.ArgumentParser(add_help=False)
+    p_walk.add_argument(
+        '--digest',
+        metavar='ALGORITHM',
+        help="""Compute content digests with this algorithm, e.g. blake2b,
+            to skip analysis of files whose content did not change, or
+            whose content was already analysed at another path."""
+    )
+    p_walk.add_argument(
+        '--defer-mime',
+        action='store_true',
+        help="""Do not read files to detect their mime type during the walk.
+            Files without a known extension are typed by analysis instead,
+            so that the walk only reads metadata."""
+    )
+    p_walk.add_argument(
+        '--analyse-workers',
+        type=int,
+        default=1,
+        metavar='N',
+        help="""Number of threads to analyse files with. With more than 1,
+            items are claimed in small batches and committed one by one, so
+            that several processes may share a database. Default: 1"""
+    )
 
     sp = p.add_subparsers(
         title="Commands",
@@ -140,7 +350,7 @@ def parse_args(runner, argv):
 
     p_index = sp.add_parser(
         'index',
-        parents=[],
+        parents=[p_walk],
         help="Index filesystem tree",
         add_help=True
     )
@@ -149,6 +359,104 @@ def parse_args(runner, argv):
         'start_dir',
         help="""Path to start directory."""
     )
+    p_index.add_argument(
+        '--walk-workers',
+        type=int,
+        default=1,
+        metavar='N',
+        help="""Number of threads to walk the filesystem with. Default: 1"""
+    )
+    p_index.add_argument(
+        '--stream',
+        action='store_true',
+        help="""Walk in sorted order and save changes in batches, so that
+            memory does not grow with the size of the tree."""
+    )
+    p_index.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        metavar='N',
+        help="""Number of changes per batch in streaming mode. Default: 1000"""
+    )
+    p_index.add_argument(
+        '--resume',
+        action='store_true',
+        help="""Skip the walk, only analyse and index items left pending by
+            an interrupted run. A run without this option also resumes
+            pending items, but walks first."""
+    )
+    p_index.add_argument(
+        '--pipeline',
+        action='store_true',
+        help="""Walk, analyse and index concurrently, so that items become
+            searchable while the walk is still running. Implies --stream and
+            Tika's rmeta extraction. Needs package aiohttp."""
+    )
+    p_index.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        metavar='N',
+        help="""Number of concurrent Tika requests in pipeline mode.
+            Default: 8"""
+    )
+    p_index.add_argument(
+        '--full-scan',
+        action='store_true',
+        help="""List all directories. By default, directories whose mtime
+            did not change since the last walk are skipped, which misses files
+            modified in place."""
+    )
+
+    p_watch = sp.add_parser(
+        'watch',
+        parents=[p_walk],
+        help="Watch filesystem tree and index changes continuously",
+        add_help=True
+    )
+    p_watch.set_defaults(func=runner.cmd_watch)
+    p_watch.add_argument(
+        'start_dir',
+        help="""Path to start directory."""
+    )
+    p_watch.add_argument(
+        '--walk-workers',
+        type=int,
+        default=1,
+        metavar='N',
+        help="""Number of threads for the initial walk. Default: 1"""
+    )
+    p_watch.add_argument(
+        '--full-scan',
+        action='store_true',
+        help="""List all directories on the initial walk."""
+    )
+    p_watch.add_argument(
+        '--debounce',
+        type=float,
+        default=2.0,
+        metavar='SECONDS',
+        help="""Process changes after no event arrived for this long.
+            Default: 2"""
+    )
+    p_watch.add_argument(
+        '--max-delay',
+        type=float,
+        default=30.0,
+        metavar='SECONDS',
+        help="""Process changes at the latest this long after their first
+            event. Default: 30"""
+    )
+    p_watch.set_defaults(batch_size=1000)
+
+    p_reap = sp.add_parser(
+        'reap',
+        parents=[],
+        help="Put items of crashed workers back into pending state",
+        add_help=True
+    )
+    p_reap.set_defaults(func=runner.cmd_reap)
 
     p_drop = sp.add_parser(
         'drop',
@@ -169,9 +477,16 @@ def main(argv=None):
     app_name = os.path.basename(argv[0])
     lgg = logging.getLogger('cli.' + app_name)
 
+    runner = None
+    exporter = None
+    args = None
     try:
         runner = Runner()
         args = parse_args(runner, argv)
+        instrument_db(DbSession)
+        exporter = Exporter(textfile=args.metrics_file,
+            port=args.metrics_port)
+        exporter.start()
 
         runner.init_app(args, lgg=lgg, setup_logging=True)
         if hasattr(args, 'func'):
@@ -184,6 +499,15 @@ def main(argv=None):
     else:
         lgg.info('Finished.')
     finally:
+        if runner is not None:
+            runner.close_workers()
+        if exporter is not None:
+            exporter.close()
+        summary = json.dumps(REGISTRY.summary(), sort_keys=True)
+        lgg.info('Metrics: {}'.format(summary))
+        if args is not None and args.metrics_json:
+            with open(args.metrics_json, 'w', encoding='utf-8') as fh:
+                fh.write(summary)
         lgg.info('Time taken: {}'.format(
             datetime.timedelta(seconds=time.time() - start_time))
         )
@@ -0,0 +1,48 @@
+"""
+Tests of :func:`stoma.models.below` on SQLite.
+"""
+import unittest
+
+import sqlalchemy as sa
+
+from stoma.models import below
+
+
+def _bytewise(a, b):
+    return (a > b) - (a < b)
+
+
+class BelowTest(unittest.TestCase):
+
+    PATHS = ['/data', '/data/foo', '/data/foo/a', '/data/foo/b/c',
+        '/data/foobar', '/data/foobar/a', '/data/foo-x', '/data/fo%',
+        '/data/fo%/a', '/data/fo_/a', '/data/fooo']
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+
+        @sa.event.listens_for(self.engine, 'connect')
+        def connect(dbapi_conn, rec):
+            dbapi_conn.create_collation('C', _bytewise)
+
+        meta = sa.MetaData()
+        self.t = sa.Table('t', meta, sa.Column('path', sa.Unicode,
+            primary_key=True))
+        meta.create_all(self.engine)
+        self.engine.execute(self.t.insert(), [{'path': p}
+            for p in self.PATHS])
+
+    def below(self, path):
+        q = sa.select([self.t.c.path]).where(below(self.t.c.path, path))
+        return sorted(r.path for r in self.engine.execute(q))
+
+    def test_excludes_siblings(self):
+        self.assertEqual(self.below('/data/foo'),
+            ['/data/foo/a', '/data/foo/b/c'])
+
+    def test_trailing_separator(self):
+        self.assertEqual(self.below('/data/foo/'), self.below('/data/foo'))
+
+    def test_wildcards_are_literal(self):
+        self.assertEqual(self.below('/data/fo%'), ['/data/fo%/a'])
+        self.assertEqual(self.below('/data/fo_'), ['/data/fo_/a'])
@@ -0,0 +1,104 @@
+"""
+Tests of :mod:`stoma.tika` with HTML cut at ``max_text_size`` and files
+larger than ``max_file_size``.
+"""
+import tempfile
+import unittest
+
+from stoma.tika import TikaPymMixin, bundle_from_rmeta, split_html
+
+
+HTML = ('<html xmlns="http://www.w3.org/1999/xhtml"><head>'
+    '<meta name="Content-Type" content="text/plain"/><title>Title</title>'
+    '</head><body><p>Some text</p></body></html>')
+CUT_IN_HEAD = HTML[:HTML.index('<title>') + 9]
+CUT_BEFORE_HEAD = HTML[:HTML.index('<head>') + 3]
+
+
+class FakeTika(TikaPymMixin):
+    """Answers with canned results instead of asking Tika."""
+
+    def __init__(self, html_, max_file_size=0):
+        self.html = html_
+        self.max_file_size = max_file_size
+        self.requests = []
+
+    def rmeta(self, fn, type_=None, hh=None):
+        self.requests.append('rmeta/' + type_)
+        return [{'Content-Type': 'text/plain', 'resourceName': fn}]
+
+    def detect(self, fn, hh):
+        self.requests.append('detect')
+        return 'text/plain'
+
+    def meta(self, fn, type_='json', hh=None):
+        return {'Content-Type': 'text/plain'} if type_ == 'json' else None
+
+    def language(self, fn, hh):
+        return 'en'
+
+    def tika_limited(self, fn, type_='text', hh=None):
+        if type_ == 'html':
+            return self.html, True
+        return 'Some text', True
+
+
+class SplitHtmlTest(unittest.TestCase):
+
+    def test_complete(self):
+        head, body, text = split_html(HTML)
+        self.assertIn('<title>Title</title>', head)
+        self.assertEqual(body, '<body><p>Some text</p></body>')
+        self.assertEqual(text, 'Some text')
+
+    def test_cut_in_head(self):
+        head, body, text = split_html(CUT_IN_HEAD)
+        self.assertIn('<title>Ti', head)
+        self.assertIsNone(body)
+        self.assertIsNone(text)
+
+    def test_cut_before_head(self):
+        head, body, text = split_html(CUT_BEFORE_HEAD)
+        self.assertIsNone(head)
+        self.assertFalse(text)
+
+    def test_empty(self):
+        self.assertEqual(split_html(None), (None, None, None))
+        self.assertEqual(split_html('<!-- only -->'), (None, None, None))
+
+
+class TruncatedHtmlTest(unittest.TestCase):
+
+    def test_pym(self):
+        m = FakeTika(CUT_IN_HEAD).pym('x.txt')
+        self.assertIn('<title>Ti', m['data_html_head'])
+        self.assertIsNone(m['data_html_body'])
+        self.assertEqual(m['data_text'], 'Some text')
+        self.assertTrue(m['truncated'])
+
+    def test_bundle_from_rmeta(self):
+        docs = [{'Content-Type': 'text/plain', 'X-TIKA:content': CUT_IN_HEAD,
+            'X-TIKA:EXCEPTION:write_limit_reached': 'true'},
+            {'X-TIKA:content': HTML}]
+        m = bundle_from_rmeta(docs, max_text_size=100)
+        self.assertIn('<title>Ti', m['data_html_head'])
+        self.assertIsNone(m['data_html_body'])
+        # Text of embedded documents is kept
+        self.assertEqual(m['data_text'], 'Some text')
+        self.assertTrue(m['truncated'])
+
+
+class MetaOnlyTest(unittest.TestCase):
+
+    def test_pym_of_too_large_file(self):
+        tika = FakeTika(HTML, max_file_size=10)
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write(b'x' * 11)
+            fh.flush()
+            m = tika.pym(fh.name)
+        # One request that returns no content
+        self.assertEqual(tika.requests, ['rmeta/ignore'])
+        self.assertEqual(m['mime_type'], 'text/plain')
+        self.assertIsNone(m['data_text'])
+        self.assertIsNone(m['meta_xmp'])
+        self.assertTrue(m['truncated'])
@@ -0,0 +1,181 @@
+"""
+Tests of :mod:`stoma.tikapool` against stub HTTP servers on localhost.
+"""
+import http.server
+import socket
+import threading
+import time
+import unittest
+
+import requests
+
+from stoma.httpclient import create_session
+from stoma.tika import TikaRestClient
+from stoma.tikapool import TikaPool
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.n_requests += 1
+        body = srv.body if srv.status == 200 else b'unavailable'
+        self.send_response(srv.status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, body):
+        """Answers every GET with ``body``, or with :attr:`status`."""
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.body = body
+        self.status = 200
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def endpoint(self):
+        return self.server_address
+
+
+def dead_endpoint():
+    """Returns (host, port) on which nothing listens."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    endpoint = sock.getsockname()
+    sock.close()
+    return endpoint
+
+
+def wait_for(cond, timeout=5.0):
+    t = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > t:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TikaPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        for srv in self.servers:
+            srv.shutdown()
+            srv.server_close()
+
+    def stub(self, body):
+        srv = StubServer(body)
+        self.servers.append(srv)
+        return srv
+
+    def pool(self, endpoints, **kw):
+        kw.setdefault('check_interval', 0)
+        kw.setdefault('session', requests.Session())
+        pool = TikaPool(endpoints, **kw)
+        self.pools.append(pool)
+        return pool
+
+    def client(self, pool):
+        # Without retries of urllib3, so that only the pool retries
+        return TikaRestClient(session=requests.Session(), timeout=2.0,
+            pool=pool)
+
+    def test_least_outstanding(self):
+        a, b = self.stub(b'a'), self.stub(b'b')
+        pool = self.pool([a.endpoint, b.endpoint])
+        tika = self.client(pool)
+        # A request in flight on one endpoint...
+        busy = pool.acquire()
+        idle = b if busy.port == a.endpoint[1] else a
+        # ...sends all others to the idle one
+        for _ in range(4):
+            self.assertEqual(tika.version(), idle.body.decode())
+        self.assertEqual(idle.n_requests, 4)
+        pool.release(busy, True)
+        # Ties are broken round robin
+        for _ in range(4):
+            tika.version()
+        self.assertEqual(a.n_requests + b.n_requests, 8)
+        self.assertEqual(idle.n_requests, 6)
+        self.assertTrue(all(ep.outstanding == 0 for ep in pool.endpoints))
+
+    def test_eject_after_max_failures(self):
+        pool = self.pool([dead_endpoint()], max_failures=2, eject_seconds=60)
+        ep = pool.endpoints[0]
+        for n in (1, 2):
+            with self.assertRaises(requests.ConnectionError):
+                with pool.endpoint() as x:
+                    requests.get(x.url + '/version', timeout=2.0)
+            self.assertEqual(ep.failures, n)
+            self.assertEqual(ep.ejected_until is not None, n == 2)
+        self.assertEqual(ep.outstanding, 0)
+
+    def test_failover_from_dead_endpoint(self):
+        live = self.stub(b'live')
+        pool = self.pool([dead_endpoint(), live.endpoint], max_failures=2)
+        dead = pool.endpoints[0]
+        tika = self.client(pool)
+        for _ in range(6):
+            self.assertEqual(tika.version(), 'live')
+        self.assertEqual(live.n_requests, 6)
+        self.assertIsNotNone(dead.ejected_until)
+
+    def test_failover_from_unavailable_endpoint(self):
+        busy, live = self.stub(b'busy'), self.stub(b'live')
+        busy.status = 503
+        pool = self.pool([busy.endpoint, live.endpoint], max_failures=2)
+        tika = self.client(pool)
+        for _ in range(6):
+            self.assertEqual(tika.version(), 'live')
+        self.assertEqual(live.n_requests, 6)
+        # Ejected after two 503, so not asked again
+        self.assertEqual(busy.n_requests, 2)
+        self.assertIsNotNone(pool.endpoints[0].ejected_until)
+
+    def test_last_endpoint_answers_status(self):
+        busy = self.stub(b'busy')
+        busy.status = 503
+        tika = self.client(self.pool([busy.endpoint]))
+        r = tika._request('GET', '/version')
+        self.assertEqual(r.status_code, 503)
+
+    def test_health_check_takes_back(self):
+        srv = self.stub(b'ok')
+        pool = self.pool([srv.endpoint], check_interval=0.05,
+            eject_seconds=60)
+        ep = pool.endpoints[0]
+        pool.start()
+        srv.status = 503
+        self.assertTrue(wait_for(lambda: ep.ejected_until is not None))
+        srv.status = 200
+        self.assertTrue(wait_for(lambda: ep.ejected_until is None))
+        self.assertEqual(ep.failures, 0)
+        self.assertTrue(pool.is_running())
+
+    def test_health_check_does_not_retry(self):
+        srv = self.stub(b'ok')
+        srv.status = 503
+        pool = self.pool([srv.endpoint], session=create_session(retries=0))
+        self.assertFalse(pool.check(pool.endpoints[0]))
+        self.assertEqual(srv.n_requests, 1)
+        self.assertIsNotNone(pool.endpoints[0].ejected_until)
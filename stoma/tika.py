@@ -1,65 +1,245 @@
-import io
+import codecs
 import logging
+import os
 import socket
 import subprocess
+import tempfile
 
+from lxml import etree, html
+
+from .const import MIME_TYPE_DEFAULT
 import requests
-from lxml import html
+
+from .httpclient import (create_session, DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT, RETRY_STATUS)
+from .tikapool import EndpointUnavailable
 
 mlgg = logging.getLogger(__name__)
 
+EXTRACT_MODE_CLASSIC = 'classic'
+"""Fetch each part of the bundle with its own request, see ``pym()``"""
+EXTRACT_MODE_RMETA = 'rmeta'
+"""Fetch the bundle with a single request to ``/rmeta``"""
+
+LANGUAGE_SAMPLE_SIZE = 10000
+"""Number of characters of text to identify language from"""
+
+DEFAULT_MAX_TEXT_SIZE = 10 * 1024 * 1024
+"""Extracted text and HTML are truncated after this many characters..."""
+DEFAULT_MAX_FILE_SIZE = 512 * 1024 * 1024
+"""...and of larger files, in bytes, only metadata is extracted."""
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 16 * 1024 * 1024
+"""Unpacked archives are kept in memory up to this size, else on disk"""
+
+WRITE_LIMIT_KEY = 'X-TIKA:EXCEPTION:write_limit_reached'
+"""Set by ``/rmeta`` in the metadata of a document whose text was cut"""
+
 
 # See also https://github.com/chrismattmann/tika-python/blob/master/tika/tika.py
 class TikaPymMixin:
 
+    extract_mode = EXTRACT_MODE_CLASSIC
+    max_text_size = 0
+    """Maximum number of characters of text and HTML; 0 for no limit"""
+    max_file_size = 0
+    """Of larger files only fetch metadata; 0 for no limit"""
+
     def pym(self, fn, hh=None):
         """
         Fetches a bundle of meta information about given file.
 
         Returned dict has these keys: ``content-type``, ``meta_json``,
-        ``meta_xmp``, ``data_text``, ``data_html_head``, ``data_html_body``.
+        ``meta_xmp``, ``data_text``, ``data_html_head``, ``data_html_body``,
+        ``truncated``.
+
+        Text and HTML are truncated after ``max_text_size`` characters.
+        Files larger than ``max_file_size`` get no text, HTML, XMP or
+        language at all, see :meth:`pym_meta_only`. In both cases,
+        ``truncated`` is True.
 
         Some keys such as ``meta_json`` may already contain a key
         ``content-type``. Still, we provide the top-level key ``content-type``,
          which is more accurate (and may differ from the others).
 
+        If ``extract_mode`` is ``EXTRACT_MODE_RMETA``, delegates to
+        :meth:`pym_rmeta`.
+
         :param fn: Filename.
         :param hh: Optional array with header fields for Tika server
         :return: Dict with meta info.
         """
+        if self.extract_mode == EXTRACT_MODE_RMETA:
+            return self.pym_rmeta(fn, hh=hh)
         if hh is None:
             hh = {}
+        if self.is_too_large(fn):
+            return self.pym_meta_only(fn, hh=hh)
         m = {}
 
         ct = self.detect(fn, hh=hh)
         hh['content-type'] = ct
 
-        s = self.language(fn, hh=hh)
-        m['language'] = s if s else None
-
         s = self.meta(fn, 'json', hh=hh)
         m['meta_json'] = s if s else None
 
         s = self.meta(fn, 'xmp', hh=hh)
         m['meta_xmp'] = s if s else None
 
-        s = self.tika(fn, 'html', hh=hh)
-        if s:
-            # Split head and body
-            root = html.fromstring(s)
-            # Our XML always has UTF-8
-            m['data_html_head'] = html.tostring(root.head).decode('utf-8')
-            m['data_html_body'] = html.tostring(root.body).decode('utf-8')
-        else:
-            m['data_html_head'] = None
-            m['data_html_body'] = None
+        m['mime_type'] = ct
+
+        s = self.language(fn, hh=hh)
+        m['language'] = s if s else None
+
+        s, truncated_html = self.tika_limited(fn, 'html', hh=hh)
+        m['data_html_head'], m['data_html_body'], _ = split_html(s)
 
-        s = self.tika(fn, 'text', hh=hh)
+        s, truncated_text = self.tika_limited(fn, 'text', hh=hh)
         m['data_text'] = s if s else None
+        m['truncated'] = truncated_html or truncated_text
+        return m
 
-        m['mime_type'] = ct
+    def pym_rmeta(self, fn, hh=None):
+        """
+        Fetches the same bundle as :meth:`pym` with a single request.
+
+        The file is sent once to ``/rmeta/html``. Content type and JSON meta
+        data are taken from the metadata of the container document, HTML from
+        its content, text from the HTML of the container and all embedded
+        documents. The language is identified from a sample of that text,
+        which is much smaller than the file. XMP is not available this way,
+        so ``meta_xmp`` is always None.
+
+        Tika stops writing text after ``max_text_size`` characters; of files
+        larger than ``max_file_size`` it extracts metadata only.
+
+        :param fn: Filename.
+        :param hh: Optional array with header fields for Tika server
+        :return: Dict with meta info.
+        """
+        if hh is None:
+            hh = {}
+        if self.is_too_large(fn):
+            return self.pym_meta_only(fn, hh=hh)
+        if self.max_text_size:
+            hh['writeLimit'] = str(self.max_text_size)
+        m = bundle_from_rmeta(self.rmeta(fn, type_='html', hh=hh),
+            max_text_size=self.max_text_size)
+        s = m['data_text']
+        s = self.language_text(s[:LANGUAGE_SAMPLE_SIZE]) if s else None
+        m['language'] = s if s else None
         return m
 
+    def pym_meta_only(self, fn, hh=None):
+        """
+        Fetches the bundle of a file too large to extract its content.
+
+        The file is sent once to ``/rmeta/ignore``, which returns metadata
+        but no content. Text, HTML, XMP and language are None, and
+        ``truncated`` is True.
+
+        :param fn: Filename.
+        :param hh: Optional array with header fields for Tika server
+        :return: Dict with meta info.
+        """
+        m = bundle_from_rmeta(self.rmeta(fn, type_='ignore', hh=hh))
+        m['truncated'] = True
+        return m
+
+    def is_too_large(self, fn):
+        """Tells whether only metadata is to be extracted from file ``fn``."""
+        if not self.max_file_size:
+            return False
+        size = os.path.getsize(fn)
+        if size <= self.max_file_size:
+            return False
+        mlgg.info("Extracting only metadata of '{}', {} bytes".format(
+            fn, size))
+        return True
+
+    def tika_limited(self, fn, type_='text', hh=None):
+        """
+        Returns text or HTML of content, at most ``max_text_size``
+        characters.
+
+        This implementation truncates the complete result, subclasses may
+        read less.
+
+        :return: Tuple(text, truncated)
+        """
+        s = self.tika(fn, type_, hh=hh)
+        if self.max_text_size and s and len(s) > self.max_text_size:
+            return s[:self.max_text_size], True
+        return s, False
+
+
+def split_html(s):
+    """
+    Splits HTML as returned by Tika into head and body.
+
+    HTML cut after ``max_text_size`` characters may end before the body, or
+    even within the head. Parts that are missing are None.
+
+    :param s: HTML, may be None.
+    :return: Tuple(head, body, text of body); all may be None.
+    """
+    if not s or not s.strip():
+        return None, None, None
+    try:
+        root = html.fromstring(s)
+    except etree.ParserError:
+        # Nothing but whitespace or comments
+        return None, None, None
+    head = root.head
+    body = root.body
+    # Our XML always has UTF-8
+    return (
+        html.tostring(head).decode('utf-8') if head is not None else None,
+        html.tostring(body).decode('utf-8') if body is not None else None,
+        body.text_content().strip() if body is not None else None
+    )
+
+
+def bundle_from_rmeta(docs, max_text_size=0):
+    """
+    Builds the bundle of :meth:`TikaPymMixin.pym` from output of ``/rmeta/html``.
+
+    Key ``language`` is set to None, it is up to the caller to identify the
+    language of ``data_text``.
+
+    :param docs: List of dicts as returned by ``/rmeta/html``.
+    :param max_text_size: Truncate text after this many characters; 0 for
+        no limit.
+    :return: Dict with meta info.
+    """
+    m = {}
+    if not isinstance(docs, list) or not docs:
+        docs = [{}]
+    meta = dict(docs[0])
+    s = meta.pop('X-TIKA:content', None)
+    ct = meta.get('Content-Type', '')
+    if isinstance(ct, list):
+        ct = ct[0]
+    m['mime_type'] = ct.split(';')[0].strip() or MIME_TYPE_DEFAULT
+    m['meta_json'] = meta if meta else None
+    m['meta_xmp'] = None
+    m['data_html_head'], m['data_html_body'], text = split_html(s)
+    texts = [text] if text else []
+    for d in docs[1:]:
+        text = split_html(d.get('X-TIKA:content'))[2]
+        if text:
+            texts.append(text)
+    s = '\n\n'.join(t for t in texts if t)
+    truncated = any(WRITE_LIMIT_KEY in d for d in docs)
+    if max_text_size and len(s) > max_text_size:
+        s = s[:max_text_size]
+        truncated = True
+    m['data_text'] = s if s else None
+    m['language'] = None
+    m['truncated'] = truncated
+    return m
+
 
 class TikaCli(TikaPymMixin):
 
@@ -162,12 +342,48 @@ class TikaRestClient(TikaPymMixin):
         'csv': {'accept': 'text/csv'},
     }
 
-    def __init__(self, host='localhost', port=9998):
+    def __init__(self, host='localhost', port=9998,
+            extract_mode=EXTRACT_MODE_CLASSIC, session=None, timeout=None,
+            max_text_size=DEFAULT_MAX_TEXT_SIZE,
+            max_file_size=DEFAULT_MAX_FILE_SIZE, pool=None):
+        """
+        Communicate with TIKA server via REST.
+
+        :param host: Host of Tika server.
+        :param port: Port of Tika server.
+        :param extract_mode: How ``pym()`` fetches its bundle, see
+            ``EXTRACT_MODE_*``.
+        :param session: Instance of :class:`requests.Session`, which may be
+            shared by several clients and threads. If None, a pooled session
+            with default settings is created, see
+            :func:`stoma.httpclient.create_session`.
+        :param timeout: Timeout of requests in seconds, either a float or a
+            tuple (connect timeout, read timeout). If None, the defaults of
+            :mod:`stoma.httpclient` apply.
+        :param max_text_size: Maximum number of characters of extracted text
+            and HTML; 0 for no limit. Longer responses are read only up to
+            the limit.
+        :param max_file_size: Of files larger than this many bytes, only
+            metadata is extracted; 0 for no limit.
+        :param pool: Optional instance of :class:`stoma.tikapool.TikaPool`.
+            If given, requests are spread over its endpoints instead of going
+            to ``host`` and ``port``, and a request that failed on one
+            endpoint is retried on another.
+        """
         self.host = host
         self.port = port
         self.url = 'http://{}:{}'.format(host, port)
+        self.extract_mode = extract_mode
+        self.session = session if session else create_session()
+        self.timeout = timeout if timeout else (DEFAULT_CONNECT_TIMEOUT,
+            DEFAULT_READ_TIMEOUT)
+        self.max_text_size = max_text_size
+        self.max_file_size = max_file_size
+        self.pool = pool
 
     def is_running(self):
+        if self.pool is not None:
+            return self.pool.is_running()
         ip = socket.gethostbyname(self.host)
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -182,8 +398,7 @@ class TikaRestClient(TikaPymMixin):
             return False
 
     def version(self):
-        url = self.url + '/version'
-        return requests.get(url).text
+        return self._request('GET', '/version').text
 
     def detect(self, fn, hh):
         """
@@ -199,8 +414,7 @@ class TikaRestClient(TikaPymMixin):
         hh.update({
             'content-disposition': 'attachment; filename={}'.format(fn)
         })
-        url = self.url + '/detect/stream'
-        r = self._send(url, fn, hh)
+        r = self._send('/detect/stream', fn, hh)
         return r.text
 
     def language(self, fn, hh):
@@ -214,15 +428,29 @@ class TikaRestClient(TikaPymMixin):
         """
         if hh is None:
             hh = {}
-        url = self.url + '/language/stream'
-        r = self._send(url, fn, hh)
+        r = self._send('/language/stream', fn, hh)
         return r.text
 
-    def rmeta(self, fn, hh=None):
+    def language_text(self, text):
+        """
+        Returns identified language of given text as 2 chars.
+
+        :param text: The text.
+        :returns: The language.
+        :rtype: string
+        """
+        r = self._request('PUT', '/language/string',
+            data=text.encode('utf-8'),
+            headers={'content-type': 'text/plain; charset=utf-8'})
+        return r.text
+
+    def rmeta(self, fn, type_=None, hh=None):
         """
         Returns recursive meta info about compound document.
 
         :param fn: Filename.
+        :param type_: Optional format of content: 'html', 'xml', 'text' or
+            'ignore'. Tika's default is XML.
         :param hh: Optional array with header fields for Tika server
         :returns: List of dicts. Each dict has meta info about one of the
             compound documents. Key ``X-TIKA:content`` contains text document.
@@ -230,8 +458,10 @@ class TikaRestClient(TikaPymMixin):
         """
         if hh is None:
             hh = {}
-        url = self.url + '/rmeta'
-        r = self._send(url, fn, hh)
+        path = '/rmeta'
+        if type_:
+            path += '/' + type_
+        r = self._send(path, fn, hh)
         try:
             return r.json()
         except ValueError:
@@ -241,6 +471,9 @@ class TikaRestClient(TikaPymMixin):
         """
         Unpacks compound document and returns ZIP archive.
 
+        The archive is streamed into a temporary file, which is kept in
+        memory up to ``SPOOL_SIZE`` bytes.
+
         :param fn: Filename
         :param hh: Optional array with header fields for Tika server
         :param all_: Get all compound documents.
@@ -251,11 +484,21 @@ class TikaRestClient(TikaPymMixin):
         hh.update({
             'content-type': 'application/zip'
         })
-        url = self.url + '/unpack'
+        path = '/unpack'
         if all_:
-            url += '/all'
-        r = self._send(url, fn, hh)
-        return io.BytesIO(r.content) if r.content else None
+            path += '/all'
+        r = self._send(path, fn, hh, stream=True)
+        f = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+        finally:
+            r.close()
+        if not f.tell():
+            f.close()
+            return None
+        f.seek(0)
+        return f
 
     def meta(self, fn, type_='json', hh=None):
         """
@@ -270,8 +513,7 @@ class TikaRestClient(TikaPymMixin):
         if hh is None:
             hh = {}
         hh.update(self.__class__.TYPE_MAP[type_])
-        url = self.url + '/meta'
-        r = self._send(url, fn, hh)
+        r = self._send('/meta', fn, hh)
         if type_ == 'json':
             try:
                 return r.json()
@@ -293,23 +535,117 @@ class TikaRestClient(TikaPymMixin):
             hh = {}
         hh.update(self.__class__.TYPE_MAP[type_])
         hh['Accept-Charset'] = 'unicode-1-1; q=1.0'
-        url = self.url + '/tika'
-        r = self._send(url, fn, hh)
+        r = self._send('/tika', fn, hh)
         r.encoding = 'utf-8'
         return r.text
 
-    @staticmethod
-    def _send(url, fn, hh):
+    def tika_limited(self, fn, type_='text', hh=None):
+        """
+        Returns text or HTML of content, at most ``max_text_size``
+        characters.
+
+        The response is streamed and only read up to the limit.
+
+        :return: Tuple(text, truncated)
+        """
+        if hh is None:
+            hh = {}
+        hh.update(self.__class__.TYPE_MAP[type_])
+        hh['Accept-Charset'] = 'unicode-1-1; q=1.0'
+        r = self._send('/tika', fn, hh, stream=True)
+        return read_limited(r, self.max_text_size)
+
+    def _send(self, path, fn, hh, stream=False):
         """
         PUTs given file to URL.
 
         Also sets header content-disposition.
 
-        :param url: Destination URL.
+        :param path: Path of destination URL.
         :param fn: Filename
         :param hh: Optional array with header fields for Tika server
+        :param stream: If set, the body of the response is not read yet;
+            the caller must read it or close the response.
         :return: `request.Response`
         """
         hh['content-disposition'] = 'attachment; filename={}'.format(fn)
+        return self._request('PUT', path, fn=fn, headers=hh, stream=stream)
+
+    def _request(self, method, path, fn=None, data=None, headers=None,
+            stream=False):
+        """
+        Sends a request to Tika, or to an endpoint of the pool.
+
+        With a pool, a request whose endpoint is unreachable, times out or
+        answers with a status of ``RETRY_STATUS`` is sent to another
+        endpoint, up to once per endpoint.
+
+        :param method: HTTP method.
+        :param path: Path of URL.
+        :param fn: Name of a file to send as body...
+        :param data: ...or the body.
+        :param headers: Dict of header fields.
+        :param stream: Whether to stream the response.
+        :return: `request.Response`
+        """
+        if self.pool is None:
+            return self._do(method, self.url + path, fn, data, headers,
+                stream)
+        n = len(self.pool)
+        for i in range(n):
+            last = i == n - 1
+            try:
+                with self.pool.endpoint() as ep:
+                    r = self._do(method, ep.url + path, fn, data, headers,
+                        stream)
+                    if r.status_code in RETRY_STATUS and not last:
+                        r.close()
+                        raise EndpointUnavailable('{} answered {}'.format(
+                            ep.url, r.status_code))
+                    return r
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if last:
+                    raise
+                mlgg.warning('{}; trying another Tika endpoint'.format(exc))
+
+    def _do(self, method, url, fn, data, headers, stream):
+        if fn is None:
+            return self.session.request(method, url, data=data,
+                headers=headers, timeout=self.timeout, stream=stream)
+        # Opened per attempt, a retry must send the file from its start
         with open(fn, 'rb') as fh:
-            return requests.put(url, data=fh, headers=hh)
+            return self.session.request(method, url, data=fh,
+                headers=headers, timeout=self.timeout, stream=stream)
+
+
+def read_limited(r, max_size):
+    """
+    Reads the UTF-8 body of a streamed response, up to a number of
+    characters.
+
+    The response is closed afterwards. If it was not read to its end, its
+    connection is dropped rather than reused.
+
+    :param r: Instance of :class:`requests.Response`, requested with
+        ``stream=True``.
+    :param max_size: Maximum number of characters; 0 for no limit.
+    :return: Tuple(text, truncated)
+    """
+    dec = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    parts = []
+    n = 0
+    truncated = False
+    try:
+        for chunk in r.iter_content(CHUNK_SIZE):
+            s = dec.decode(chunk)
+            if max_size and n + len(s) > max_size:
+                parts.append(s[:max_size - n])
+                truncated = True
+                break
+            parts.append(s)
+            n += len(s)
+        else:
+            parts.append(dec.decode(b'', final=True))
+    finally:
+        r.close()
+    return ''.join(parts), truncated
@@ -0,0 +1,217 @@
+import contextlib
+import itertools
+import logging
+import threading
+import time
+
+import requests
+
+from .httpclient import DEFAULT_CONNECT_TIMEOUT
+
+
+mlgg = logging.getLogger(__name__)
+
+DEFAULT_CHECK_INTERVAL = 10.0
+DEFAULT_MAX_FAILURES = 3
+DEFAULT_EJECT_SECONDS = 60.0
+
+
+class EndpointUnavailable(requests.ConnectionError):
+    """An endpoint answered that it is unavailable, e.g. with status 503."""
+
+
+def parse_endpoints(s, default_port=9998):
+    """
+    Parses a list of endpoints.
+
+    :param s: String 'HOST[:PORT], ...', or list of such strings.
+    :param default_port: Port of endpoints given without one.
+    :return: List of tuples (host, port).
+    """
+    if isinstance(s, str):
+        s = s.split(',')
+    endpoints = []
+    for x in s:
+        x = x.strip()
+        if not x:
+            continue
+        host, _, port = x.partition(':')
+        endpoints.append((host, int(port) if port else default_port))
+    return endpoints
+
+
+class TikaEndpoint:
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.url = 'http://{}:{}'.format(host, port)
+        self.outstanding = 0
+        """Number of requests in flight"""
+        self.failures = 0
+        """Number of consecutive failures"""
+        self.ejected_until = None
+        """Monotonic time until which the endpoint is not used, or None"""
+
+    def __repr__(self):
+        return '<TikaEndpoint {}>'.format(self.url)
+
+
+class TikaPool:
+
+    def __init__(self, endpoints, session=None,
+            check_interval=DEFAULT_CHECK_INTERVAL,
+            max_failures=DEFAULT_MAX_FAILURES,
+            eject_seconds=DEFAULT_EJECT_SECONDS):
+        """
+        Spreads requests over several Tika servers.
+
+        Each request goes to the endpoint with the fewest requests in flight,
+        ties are broken round robin. An endpoint that failed ``max_failures``
+        times in a row, by connection errors, timeouts or a status in
+        :data:`stoma.httpclient.RETRY_STATUS`, is ejected for
+        ``eject_seconds``. A background thread checks all endpoints every
+        ``check_interval`` seconds by requesting ``/version``: it ejects
+        those that fail, and takes back ejected ones that answer again.
+
+        If all endpoints are ejected, requests go to the one ejected first,
+        rather than failing outright.
+
+        :param endpoints: List of tuples (host, port).
+        :param session: HTTP session for health checks. It should not
+            retry, or a dead endpoint is ejected only after all retries.
+        :param check_interval: Seconds between health checks; 0 to not check.
+        :param max_failures: Number of consecutive failures after which an
+            endpoint is ejected.
+        :param eject_seconds: Duration of an ejection.
+        """
+        if not endpoints:
+            raise ValueError('No Tika endpoints given')
+        self.endpoints = [TikaEndpoint(host, port) for host, port in endpoints]
+        self.session = session if session else requests.Session()
+        self.check_interval = check_interval
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self._rr = itertools.count()
+        self._stop = threading.Event()
+        self._checker = None
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def start(self):
+        """Starts the health checks."""
+        if self.check_interval and self._checker is None:
+            self._stop.clear()
+            self._checker = threading.Thread(target=self._check_loop,
+                name='tika-health', daemon=True)
+            self._checker.start()
+
+    def close(self):
+        """Stops the health checks."""
+        self._stop.set()
+        if self._checker is not None:
+            self._checker.join()
+            self._checker = None
+
+    def acquire(self):
+        """
+        Picks an endpoint for a request.
+
+        Call :meth:`release` when the request is done.
+
+        :return: Instance of :class:`TikaEndpoint`.
+        """
+        with self._lock:
+            now = time.monotonic()
+            n = len(self.endpoints)
+            start = next(self._rr) % n
+            candidates = [self.endpoints[(start + i) % n] for i in range(n)]
+            healthy = [ep for ep in candidates
+                if not self._is_ejected(ep, now)]
+            if healthy:
+                ep = min(healthy, key=lambda e: e.outstanding)
+            else:
+                ep = min(candidates, key=lambda e: e.ejected_until)
+            ep.outstanding += 1
+            return ep
+
+    def release(self, ep, ok):
+        """
+        Reports the end of a request.
+
+        :param ep: Endpoint as returned by :meth:`acquire`.
+        :param ok: False if the endpoint failed.
+        """
+        with self._lock:
+            ep.outstanding -= 1
+            if ok:
+                ep.failures = 0
+                return
+            ep.failures += 1
+            if ep.failures >= self.max_failures:
+                self._eject(ep)
+
+    @contextlib.contextmanager
+    def endpoint(self):
+        """
+        Context manager to run a request on an endpoint.
+
+        Yields an endpoint. The endpoint is reported failed if the block
+        raises :class:`requests.ConnectionError` or
+        :class:`requests.Timeout`; other exceptions are the request's
+        fault, not the endpoint's.
+        """
+        ep = self.acquire()
+        ok = True
+        try:
+            yield ep
+        except (requests.ConnectionError, requests.Timeout):
+            ok = False
+            raise
+        finally:
+            self.release(ep, ok)
+
+    def is_running(self):
+        """Tells whether any endpoint is up."""
+        return any(self.check(ep) for ep in self.endpoints)
+
+    def check(self, ep):
+        """
+        Checks health of an endpoint and ejects or takes it back.
+
+        :return: True if endpoint is healthy.
+        """
+        try:
+            r = self.session.get(ep.url + '/version',
+                timeout=DEFAULT_CONNECT_TIMEOUT)
+            ok = r.ok
+        except requests.RequestException:
+            ok = False
+        with self._lock:
+            if ok:
+                if ep.ejected_until is not None:
+                    mlgg.info('Taking back Tika endpoint {}'.format(ep.url))
+                ep.failures = 0
+                ep.ejected_until = None
+            elif not self._is_ejected(ep, time.monotonic()):
+                self._eject(ep)
+        return ok
+
+    @staticmethod
+    def _is_ejected(ep, now):
+        return ep.ejected_until is not None and ep.ejected_until > now
+
+    def _eject(self, ep):
+        # Caller must hold the lock
+        now = time.monotonic()
+        if not self._is_ejected(ep, now):
+            mlgg.warning('Ejecting Tika endpoint {} for {} s'.format(
+                ep.url, self.eject_seconds))
+        ep.ejected_until = now + self.eject_seconds
+
+    def _check_loop(self):
+        while not self._stop.wait(self.check_interval):
+            for ep in self.endpoints:
+                self.check(ep)
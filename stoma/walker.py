@@ -1,159 +1,765 @@
 import os
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 
 import sqlalchemy as sa
 from zope.sqlalchemy import mark_changed
 
 from .const import (ITEM_STATE_NEED_ANALYSIS, ITEM_STATE_NEED_DELETION,
-    ITEM_STATE_UNCHANGED, IN_PROCESS_ITEM_STATES, STAT_ATTR)
-from .mime import guess_mime_type
-from .models import Item, exclude_filter
+    ITEM_STATE_DELETED, ITEM_STATE_NEED_INDEXING, IN_PROCESS_ITEM_STATES,
+    ANALYSED_ITEM_STATES, STAT_ATTR, MIME_TYPE_UNKNOWN)
+from .digest import file_digest
+from .metrics import WALK_PHASE_SECONDS, WALK_ITEMS
+from .mime import MimeDetector, guess_from_extension
+from .models import Item, Directory, below
+from .pgcopy import is_postgresql, copy_from
+from .records import ItemRecords
 
 
 ACTION_INSERT = 'i'
 ACTION_UPDATE = 'u'
 ACTION_DELETE = 'd'
 ACTION_NOOP = 'n'
+ACTION_TOUCH = 't'
+
+DELETE_KEEP_STATES = IN_PROCESS_ITEM_STATES + (ITEM_STATE_NEED_DELETION,
+    ITEM_STATE_DELETED)
+"""Items in these states are not marked for deletion"""
+
+STAGE_TABLE = 'item_stage'
+STAGE_COLUMNS = ('action', 'path', 'state', 'mime_type', 'encoding',
+    'item_ctime', 'item_mtime', 'size', 'os_stat', 'digest')
+ROW_COLUMNS = STAGE_COLUMNS[1:]
+TOUCH_COLUMNS = ('state', 'item_ctime', 'item_mtime', 'os_stat')
+
+SQL_CREATE_STAGE = """
+CREATE TEMPORARY TABLE IF NOT EXISTS {stage} (
+    action CHAR(1) NOT NULL,
+    path VARCHAR NOT NULL,
+    state VARCHAR,
+    mime_type VARCHAR,
+    encoding VARCHAR,
+    item_ctime TIMESTAMP,
+    item_mtime TIMESTAMP,
+    size BIGINT,
+    os_stat JSONB,
+    digest VARCHAR
+) ON COMMIT DROP
+"""
+
+SQL_UPSERT = """
+INSERT INTO {item} ({cols})
+SELECT {cols} FROM {stage}
+WHERE action IN ('{insert}', '{update}')
+ON CONFLICT (path) DO UPDATE SET {sets}
+"""
+
+SQL_TOUCH = """
+UPDATE {item} AS i SET {sets}
+FROM {stage} AS s
+WHERE s.action = '{touch}' AND i.path = s.path
+"""
+
+SQL_DELETE = """
+UPDATE {item} AS i SET state = :state
+FROM {stage} AS s
+WHERE s.action = '{delete}' AND i.path = s.path AND i.state <> ALL(:keep)
+"""
 
 
 class Walker:
 
-    def __init__(self, lgg, sess):
+    def __init__(self, lgg, sess, walk_workers=1, batch_size=1000,
+            full_scan=False, digest=None, defer_mime=False):
+        """
+        Walks a filesystem tree and records changes in the database.
+
+        Unless ``full_scan`` is set, a directory whose mtime and link count
+        are the same as during the last walk is not listed again: its files
+        are taken as unchanged, and its subdirectories are taken from the
+        database and visited as usual. A directory's metadata changes if
+        entries are added, removed or renamed in it, but not if a file in it
+        is modified in place. Such modifications are only found by a full
+        scan, or by ``stoma watch``.
+
+        :param lgg: Logger
+        :param sess: DB session
+        :param walk_workers: Number of threads to collect items with.
+        :param batch_size: Number of changes per batch in streaming mode.
+        :param full_scan: Whether to list all directories.
+        :param digest: Name of digest algorithm, see
+            :func:`stoma.digest.file_digest`. If set, a file whose mtime
+            changed but whose size and digest did not, is only re-indexed
+            instead of re-analysed. The digest is only computed here if the
+            size is unchanged; otherwise the analyser computes it.
+        :param defer_mime: If set, files are not read to detect their mime
+            type during the walk. Files without a known extension get
+            ``MIME_TYPE_UNKNOWN``, which analysis replaces with the type Tika
+            detects, or :meth:`detect_deferred` with that of libmagic.
+        """
         self.lgg = lgg
         self.sess = sess
-        self.items = {}
+        self.walk_workers = walk_workers
+        self.batch_size = batch_size
+        self.full_scan = full_scan
+        self.digest = digest
+        self.defer_mime = defer_mime
+        self.items = ItemRecords()
         self.known_items = {}
+        self.deletes = []
         self.start_dir = None
+        self.known_dirs = None
+        self.known_subdirs = {}
+        self.seen_dirs = {}
+        self.pruned_dirs = set()
+        self.on_batch = None
+        """
+        Optional callable, called after each saved batch with the list of
+        paths that need analysis. It may commit the current transaction.
+        """
+        self._read_sess = None
+        self.use_copy = None
+        """
+        Whether to save with ``COPY``; None to decide by the database.
+        """
+        self.mime = MimeDetector(workers=walk_workers)
+        """
+        Detects mime types of new and changed items, batch by batch.
+        """
+
+    def close(self):
+        """Stops the threads of mime type detection."""
+        self.mime.close()
 
     def walk(self, start_dir):
         self.start_dir = os.path.abspath(start_dir)
-        self.collect_items()
-        self.load_items()
-        self.compare()
-        self.save_items()
+        phases = (
+            ('load_dirs', self.load_dirs),
+            ('collect', self.collect_items),
+            ('load', self.load_items),
+            ('compare', self.compare),
+            ('save', self.save_items),
+            ('save_dirs', self.save_dirs),
+        )
+        for phase, func in phases:
+            with WALK_PHASE_SECONDS.time(phase=phase):
+                func()
 
     def collect_items(self):
         """
         Collects items from filesystem, starting with ``self.start_dir``.
+
+        Directories are listed with :func:`os.scandir`. If ``walk_workers`` is
+        greater than 1, subdirectories are spread across a thread pool of that
+        size, which pays off on network filesystems where each stat is a
+        round trip.
         """
-        self.lgg.debug("Collecting '{}'...".format(self.start_dir))
-        items = {}
-        for root, dirs, files in os.walk(self.start_dir):
-            for f in files:
-                fn = os.path.join(root, f)
-                st = os.stat(fn, follow_symlinks=False)
-                items[fn] = {'os_stat': st}
-                items[fn]['item_ctime'] = datetime.fromtimestamp(st.st_ctime)
-                items[fn]['item_mtime'] = datetime.fromtimestamp(st.st_mtime)
+        self.lgg.debug("Collecting '{}' with {} worker(s)...".format(
+            self.start_dir, self.walk_workers))
+        items = ItemRecords()
+        if self.walk_workers > 1:
+            scanned = self._collect_parallel()
+        else:
+            scanned = self._collect_serial()
+        for fn, st in scanned:
+            items.append(fn, st)
         self.items = items
         self.lgg.info('Collected {} items'.format(len(items)))
 
+    def _collect_serial(self, start_dir=None):
+        dirs = [start_dir or self.start_dir]
+        while dirs:
+            files, subdirs = self._scan_dir(dirs.pop())
+            yield from files
+            dirs.extend(subdirs)
+
+    def _collect_parallel(self):
+        with ThreadPoolExecutor(max_workers=self.walk_workers) as executor:
+            pending = {executor.submit(self._scan_dir, self.start_dir)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    files, subdirs = fut.result()
+                    yield from files
+                    for d in subdirs:
+                        pending.add(executor.submit(self._scan_dir, d))
+
+    def _scan_dir(self, path):
+        """
+        Lists a single directory.
+
+        Like :func:`os.walk`, symlinks to directories are not followed and
+        unreadable directories are skipped.
+
+        :param path: Directory to list.
+        :return: Tuple(files, subdirs); ``files`` is a list of tuples
+            (filename, stat result), ``subdirs`` a list of directory names.
+        """
+        files = []
+        subdirs = []
+        if self.known_dirs is not None:
+            try:
+                st = os.stat(path)
+            except OSError as exc:
+                self.lgg.warning("Cannot stat '{}': {}".format(path, exc))
+                return files, subdirs
+            rec = (datetime.fromtimestamp(st.st_mtime), st.st_nlink)
+            if rec == self.known_dirs.get(path):
+                self.seen_dirs[path] = rec
+                self.pruned_dirs.add(path)
+                return files, list(self.known_subdirs.get(path, ()))
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                subdirs.append(entry.path)
+                            continue
+                        # Result is cached on the entry
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        # Vanished while we were looking
+                        continue
+                    files.append((entry.path, st))
+        except OSError as exc:
+            self.lgg.warning("Cannot list '{}': {}".format(path, exc))
+        else:
+            if self.known_dirs is not None:
+                self.seen_dirs[path] = rec
+        return files, subdirs
+
+    def load_dirs(self):
+        """
+        Loads directories from database, starting with ``self.start_dir``.
+
+        Known directories are kept as tuples (dir_mtime, nlink). On a full
+        scan, none are loaded, so that all directories are listed and their
+        records renewed.
+        """
+        self.known_dirs = {}
+        self.known_subdirs = {}
+        self.seen_dirs = {}
+        self.pruned_dirs = set()
+        if self.full_scan:
+            return
+        self.lgg.debug("Loading known directories")
+        rs = self.sess.query(
+            Directory.path, Directory.parent, Directory.dir_mtime,
+            Directory.nlink
+        ).filter(sa.or_(
+            Directory.path == self.start_dir,
+            below(Directory.path, self.start_dir)
+        ))
+        for r in rs:
+            self.known_dirs[r.path] = (r.dir_mtime, r.nlink)
+            self.known_subdirs.setdefault(r.parent, []).append(r.path)
+        self.lgg.info('Loaded {} known directories'.format(
+            len(self.known_dirs)))
+
+    def save_dirs(self):
+        """
+        Saves metadata of the directories seen during this walk.
+        """
+        sess = self.sess
+        t = Directory.__table__
+        known_dirs = self.known_dirs
+        seen_dirs = self.seen_dirs
+        inserts = []
+        updates = []
+        for p, (dir_mtime, nlink) in seen_dirs.items():
+            if p not in known_dirs:
+                inserts.append({'path': p, 'parent': os.path.dirname(p),
+                    'dir_mtime': dir_mtime, 'nlink': nlink})
+            elif known_dirs[p] != (dir_mtime, nlink):
+                updates.append({'p': p, 'dir_mtime': dir_mtime,
+                    'nlink': nlink})
+        self.lgg.info('{} directories pruned, {} listed'.format(
+            len(self.pruned_dirs), len(seen_dirs) - len(self.pruned_dirs)))
+        if self.full_scan:
+            # We did not load known directories, so replace them all
+            sess.execute(t.delete().where(sa.or_(
+                t.c.path == self.start_dir,
+                below(t.c.path, self.start_dir)
+            )))
+        else:
+            deletes = [p for p in known_dirs.keys() if p not in seen_dirs]
+            if deletes:
+                sess.execute(t.delete().where(t.c.path.in_(deletes)))
+        if updates:
+            upd = t.update().where(t.c.path == sa.bindparam('p'))
+            sess.execute(upd, updates)
+        if inserts:
+            sess.execute(t.insert(), inserts)
+        mark_changed(sess)
+        self.known_dirs = None
+
     def load_items(self):
         """
         Loads items from database, starting with ``self.start_dir``.
+
+        Known items are kept as tuples (item_mtime, state), or, if digests
+        are enabled, (item_mtime, state, size, digest).
         """
         self.lgg.debug("Loading known items")
-        fil = [Item.path.like(self.start_dir + '%')]
-        rs = self.sess.query(
-            Item.path, Item.item_mtime, Item.state
-        ).filter(*fil)
-        self.known_items = {r.path:
-            {'item_mtime': r.item_mtime, 'state': r.state} for r in rs}
+        fil = [below(Item.path, self.start_dir)]
+        rs = self.sess.query(*self._known_columns()).filter(*fil)
+        known = self._known
+        self.known_items = {r.path: known(r) for r in rs}
         self.lgg.info('Loaded {} known items'.format(len(self.known_items)))
 
     def compare(self):
         """
         Determines which items to create, update, and delete.
 
-        Sets key 'action' on items to tell whether this item is to create or
-        update in the database.
+        Sets the action of each collected item to tell whether this item is to
+        create or update in the database. Known items that were not collected
+        are listed in ``self.deletes``.
         """
         self.lgg.debug("Comparing")
         items = self.items
         known_items = self.known_items
-        n_new = n_update = n_delete = n_unchanged = 0
-        for it in items.keys():
-            if it in known_items:
-                if known_items[it]['state'] not in IN_PROCESS_ITEM_STATES:
-                    if items[it]['item_mtime'] != known_items[it]['item_mtime']:
-                        items[it]['mime_enc'] = guess_mime_type(it)
-                        items[it]['action'] = ACTION_UPDATE
-                        n_update += 1
-                    else:
-                        items[it]['action'] = ACTION_NOOP
-                        n_unchanged += 1
+        n = {ACTION_INSERT: 0, ACTION_UPDATE: 0, ACTION_DELETE: 0,
+            ACTION_NOOP: 0, ACTION_TOUCH: 0}
+        seen = 0
+        for i, it in items:
+            known = known_items.get(it)
+            if known is not None:
+                seen += 1
+            action = self._compare_item(it, items.stat(i), known)
+            items.set_action(i, action)
+            n[action] += 1
+        self.deletes = []
+        if seen < len(known_items):
+            paths = set(items.paths)
+            pruned = self.pruned_dirs
+            for it in known_items.keys():
+                if it in paths:
+                    continue
+                if os.path.dirname(it) in pruned:
+                    n[ACTION_NOOP] += 1
                 else:
-                    items[it]['action'] = ACTION_NOOP
-                    n_unchanged += 1
-            else:
-                items[it]['mime_enc'] = guess_mime_type(it)
-                items[it]['action'] = ACTION_INSERT
-                n_new += 1
-        for it in known_items.keys():
-            if it not in items:
-                known_items[it]['action'] = ACTION_DELETE
-                n_delete += 1
-        self.lgg.info('{} new, {} update, {} delete, {} unchanged; sum: {}'.format(
-            n_new, n_update, n_delete, n_unchanged, n_new + n_update + n_delete + n_unchanged)
+                    self.deletes.append(it)
+        n[ACTION_DELETE] = len(self.deletes)
+        self._log_counts(n)
+
+    def _known_columns(self):
+        cols = [Item.path, Item.item_mtime, Item.state]
+        if self.digest:
+            cols += [Item.size, Item.digest]
+        return cols
+
+    def _known(self, r):
+        if self.digest:
+            return r.item_mtime, sys.intern(r.state), r.size, r.digest
+        return r.item_mtime, sys.intern(r.state)
+
+    def _compare_item(self, path, st, known):
+        """
+        Determines action for a single item.
+
+        :param path: Path of item.
+        :param st: Stat result of item.
+        :param known: Tuple of known item as returned by :meth:`_known`,
+            None if item is new.
+        :return: The action.
+        """
+        if known is None:
+            return ACTION_INSERT
+        item_mtime, state = known[:2]
+        if state in (ITEM_STATE_NEED_DELETION, ITEM_STATE_DELETED):
+            # Reappeared
+            return ACTION_UPDATE
+        if state in IN_PROCESS_ITEM_STATES \
+                or datetime.fromtimestamp(st.st_mtime) == item_mtime:
+            return ACTION_NOOP
+        if self.digest and state in ANALYSED_ITEM_STATES \
+                and known[3] and known[2] == st.st_size:
+            try:
+                if file_digest(path, self.digest) == known[3]:
+                    return ACTION_TOUCH
+            except OSError as exc:
+                self.lgg.warning("Cannot compute digest of '{}': {}".format(
+                    path, exc))
+        return ACTION_UPDATE
+
+    def _log_counts(self, n):
+        self.lgg.info('{} new, {} update, {} touch, {} delete, {} unchanged; '
+            'sum: {}'.format(n[ACTION_INSERT], n[ACTION_UPDATE],
+                n[ACTION_TOUCH], n[ACTION_DELETE], n[ACTION_NOOP],
+                sum(n.values()))
         )
 
     def save_items(self):
         self.lgg.info("Saving...")
-        sess = self.sess
         items = self.items
-        known_items = self.known_items
-        t = Item.__table__
-
-        # 1. Assume all items are unchanged
-        fil = exclude_filter()
-        fil.append(t.c.path.like(self.start_dir + '%'))
-        sess.execute(
-            t.update().where(sa.and_(*fil)),
-            {'state': ITEM_STATE_UNCHANGED}
-        )
-        # 2. Prepare
         updates = []
         inserts = []
-        for p, d in items.items():
-            if d['action'] == ACTION_UPDATE:
-                updates.append({
-                    'p': p,
-                    'state': ITEM_STATE_NEED_ANALYSIS,
-                    'mime_type': d['mime_enc'][0],
-                    'encoding': d['mime_enc'][1],
-                    'item_ctime': d['item_ctime'],
-                    'item_mtime': d['item_mtime'],
-                    'size': d['os_stat'].st_size,
-                    'os_stat': {a: getattr(d['os_stat'], a) for a in STAT_ATTR},
-                })
-            elif d['action'] == ACTION_INSERT:
-                inserts.append({
-                    'path': p,
-                    'state': ITEM_STATE_NEED_ANALYSIS,
-                    'mime_type': d['mime_enc'][0],
-                    'encoding': d['mime_enc'][1],
-                    'item_ctime': d['item_ctime'],
-                    'item_mtime': d['item_mtime'],
-                    'size': d['os_stat'].st_size,
-                    'os_stat': {a: getattr(d['os_stat'], a) for a in STAT_ATTR},
-                })
-        deletes = [k for k, v in known_items.items() if v is None]
-        # 3. Update
+        touches = []
+        for i, p in items:
+            action = items.action(i)
+            if action == ACTION_UPDATE:
+                updates.append(self._row(p, items.stat(i)))
+            elif action == ACTION_INSERT:
+                inserts.append(self._row(p, items.stat(i)))
+            elif action == ACTION_TOUCH:
+                touches.append(self._touch_row(p, items.stat(i)))
+        self._save_batch(inserts, updates, self.deletes, touches)
+
+    @staticmethod
+    def _row(p, st):
+        # Mime type is detected for the whole batch in _save_batch()
+        return {
+            'path': p,
+            'state': ITEM_STATE_NEED_ANALYSIS,
+            'mime_type': None,
+            'encoding': None,
+            'item_ctime': datetime.fromtimestamp(st.st_ctime),
+            'item_mtime': datetime.fromtimestamp(st.st_mtime),
+            'size': st.st_size,
+            'os_stat': {a: getattr(st, a) for a in STAT_ATTR},
+            'digest': None,
+        }
+
+    @staticmethod
+    def _touch_row(p, st):
+        # Content is unchanged, only refresh the metadata in the index
+        return {
+            'p': p,
+            'state': ITEM_STATE_NEED_INDEXING,
+            'item_ctime': datetime.fromtimestamp(st.st_ctime),
+            'item_mtime': datetime.fromtimestamp(st.st_mtime),
+            'os_stat': {a: getattr(st, a) for a in STAT_ATTR},
+        }
+
+    def _save_batch(self, inserts, updates, deletes, touches=None):
+        """
+        Writes a batch of changes to the database.
+
+        Mime types of new and changed items are detected here, together.
+
+        :param inserts: List of row dicts of new items.
+        :param updates: List of row dicts of changed items.
+        :param deletes: List of paths of deleted items.
+        :param touches: List of row dicts of items whose mtime changed but
+            whose content did not.
+        """
+        paths = [r['path'] for r in inserts] + [r['path'] for r in updates]
+        with WALK_PHASE_SECONDS.time(phase='mime'):
+            self._detect_mime_types(inserts + updates)
+        if self.use_copy is None:
+            self.use_copy = is_postgresql(self.sess)
+        with WALK_PHASE_SECONDS.time(phase='save_batch'):
+            if self.use_copy:
+                self._save_batch_copy(inserts, updates, deletes, touches)
+            else:
+                self._save_batch_orm(inserts, updates, deletes, touches)
+        mark_changed(self.sess)
+        WALK_ITEMS.inc(len(inserts), action='insert')
+        WALK_ITEMS.inc(len(updates), action='update')
+        WALK_ITEMS.inc(len(deletes), action='delete')
+        WALK_ITEMS.inc(len(touches) if touches else 0, action='touch')
+        if self.on_batch is not None:
+            self.on_batch(paths)
+
+    def _detect_mime_types(self, rows):
+        if self.defer_mime:
+            for r in rows:
+                mime_type, encoding = guess_from_extension(r['path'])
+                r['mime_type'] = mime_type if mime_type else MIME_TYPE_UNKNOWN
+                r['encoding'] = encoding
+            return
+        files = [(r['path'], r['os_stat']) for r in rows]
+        for r, (mime_type, encoding) in zip(rows,
+                self.mime.guess_many(files)):
+            r['mime_type'] = mime_type
+            r['encoding'] = encoding
+
+    def detect_deferred(self, filter_crit=None):
+        """
+        Detects mime types that were deferred by the walk.
+
+        Pending items with ``MIME_TYPE_UNKNOWN`` are read by libmagic in
+        batches of ``batch_size``, with ``walk_workers`` threads, see
+        :class:`stoma.mime.MimeDetector`. Run this before analysis if it
+        needs the type, e.g. to choose local extractors or scheduler lanes.
+
+        :param filter_crit: Optional list of additional filter criteria.
+        :return: Number of items detected.
+        """
+        sess = self.sess
+        fil = [
+            Item.state == ITEM_STATE_NEED_ANALYSIS,
+            Item.mime_type == MIME_TYPE_UNKNOWN
+        ]
+        if filter_crit:
+            fil += filter_crit
+        t = Item.__table__
+        upd = t.update().where(t.c.path == sa.bindparam('p'))
+        n = 0
+        last = ''
+        while True:
+            rs = sess.query(Item.path, Item.os_stat).filter(
+                Item.path > last, *fil
+            ).order_by(Item.path).limit(self.batch_size).all()
+            if not rs:
+                break
+            last = rs[-1].path
+            with WALK_PHASE_SECONDS.time(phase='mime'):
+                mts = self.mime.guess_many([(r.path, r.os_stat) for r in rs])
+            sess.execute(upd, [{'p': r.path, 'mime_type': mt}
+                for r, (mt, _) in zip(rs, mts)])
+            mark_changed(sess)
+            n += len(rs)
+        self.lgg.info('Detected mime types of {} items'.format(n))
+        return n
+
+    def _save_batch_orm(self, inserts, updates, deletes, touches):
+        sess = self.sess
+        t = Item.__table__
+        if touches:
+            self.lgg.debug("Touching {}".format(len(touches)))
+            upd = t.update().where(t.c.path == sa.bindparam('p'))
+            sess.execute(upd, touches)
         if updates:
-            self.lgg.debug("Updating")
+            self.lgg.debug("Updating {}".format(len(updates)))
+            for r in updates:
+                r['p'] = r.pop('path')
             upd = t.update().where(t.c.path == sa.bindparam('p'))
             sess.execute(upd, updates)
-        # 4. inserts
         if inserts:
-            self.lgg.debug("Inserting")
-            ins = t.insert()
-            sess.execute(ins, inserts)
-        # 5. deletes
+            self.lgg.debug("Inserting {}".format(len(inserts)))
+            sess.execute(t.insert(), inserts)
         if deletes:
-            self.lgg.debug("Deleting")
-            fil = exclude_filter()
+            self.lgg.debug("Deleting {}".format(len(deletes)))
+            fil = [t.c.state.notin_(DELETE_KEEP_STATES)]
             fil.append(t.c.path.in_(deletes))
             upd = t.update().where(sa.and_(*fil))
             sess.execute(upd, {'state': ITEM_STATE_NEED_DELETION})
-        # 6. Flush
-        mark_changed(sess)
+
+    def _save_batch_copy(self, inserts, updates, deletes, touches):
+        """
+        Writes a batch of changes with PostgreSQL's ``COPY``.
+
+        All changes are copied into a temporary staging table, and applied
+        from there with one set-based statement per kind of change. New and
+        changed items are upserted, so that an item inserted meanwhile by
+        another process does not fail the batch.
+        """
+        sess = self.sess
+        n = len(inserts) + len(updates) + len(deletes) + len(touches or ())
+        if not n:
+            return
+        self.lgg.debug("Copying {} changes".format(n))
+        fmt = {
+            'item': Item.__table__.fullname,
+            'stage': STAGE_TABLE,
+            'insert': ACTION_INSERT,
+            'update': ACTION_UPDATE,
+            'touch': ACTION_TOUCH,
+            'delete': ACTION_DELETE,
+        }
+        sess.execute(SQL_CREATE_STAGE.format(**fmt))
+        # Within the same transaction, the table still has the last batch
+        sess.execute('TRUNCATE {}'.format(STAGE_TABLE))
+
+        def rows():
+            for action, rr in ((ACTION_INSERT, inserts),
+                    (ACTION_UPDATE, updates)):
+                for r in rr:
+                    yield (action,) + tuple(r[k] for k in ROW_COLUMNS)
+            for r in touches or ():
+                yield (ACTION_TOUCH, r['p']) + tuple(
+                    r.get(k) for k in ROW_COLUMNS[1:])
+            for p in deletes:
+                yield (ACTION_DELETE, p) + (None,) * (len(ROW_COLUMNS) - 1)
+
+        copy_from(sess, STAGE_TABLE, STAGE_COLUMNS, rows())
+        if inserts or updates:
+            sess.execute(SQL_UPSERT.format(
+                cols=', '.join(ROW_COLUMNS),
+                sets=', '.join('{0} = EXCLUDED.{0}'.format(c)
+                    for c in ROW_COLUMNS[1:]),
+                **fmt))
+        if touches:
+            sess.execute(SQL_TOUCH.format(
+                sets=', '.join('{0} = s.{0}'.format(c) for c in TOUCH_COLUMNS),
+                **fmt))
+        if deletes:
+            sess.execute(sa.text(SQL_DELETE.format(**fmt)), {
+                'state': ITEM_STATE_NEED_DELETION,
+                'keep': list(DELETE_KEEP_STATES)
+            })
+
+    # ===[ STREAMING ]=======
+
+    def walk_streaming(self, start_dir):
+        """
+        Walks, compares and saves with memory bound by ``batch_size``.
+
+        Instead of holding the whole tree in memory, the filesystem is walked
+        in sorted path order and merge-joined against a server-side cursor
+        over the known items, also sorted by path. Changes are written in
+        batches of ``batch_size``.
+
+        Both sides must agree on the sort order, hence the database sorts
+        bytewise (collation "C"), which for UTF-8 matches the code point
+        order of Python strings.
+        """
+        self.start_dir = os.path.abspath(start_dir)
+        self.lgg.debug("Streaming '{}' in batches of {}...".format(
+            self.start_dir, self.batch_size))
+        with WALK_PHASE_SECONDS.time(phase='load_dirs'):
+            self.load_dirs()
+        try:
+            with WALK_PHASE_SECONDS.time(phase='merge'):
+                self._merge_join()
+        finally:
+            if self._read_sess is not None:
+                self._read_sess.close()
+                self._read_sess = None
+        with WALK_PHASE_SECONDS.time(phase='save_dirs'):
+            self.save_dirs()
+
+    def _merge_join(self):
+        fs_it = self._iter_sorted(self.start_dir)
+        db_it = iter(self._query_known_sorted())
+        n = {ACTION_INSERT: 0, ACTION_UPDATE: 0, ACTION_DELETE: 0,
+            ACTION_NOOP: 0, ACTION_TOUCH: 0}
+        inserts = []
+        updates = []
+        deletes = []
+        touches = []
+        fs = next(fs_it, None)
+        db = next(db_it, None)
+        while fs is not None or db is not None:
+            if db is None or (fs is not None and fs[0] < db.path):
+                p, st = fs
+                known = None
+                fs = next(fs_it, None)
+            elif fs is None or db.path < fs[0]:
+                # Items of pruned directories are not collected. The walk
+                # has already passed, and thus scanned, this item's directory.
+                if os.path.dirname(db.path) in self.pruned_dirs:
+                    n[ACTION_NOOP] += 1
+                else:
+                    deletes.append(db.path)
+                    n[ACTION_DELETE] += 1
+                db = next(db_it, None)
+                continue
+            else:
+                p, st = fs
+                known = self._known(db)
+                fs = next(fs_it, None)
+                db = next(db_it, None)
+            action = self._compare_item(p, st, known)
+            n[action] += 1
+            if action == ACTION_INSERT:
+                inserts.append(self._row(p, st))
+            elif action == ACTION_UPDATE:
+                updates.append(self._row(p, st))
+            elif action == ACTION_TOUCH:
+                touches.append(self._touch_row(p, st))
+            if len(inserts) + len(updates) + len(deletes) + len(touches) \
+                    >= self.batch_size:
+                self._save_batch(inserts, updates, deletes, touches)
+                inserts = []
+                updates = []
+                deletes = []
+                touches = []
+        self._save_batch(inserts, updates, deletes, touches)
+        self._log_counts(n)
+
+    def _iter_sorted(self, path):
+        """
+        Yields files below ``path`` in sorted order of their full paths.
+
+        Siblings are sorted with a trailing separator on directory names, so
+        that e.g. ``a-b`` precedes ``a/x`` as it does in a plain string sort.
+
+        :param path: Directory to start with.
+        :return: Generator of tuples (filename, stat result).
+        """
+        files, subdirs = self._scan_dir(path)
+        entries = [(fn, st) for fn, st in files]
+        entries += [(d + os.sep, None) for d in subdirs]
+        entries.sort(key=lambda e: e[0])
+        for fn, st in entries:
+            if st is None:
+                yield from self._iter_sorted(fn[:-len(os.sep)])
+            else:
+                yield fn, st
+
+    def _query_known_sorted(self):
+        sess = self.sess
+        if self.on_batch is not None:
+            # Committing a batch would close a cursor of our session, so
+            # read from a separate connection.
+            sess = self._read_sess = sa.orm.Session(bind=sess.get_bind())
+        return sess.query(
+            *self._known_columns()
+        ).filter(
+            below(Item.path, self.start_dir)
+        ).order_by(
+            sa.collate(Item.path, 'C')
+        ).yield_per(self.batch_size)
+
+    # ===[ REFRESH ]=======
+
+    def refresh(self, paths):
+        """
+        Compares and saves only the given paths, e.g. from filesystem events.
+
+        A path that is a directory is collected recursively, a path that no
+        longer exists marks the item and, if it was a directory, all items
+        below it for deletion.
+
+        :param paths: Iterable of absolute paths.
+        """
+        items = ItemRecords()
+        files = []
+        prefixes = []
+        for p in paths:
+            try:
+                st = os.stat(p, follow_symlinks=False)
+            except FileNotFoundError:
+                files.append(p)
+                prefixes.append(p)
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                prefixes.append(p)
+                for fn, st2 in self._collect_serial(p):
+                    items.append(fn, st2)
+            else:
+                files.append(p)
+                items.append(p, st)
+        known_items = self._load_known(files, prefixes)
+        inserts = []
+        updates = []
+        touches = []
+        for i, p in items:
+            action = self._compare_item(p, items.stat(i), known_items.get(p))
+            if action == ACTION_INSERT:
+                inserts.append(self._row(p, items.stat(i)))
+            elif action == ACTION_UPDATE:
+                updates.append(self._row(p, items.stat(i)))
+            elif action == ACTION_TOUCH:
+                touches.append(self._touch_row(p, items.stat(i)))
+        collected = set(items.paths)
+        deletes = [p for p in known_items.keys() if p not in collected]
+        self.lgg.info('Refresh: {} new, {} update, {} touch, {} delete'.format(
+            len(inserts), len(updates), len(touches), len(deletes)))
+        self._save_batch(inserts, updates, deletes, touches)
+
+    def _load_known(self, files, prefixes):
+        fil = []
+        if files:
+            fil.append(Item.path.in_(files))
+        for p in prefixes:
+            fil.append(below(Item.path, p))
+        if not fil:
+            return {}
+        rs = self.sess.query(*self._known_columns()).filter(sa.or_(*fil))
+        return {r.path: self._known(r) for r in rs}
@@ -0,0 +1,139 @@
+import logging
+import os
+import time
+
+import pyinotify
+import transaction
+
+
+mlgg = logging.getLogger(__name__)
+
+WATCH_MASK = (pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE
+    | pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB | pyinotify.IN_DELETE
+    | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+
+
+class _EventHandler(pyinotify.ProcessEvent):
+
+    # noinspection PyMethodOverriding
+    def my_init(self, watcher):
+        self.watcher = watcher
+
+    def process_default(self, event):
+        if event.mask & pyinotify.IN_IGNORED:
+            return
+        self.watcher.touch(event.pathname)
+
+    def process_IN_Q_OVERFLOW(self, event):
+        self.watcher.overflow()
+
+
+class Watcher:
+
+    def __init__(self, lgg, walker, analyser, indexer, debounce=2.0,
+            max_delay=30.0):
+        """
+        Keeps database and index in sync with a directory tree.
+
+        After an initial full walk, changes are taken from inotify events.
+        Events are coalesced per path; a batch of paths is processed when no
+        new event arrived for ``debounce`` seconds, or at the latest
+        ``max_delay`` seconds after its first event. Processing a batch
+        refreshes the items in the database, then analyses and indexes all
+        pending items.
+
+        If the kernel's event queue overflows, events are lost, so the next
+        batch is a full walk again.
+
+        :param lgg: Logger
+        :param walker: Instance of :class:`stoma.walker.Walker`
+        :param analyser: Instance of :class:`stoma.analyser.Analyser`
+        :param indexer: Instance of :class:`stoma.indexer.Indexer`
+        :param debounce: Quiet period in seconds.
+        :param max_delay: Maximum delay in seconds.
+        """
+        self.lgg = lgg
+        self.walker = walker
+        self.analyser = analyser
+        self.indexer = indexer
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.start_dir = None
+        self.pending = set()
+        self.first_event = None
+        self.last_event = None
+        self.need_full_scan = True
+
+    def watch(self, start_dir):
+        """
+        Watches ``start_dir`` until interrupted.
+
+        :param start_dir: Directory to watch.
+        """
+        self.start_dir = os.path.abspath(start_dir)
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm, _EventHandler(watcher=self),
+            timeout=int(self.debounce * 1000))
+        # Add watches before the full walk, so that we miss no changes
+        # that happen during it.
+        wm.add_watch(self.start_dir, WATCH_MASK, rec=True, auto_add=True)
+        self.lgg.info("Watching '{}'".format(self.start_dir))
+        try:
+            while True:
+                self.process()
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+        finally:
+            notifier.stop()
+
+    def touch(self, path):
+        """Records an event for ``path``."""
+        now = time.monotonic()
+        if not self.pending:
+            self.first_event = now
+        self.last_event = now
+        self.pending.add(path)
+
+    def overflow(self):
+        self.lgg.warning('Event queue overflow, scheduling full walk')
+        self.need_full_scan = True
+
+    def is_due(self):
+        if self.need_full_scan:
+            return True
+        if not self.pending:
+            return False
+        now = time.monotonic()
+        return (now - self.last_event >= self.debounce
+            or now - self.first_event >= self.max_delay)
+
+    def process(self):
+        """Processes pending changes, if due."""
+        if not self.is_due():
+            return
+        if self.need_full_scan:
+            # A full walk covers all pending events
+            self.need_full_scan = False
+            self.pending = set()
+            self._run(self.walker.walk, self.start_dir)
+        else:
+            paths = self.pending
+            self.pending = set()
+            self.lgg.debug('Processing {} changed paths'.format(len(paths)))
+            self._run(self.walker.refresh, paths)
+        if self.analyser.workers > 1:
+            self.analyser.analyse_parallel()
+        else:
+            self._run(self.analyser.analyse)
+        self._run(self.indexer.index)
+
+    def _run(self, func, *args):
+        transaction.begin()
+        try:
+            func(*args)
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            self.lgg.error('Transaction aborted')
+            raise